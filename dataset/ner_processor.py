@@ -62,7 +62,7 @@ class NERProcessor(object):
                                            return_overflowing_tokens=self.return_truncated_tokens,
                                            padding=self.padding)
         labels = []
-
+        copy_spans = []
 
         j = 0
         for i, label in enumerate(examples_[f"ner_tags"]):
@@ -71,11 +71,16 @@ class NERProcessor(object):
                                                                                       "overflowing") else None
             label_ids = align_label(label, word_ids, label_all_tokens=label_all_tokens)
             labels.append(label_ids)
+            # Words of a copy in the duplicated sequence (a copy is followed by a [SEP] word in "sep" mode)
+            copy_length = len(examples_["original_tokens"][i]) if "original_tokens" in examples_ else len(label)
+            copy_stride = copy_length + 1 if duplicate_mode == "sep" else copy_length
+            copy_spans.append(word_copy_spans(word_ids, copy_length, copy_stride))
             if overflowing_tokens:
                 for encoding in overflowing_tokens:
                     word_ids = encoding.word_ids
                     label_ids = align_label(label, word_ids, label_all_tokens)
                     labels.append(label_ids)
+                    copy_spans.append(word_copy_spans(word_ids, copy_length, copy_stride))
                     j += 1
             j += 1
 
@@ -85,6 +90,8 @@ class NERProcessor(object):
             for key, values in examples_.items():
                 tokenized_inputs[key] = [values[i] for i in sample_map]
         tokenized_inputs["labels"] = labels
+        if duplicate:
+            tokenized_inputs["copy_spans"] = copy_spans
 
         if duplicate and duplicate_mode == "shift":
             pos_ids = [i for i in range(self.max_length)]
@@ -99,6 +106,25 @@ class NERProcessor(object):
         return tokenized_inputs
 
 
+def word_copy_spans(word_ids, copy_length, copy_stride):
+    """
+    Token boundaries `[[start, end], ...]` of each (possibly truncated) copy of a duplicated sequence, from the
+    `word_ids` of its encoding. Copy c holds the words `[c * copy_stride, c * copy_stride + copy_length)`; special
+    tokens and the words in between copies (e.g. [SEP] in "sep" mode) belong to no copy.
+    """
+    words = np.array([-1 if word_idx is None else word_idx for word_idx in word_ids])
+    in_copy = (words >= 0) & (words % max(copy_stride, 1) < copy_length)
+    (indices,) = in_copy.nonzero()
+    if len(indices) == 0:
+        return []
+    copies = words[indices] // max(copy_stride, 1)
+    # Tokens of a copy are contiguous: split where the copy index changes
+    boundaries = np.flatnonzero(np.diff(copies)) + 1
+    starts = indices[np.concatenate([[0], boundaries])]
+    ends = indices[np.concatenate([boundaries - 1, [len(indices) - 1]])] + 1
+    return np.stack([starts, ends], axis=1).tolist()
+
+
 def duplicate_seq(features, k=2, mode="none", sep_token="[SEP]"):
     if mode=="sep":
         tokens = [(k * (x + [sep_token]))[:-1] for x in features["tokens"]]
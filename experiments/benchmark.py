@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# file: benchmark.py
+#
+# Micro-benchmarks of the model and metric code paths. Models are randomly initialized from the default
+# `BertForTokenClassificationConfig` (bert-base sizes), so no checkpoint or dataset is needed.
+import argparse
+import io
+import time
+from typing import Callable
+
+import pandas as pd
+import torch
+
+from dataset.ner_dataset import NERDatasetbuilder
+from inference.decoding import label_scheme, viterbi_decode
+from method.position_shift import shift_offsets, shifted_position_ids
+from metrics.pos_loss import CrossEntropyLossPerPosition
+from models.attention import BertSelfAttention
+from models.bert_ner import BertForTokenClassification
+from models.config import BertForTokenClassificationConfig
+
+
+def timeit(fn: Callable, repeat: int = 20, warmup: int = 3) -> float:
+    """Median wall-clock time of `fn()` in milliseconds."""
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return float(pd.Series(times).median())
+
+
+def bench_attention(args):
+    """Explicit vs. fused (scaled_dot_product_attention) self-attention at several sequence lengths."""
+    config = BertForTokenClassificationConfig()
+    attention = BertSelfAttention(config).eval()
+    results = []
+    for max_length in args.max_lengths:
+        hidden_states = torch.randn(args.batch_size, max_length, config.hidden_size)
+        attention_mask = torch.zeros(args.batch_size, 1, 1, max_length)
+        row = {"max_length": max_length}
+        for fused in [False, True]:
+            attention.fused_attention = fused
+            with torch.inference_mode():
+                row["fused_ms" if fused else "explicit_ms"] = timeit(
+                    lambda: attention(hidden_states, attention_mask), repeat=args.repeat)
+        row["speedup"] = row["explicit_ms"] / row["fused_ms"]
+        # The explicit path materializes scores and probabilities of shape [batch, heads, L, L] in float32
+        row["explicit_attn_MB"] = 2 * 4 * args.batch_size * config.num_attention_heads * max_length ** 2 / 2 ** 20
+        results.append(row)
+    return pd.DataFrame(results)
+
+
+def bench_relative_positions(args):
+    """Dense (L x L x d gather) vs. skewed relative position scores for relative_key and relative_key_query."""
+    results = []
+    for position_embedding_type in ["relative_key", "relative_key_query"]:
+        config = BertForTokenClassificationConfig(position_embedding_type=position_embedding_type)
+        attention = BertSelfAttention(config).eval()
+        # Time the skewed path at every length, regardless of the dense fallback of short sequences
+        attention.relative_position_skew_min_length = 0
+        head_size = attention.attention_head_size
+        for max_length in args.max_lengths:
+            shape = (args.batch_size, config.num_attention_heads, max_length, head_size)
+            query_layer, key_layer = torch.randn(shape), torch.randn(shape)
+            row = {"type": position_embedding_type, "max_length": max_length}
+            scores = {}
+            for skew in [False, True]:
+                attention.relative_position_skew = skew
+                with torch.inference_mode():
+                    scores[skew] = attention.relative_position_scores(query_layer, key_layer)
+                    row["skew_ms" if skew else "dense_ms"] = timeit(
+                        lambda: attention.relative_position_scores(query_layer, key_layer), repeat=args.repeat)
+            row["speedup"] = row["dense_ms"] / row["skew_ms"]
+            row["max_abs_diff"] = (scores[True] - scores[False]).abs().max().item()
+            # Intermediates: gathered [L, L, d] distance embeddings vs. [batch, heads, block, block + L - 1] scores
+            block_size = min(attention.relative_position_block_size, max_length)
+            row["dense_MB"] = 4 * max_length ** 2 * head_size / 2 ** 20
+            row["skew_MB"] = 4 * args.batch_size * config.num_attention_heads * block_size * (
+                    block_size + max_length - 1) / 2 ** 20
+            results.append(row)
+    return pd.DataFrame(results)
+
+
+def _state_dict_mb(model: torch.nn.Module) -> float:
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 2 ** 20
+
+
+def bench_quantization(args):
+    """fp32 vs. dynamic int8 BertForTokenClassification forward pass (CPU) at several batch sizes and lengths."""
+    config = BertForTokenClassificationConfig(num_labels=9)
+    model = BertForTokenClassification(config).eval()
+    quantized_model = model.quantize_dynamic()
+    results = []
+    for batch_size in args.batch_sizes:
+        for max_length in args.max_lengths:
+            input_ids = torch.randint(config.vocab_size, (batch_size, max_length))
+            attention_mask = torch.ones_like(input_ids)
+            row = {"batch_size": batch_size, "max_length": max_length}
+            logits = {}
+            for name, m in [("fp32", model), ("int8", quantized_model)]:
+                with torch.inference_mode():
+                    logits[name] = m(input_ids, attention_mask=attention_mask).logits
+                    row[f"{name}_ms"] = timeit(lambda: m(input_ids, attention_mask=attention_mask),
+                                               repeat=args.repeat, warmup=1)
+                row[f"{name}_tokens/s"] = batch_size * max_length / row[f"{name}_ms"] * 1000
+            row["speedup"] = row["fp32_ms"] / row["int8_ms"]
+            row["max_logit_diff"] = (logits["fp32"] - logits["int8"]).abs().max().item()
+            row["argmax_agreement"] = (logits["fp32"].argmax(-1) == logits["int8"].argmax(-1)).float().mean().item()
+            results.append(row)
+    print(f"Model size: fp32 {_state_dict_mb(model):.1f}MB, int8 {_state_dict_mb(quantized_model):.1f}MB")
+    return pd.DataFrame(results)
+
+
+def bench_classifier_head(args):
+    """
+    Classifier head (dropout, classifier, loss, backward) on all positions vs. labeled positions only, for the
+    OntoNotes 73-label head with `max_length` padding. `labeled` is the fraction of labeled tokens per sequence.
+    """
+    config = BertForTokenClassificationConfig(num_labels=73, num_hidden_layers=1)
+    model = BertForTokenClassification(config).train()
+    results = []
+    for max_length in args.max_lengths:
+        for labeled in [0.1, 0.25, 0.5]:
+            sequence_output = torch.randn(args.batch_size, max_length, config.hidden_size, requires_grad=True)
+            labels = torch.randint(config.num_labels, (args.batch_size, max_length))
+            labels[:, int(labeled * max_length):] = -100
+            row = {"max_length": max_length, "labeled": labeled}
+            for labeled_only in [False, True]:
+                def step():
+                    if labeled_only:
+                        loss = model._classify_labeled_only(sequence_output, labels=labels)[1]
+                    else:
+                        logits = model.classifier(model.dropout(sequence_output))
+                        loss = torch.nn.functional.cross_entropy(logits.view(-1, config.num_labels), labels.view(-1))
+                    loss.backward()
+
+                row["labeled_only_ms" if labeled_only else "all_positions_ms"] = timeit(step, repeat=args.repeat)
+            row["speedup"] = row["all_positions_ms"] / row["labeled_only_ms"]
+            # Activations kept for backward: dropout output and logits
+            row["all_positions_MB"] = 4 * args.batch_size * max_length * (config.hidden_size + 73) / 2 ** 20
+            row["labeled_only_MB"] = row["all_positions_MB"] * labeled
+            results.append(row)
+    return pd.DataFrame(results)
+
+
+def bench_loss_per_position(args):
+    """
+    Loss part of `BertForNERTask.compute_loss`: mean cross-entropy plus a per-example loop of per-position losses
+    (previous implementation) vs. both from one fused cross-entropy call, forward and backward.
+    """
+    loss_pos_fn = CrossEntropyLossPerPosition()
+    results = []
+    for num_labels in [9, 73]:
+        for max_length in args.max_lengths:
+            logits = torch.randn(args.batch_size, max_length, num_labels, requires_grad=True)
+            labels = torch.randint(num_labels, (args.batch_size, max_length))
+            labels[:, max_length // 2:] = -100
+
+            def loop():
+                loss = torch.nn.functional.cross_entropy(logits.view(-1, num_labels), labels.view(-1))
+                loss_per_pos = torch.stack([loss_pos_fn.ce_loss(logits[i], labels[i])
+                                            for i in range(logits.shape[0])]).T
+                loss.backward()
+                return loss_per_pos.detach()
+
+            def fused():
+                loss, loss_per_pos = loss_pos_fn.loss_and_per_position(logits, labels)
+                loss.backward()
+                return loss_per_pos.detach()
+
+            row = {"num_labels": num_labels, "max_length": max_length,
+                   "max_abs_diff": (loop() - fused()).abs().max().item(),
+                   "loop_ms": timeit(loop, repeat=args.repeat), "fused_ms": timeit(fused, repeat=args.repeat)}
+            row["speedup"] = row["loop_ms"] / row["fused_ms"]
+            results.append(row)
+    return pd.DataFrame(results)
+
+
+def bench_position_shift_tta(args):
+    """
+    Forward pass with test-time position shifts: the batch repeated once per shift with `shifted_position_ids` and
+    classified in one stacked pass, as `NERPredictor.logits` does, vs. the unshifted pass.
+    """
+    config = BertForTokenClassificationConfig(num_labels=9)
+    model = BertForTokenClassification(config).eval()
+    results = []
+    for max_length in args.max_lengths:
+        input_ids = torch.randint(config.vocab_size, (args.batch_size, max_length // 2))
+        attention_mask = torch.ones_like(input_ids)
+        for num_shifts in [1, 2, 4, 8]:
+            shifts = shift_offsets(num_shifts, config.max_position_embeddings // 2)
+            inputs = {"input_ids": input_ids.repeat(num_shifts, 1),
+                      "attention_mask": attention_mask.repeat(num_shifts, 1),
+                      "position_ids": shifted_position_ids(attention_mask, shifts, config.max_position_embeddings)}
+            with torch.inference_mode():
+                ms = timeit(lambda: model(**inputs), repeat=args.repeat, warmup=1)
+            results.append({"max_length": max_length // 2, "num_shifts": num_shifts, "ms": ms,
+                            "sequences/s": args.batch_size / ms * 1000})
+    results = pd.DataFrame(results)
+    results["slowdown"] = results["ms"] / results.groupby("max_length")["ms"].transform("first")
+    return results
+
+
+def bench_viterbi(args):
+    """
+    Constrained IOBES Viterbi decoding (`viterbi_decode`) vs. argmax of the logits, with the forward pass that produced
+    them as reference, for the CoNLL-03 (17) and OntoNotes (73) label sets. Half of the positions are labeled.
+    """
+    results = []
+    for dataset in ["conll03", "ontonotes5"]:
+        labels = NERDatasetbuilder.get_labels(dataset)
+        scheme = label_scheme(dict(enumerate(labels)))
+        model = BertForTokenClassification(BertForTokenClassificationConfig(num_labels=len(labels))).eval()
+        for max_length in args.max_lengths:
+            input_ids = torch.randint(model.config.vocab_size, (args.batch_size, max_length))
+            with torch.inference_mode():
+                forward_ms = timeit(lambda: model(input_ids), repeat=args.repeat, warmup=1)
+                logits = model(input_ids).logits.numpy()
+            mask = torch.rand(args.batch_size, max_length).numpy() < 0.5
+            row = {"num_labels": len(labels), "max_length": max_length, "forward_ms": forward_ms,
+                   "argmax_ms": timeit(lambda: logits.argmax(-1), repeat=args.repeat),
+                   "viterbi_ms": timeit(lambda: viterbi_decode(logits, mask, scheme), repeat=args.repeat)}
+            row["viterbi/forward"] = row["viterbi_ms"] / row["forward_ms"]
+            results.append(row)
+    return pd.DataFrame(results)
+
+
+BENCHMARKS = {"attention": bench_attention, "relative_positions": bench_relative_positions,
+              "quantization": bench_quantization, "classifier_head": bench_classifier_head,
+              "loss_per_position": bench_loss_per_position, "position_shift_tta": bench_position_shift_tta,
+              "viterbi": bench_viterbi}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmark", type=str, nargs="+", default=list(BENCHMARKS.keys()),
+                        choices=list(BENCHMARKS.keys()), help="Benchmarks to run")
+    parser.add_argument("--max_lengths", type=int, nargs="+", default=[128, 256, 512],
+                        help="Sequence lengths to benchmark")
+    parser.add_argument("--batch_size", type=int, default=8, help="Batch size")
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 8, 64],
+                        help="Batch sizes of the end-to-end model benchmarks (quantization)")
+    parser.add_argument("--repeat", type=int, default=20, help="Number of timed repetitions")
+    parser.add_argument("--threads", type=int, default=None, help="Number of torch CPU threads")
+    args = parser.parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    for name in args.benchmark:
+        print(f"***** Benchmark: {name} *****")
+        print(BENCHMARKS[name](args).to_string(index=False, float_format="%.3f"))
+
+
+if __name__ == "__main__":
+    main()
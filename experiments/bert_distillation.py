@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# file: bert_distillation.py
+#
+from utils import set_random_seed
+
+set_random_seed(23456)
+import argparse
+import os
+import time
+from functools import partial
+
+import torch
+import torch.nn as nn
+import wandb
+from torch.utils.data import DataLoader
+from transformers import Trainer
+
+from dataset.ner_dataset import NERDataset
+from dataset.ner_processor import NERProcessor
+from experiments.bert_position_bias import BertForNERTask
+from method.batch_concat import concatenate_batch
+from method.distillation import SoftLabelCache, distillation_loss, teacher_logits
+from method.position_shift import random_shift
+from models.factory import build_student, load_model
+from utils import get_parser
+
+os.environ['WANDB_LOG_MODEL'] = "true"
+
+
+class BertForNERDistillation(BertForNERTask):
+    """
+    `BertForNERTask` training a smaller student (fewer layers or a smaller hidden size) on the fine-tuned teacher's
+    soft token labels, with the same concatenation/shift augmentations. The loss is
+    `distill_alpha * CE(labels) + (1 - distill_alpha) * KD(teacher)`.
+
+    With `soft_label_cache`, the teacher labels the training batches and their augmented views once (saved to disk,
+    see `SoftLabelCache`) and the student is trained on these views; otherwise the teacher runs on every batch.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(BertForNERDistillation, self).__init__(*args, **kwargs)
+        self.teacher.to(self.args.device)
+        self.soft_labels = None
+        if self.all_args.soft_label_cache is not None:
+            self.soft_labels = self.build_soft_labels(self.all_args.soft_label_cache)
+
+    def init_model(self, all_args: argparse.Namespace) -> nn.Module:
+        self.teacher = load_model(all_args.teacher, cache=False).eval()
+        for param in self.teacher.parameters():
+            param.requires_grad_(False)
+        student = build_student(all_args.teacher, num_layers=all_args.student_layers,
+                                hidden_size=all_args.student_hidden_size, fused_attention=all_args.fused_attention,
+                                classify_labeled_only=all_args.classify_labeled_only)
+        print(f"DEBUG INFO -> check student config \n {student.config}")
+        return student
+
+    def build_soft_labels(self, cache_dir: str) -> SoftLabelCache:
+        augmentations = {}
+        if self.concatenate:
+            augmentations["concatenate"] = partial(concatenate_batch, max_length=self.max_length)
+        elif self.position_shift:
+            augmentations["position_shift"] = partial(random_shift, max_length=self.max_length)
+        # Shuffled once, so concatenated views mix sentences as the training batches do
+        dataloader = DataLoader(self._remove_unused_columns(self.train_dataset, description="training"),
+                                batch_size=self._train_batch_size, collate_fn=self.data_collator, shuffle=True,
+                                generator=torch.Generator().manual_seed(self.args.seed))
+        metadata = {"teacher": self.all_args.teacher, "num_examples": len(self.train_dataset),
+                    "batch_size": self._train_batch_size, "max_length": self.max_length, "seed": self.args.seed}
+        return SoftLabelCache.build(self.teacher, dataloader, augmentations=augmentations, cache_dir=cache_dir,
+                                    metadata=metadata)
+
+    def get_train_dataloader(self) -> DataLoader:
+        if self.soft_labels is None:
+            return super().get_train_dataloader()
+        return DataLoader(self.soft_labels, batch_size=self._train_batch_size, shuffle=True,
+                          collate_fn=SoftLabelCache.collate, num_workers=self.args.dataloader_num_workers,
+                          pin_memory=self.args.dataloader_pin_memory)
+
+    def training_step(self, model: nn.Module, inputs):
+        if self.soft_labels is not None:
+            # The augmented views are already part of the cache
+            return Trainer.training_step(self, model, inputs)
+        return super().training_step(model, inputs)
+
+    def compute_loss(self, model, inputs, return_outputs=False):
+        soft_labels = inputs.pop("teacher_logits", None)
+        if not model.training:
+            return super().compute_loss(model, inputs, return_outputs=return_outputs)
+        if soft_labels is None:
+            soft_labels = teacher_logits(self.teacher, inputs)
+        loss, outputs = super().compute_loss(model, inputs, return_outputs=True)
+        kd_loss = distillation_loss(outputs["logits"], soft_labels, inputs["labels"],
+                                    temperature=self.all_args.distill_temperature)
+        loss = self.all_args.distill_alpha * loss + (1 - self.all_args.distill_alpha) * kd_loss
+        return (loss, outputs) if return_outputs else loss
+
+
+@torch.inference_mode()
+def cpu_latency(model: nn.Module, batch: dict, repeat: int = 5) -> float:
+    """Median CPU latency (ms) of the model's forward pass on a batch."""
+    model = model.eval()
+    inputs = {key: value.cpu() for key, value in batch.items() if key in ("input_ids", "attention_mask")}
+    times = []
+    for _ in range(repeat + 1):
+        start = time.perf_counter()
+        model(**inputs)
+        times.append((time.perf_counter() - start) * 1000)
+    return sorted(times[1:])[repeat // 2]
+
+
+def main():
+    parser = get_parser()
+    training_args, args = parser.parse_args_into_dataclasses()
+    os.makedirs(training_args.output_dir, exist_ok=True)
+    os.environ["WANDB_DIR"] = training_args.output_dir
+    experiment_name = f"{args.experiment}-{args.dataset}"
+    tags = [f"max_length={args.max_length}", f"seed={training_args.seed}",
+            f"student_layers={args.student_layers}", f"student_hidden_size={args.student_hidden_size}",
+            f"concatenate={args.concatenate}", f"position_shift={args.position_shift}"]
+    for i in range(args.nbruns):
+        config = vars(args)
+        wandb.init(project=experiment_name, name=f"run={i + 1}", tags=tags, config=config)
+        print(f"Run number:{i + 1}")
+
+        # Dataset
+        dataset = NERDataset(dataset=args.dataset, debugging=args.debugging)
+        processor = NERProcessor(pretrained_checkpoint=args.model, max_length=args.max_length,
+                                 kwargs=config)
+        train_dataset = dataset.dataset["train_"].map(processor.tokenize_and_align_labels,
+                                                      fn_kwargs={"concatenate": args.concatenate},
+                                                      batched=True)
+        eval_dataset = dataset.dataset["dev_"].map(processor.tokenize_and_align_labels, batched=True)
+
+        task_trainer = BertForNERDistillation(all_args=args, training_args=training_args, train=train_dataset,
+                                              eval=eval_dataset, dataset=dataset, processor=processor)
+        task_trainer.train()
+
+        for k in range(1, 11):
+            test_dataset = dataset.dataset["test_"].map(processor.tokenize_and_align_labels,
+                                                        fn_kwargs={"duplicate": True, "k": k},
+                                                        load_from_cache_file=False, batched=True)
+            task_trainer.test(test_dataset=test_dataset, metric_key_prefix=f"test_k={k}", k=k)
+
+        # Inference cost of the student with respect to the teacher
+        batch = next(iter(task_trainer.get_eval_dataloader(eval_dataset)))
+        teacher, student = task_trainer.teacher.cpu(), task_trainer.model.cpu()
+        cost = {"teacher_parameters": teacher.num_parameters(), "student_parameters": student.num_parameters(),
+                "teacher_cpu_ms": cpu_latency(teacher, batch), "student_cpu_ms": cpu_latency(student, batch)}
+        cost["cpu_speedup"] = cost["teacher_cpu_ms"] / cost["student_cpu_ms"]
+        print(cost)
+        wandb.log(cost)
+
+        output_dir = os.path.join(task_trainer.args.output_dir, "student")
+        task_trainer.save_model(output_dir)
+        print(f"Saved student to {output_dir}")
+
+        wandb.finish()
+        task_trainer = None
+        import gc
+        gc.collect()
+        with torch.no_grad():
+            torch.cuda.empty_cache()
+
+
+if __name__ == "__main__":
+    main()
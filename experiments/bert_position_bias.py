@@ -6,12 +6,10 @@ from utils import set_random_seed
 
 set_random_seed(23456)
 from plot_utils.plot import plot_loss_dist
-import pandas as pd
 import argparse
 from typing import Dict, Union, Any, Optional, List
 import os
-from models.config import BertForTokenClassificationConfig
-from models.bert_ner import BertForTokenClassification
+from models.factory import load_config, load_model
 from utils import get_parser
 from dataset.ner_dataset import NERDataset
 from dataset.ner_processor import NERProcessor
@@ -20,9 +18,9 @@ from dataset.pos_processor import POSProcessor
 from dataset.collate_fn import DataCollator
 import torch
 import torch.nn as nn
-from metrics.pos_loss import CrossEntropyLossPerPosition, padded_stack
+from metrics.pos_loss import CrossEntropyLossPerPosition, PositionLossStatistics
 from metrics.ner_f1 import compute_ner_pos_f1, ner_span_metrics
-from transformers import Trainer, TrainingArguments, is_apex_available
+from transformers import Trainer, TrainerCallback, TrainingArguments, is_apex_available
 from pathlib import Path
 from torch.utils.data import DataLoader
 from datasets import Dataset
@@ -53,6 +51,16 @@ os.environ['WANDB_LOG_MODEL'] = "true"
 os.environ['WANDB_DISABLED'] = "true"
 
 
+class ResetPositionLossesCallback(TrainerCallback):
+    """Start the training loss statistics per position from scratch at every epoch."""
+
+    def __init__(self, loss_statistics: PositionLossStatistics):
+        self.loss_statistics = loss_statistics
+
+    def on_epoch_begin(self, args, state, control, **kwargs):
+        self.loss_statistics.reset()
+
+
 class BertForNERTask(Trainer):
     def __init__(self, training_args: TrainingArguments, all_args: argparse.Namespace,
                  dataset: Union[NERDataset, POSDataset],
@@ -75,32 +83,51 @@ class BertForNERTask(Trainer):
                                        padding=self.all_args.padding)
 
         # Model loading
-        bert_config = BertForTokenClassificationConfig.from_pretrained(self.model_path,
-                                                                       id2label=self.dataset.id2label,
-                                                                       label2id=self.dataset.label2id,
-                                                                       position_embedding_type=self.pos_emb_type)
-        print(f"DEBUG INFO -> check bert_config \n {bert_config}")
-        model = BertForTokenClassification.from_pretrained(self.model_path, config=bert_config)
+        model = self.init_model(all_args)
 
         super(BertForNERTask, self).__init__(model, args=training_args, train_dataset=train,
                                              eval_dataset=eval,
                                              data_collator=self.collate_fn, tokenizer=processor.tokenizer,
-                                             compute_metrics=lambda p: compute_ner_pos_f1(p=p,
-                                                                                          label_list=self.dataset.labels),
+                                             compute_metrics=lambda p: compute_ner_pos_f1(
+                                                 p=p, label_list=self.dataset.labels,
+                                                 constrained=self.all_args.constrained_decoding,
+                                                 tokenizer=self.tokenizer),
                                              **kwargs)
         self.loss_pos_fn = CrossEntropyLossPerPosition()
-        self.losses = {"train": [], "dev": []}
+        # Detached running statistics of the loss per position (no raw loss is kept)
+        self.loss_statistics = {"train": PositionLossStatistics(max_length=self.max_length, device=self.args.device),
+                                "dev": PositionLossStatistics(max_length=self.max_length, device=self.args.device)}
+        self.add_callback(ResetPositionLossesCallback(self.loss_statistics["train"]))
         self.is_in_eval = False
 
+    def init_model(self, all_args: argparse.Namespace) -> nn.Module:
+        """Model to fine-tune, called before the Trainer is initialized."""
+        # The config/model classes (BERT, ELECTRA, BLOOM) are resolved from the checkpoint's model type
+        bert_config = load_config(
+            self.model_path, id2label=self.dataset.id2label, label2id=self.dataset.label2id,
+            position_embedding_type=self.pos_emb_type, fused_attention=all_args.fused_attention,
+            classify_labeled_only=all_args.classify_labeled_only, attention_chunk_size=all_args.attention_chunk_size,
+            position_extension=all_args.position_extension,
+            extended_max_position_embeddings=all_args.extended_max_position_embeddings)
+        print(f"DEBUG INFO -> check bert_config \n {bert_config}")
+        return load_model(self.model_path, config=bert_config, low_cpu_mem_usage=all_args.low_cpu_mem_usage,
+                          cache=True)
+
     def compute_loss(self, model, inputs, return_outputs=False):
-        loss, outputs = super().compute_loss(model, inputs, return_outputs=True)
         labels = inputs["labels"]
-        logits = outputs["logits"]
-        loss_per_pos = self.loss_pos_fn(logits, labels)
-        if self.is_in_train and not self.is_in_eval:
-            self.losses["train"].append(loss_per_pos)
+        if self.label_smoother is None and not getattr(self.model, "classify_labeled_only", False):
+            # The model loss and the loss per position come from a single cross-entropy call on the logits
+            outputs = model(**{k: v for k, v in inputs.items() if k != "labels"})
+            loss, loss_per_pos = self.loss_pos_fn.loss_and_per_position(outputs["logits"], labels)
         else:
-            self.losses["dev"].append(loss_per_pos)
+            loss, outputs = super().compute_loss(model, inputs, return_outputs=True)
+            if outputs["logits"].dim() == 2:
+                # Logits of the labeled tokens only (`classify_labeled_only` in training)
+                loss_per_pos = self.loss_pos_fn.packed(outputs["logits"], labels)
+            else:
+                loss_per_pos = self.loss_pos_fn(outputs["logits"], labels)
+        split = "train" if self.is_in_train and not self.is_in_eval else "dev"
+        self.loss_statistics[split].update(loss_per_pos.T, labels != self.loss_pos_fn.ce_loss.ignore_index)
         return (loss, outputs) if return_outputs else loss
 
     def training_step(self, model: nn.Module, inputs: Dict[str, Union[torch.Tensor, Any]]) -> torch.Tensor:
@@ -143,6 +170,7 @@ class BertForNERTask(Trainer):
             metric_key_prefix: str = "eval",
     ) -> Dict[str, float]:
         self.is_in_eval = True
+        self.loss_statistics["dev"].reset()
         out = super().evaluate(eval_dataset=eval_dataset, ignore_keys=ignore_keys,
                                metric_key_prefix=metric_key_prefix)
         self.is_in_eval = False
@@ -172,33 +200,27 @@ class BertForNERTask(Trainer):
                                                           all_labels=p.label_ids,
                                                           all_inputs=p.inputs,
                                                           label_list=self.dataset.labels,
-                                                          k=k)
+                                                          k=k,
+                                                          constrained=self.all_args.constrained_decoding,
+                                                          tokenizer=self.tokenizer)
         return super().evaluate(eval_dataset=test_dataset, ignore_keys=ignore_keys, metric_key_prefix=metric_key_prefix)
 
-    def log_pos_losses(self):
-        ## Logging Loss per pos
-        train_losses = padded_stack(self.losses["train"]).view(-1,
-                                                               self.max_length).detach().cpu().numpy()
-
-        data = []
-        for k in range(train_losses.shape[1]):
-            data += [(loss, k) for loss in train_losses[:, k].tolist() if loss != 0]
-        train_ = pd.DataFrame(data=data, columns=["loss", "position"])
-        # table = wandb.Table(dataframe=train_) "train_loss/pos": table,
-        f = plot_loss_dist(train_)
-        wandb.log({"train_loss_dist": wandb.Image(f)})
-        plt.close(f)
-        if self.losses["dev"]:
-            dev_losses = padded_stack(self.losses["dev"]).view(-1,
-                                                               self.max_length).detach().cpu().numpy()
-            data = []
-            for k in range(dev_losses.shape[1]):
-                data += [(loss, k) for loss in train_losses[:, k].tolist() if loss != 0]
-            eval_ = pd.DataFrame(data=data, columns=["loss", "position"])
-            f = plot_loss_dist(eval_)
-            # table = wandb.Table(dataframe=eval_) "eval_loss/pos": table,
-            wandb.log({"eval_loss_dist": wandb.Image(f)})
+    def log_pos_losses(self, export_format: Optional[str] = "parquet"):
+        """
+        Plot the loss distribution per position of the current epoch (train and dev) to wandb, rendered from the
+        binned losses. With `export_format` ("parquet" or "csv") the histogram and summary tables are also written to
+        `<output_dir>/pos_losses` and synced to wandb for offline plotting.
+        """
+        export_dir = os.path.join(self.args.output_dir, "pos_losses")
+        for split, key in [("train", "train_loss_dist"), ("dev", "eval_loss_dist")]:
+            if not len(self.loss_statistics[split]):
+                continue
+            f = plot_loss_dist(self.loss_statistics[split].histogram_frame())
+            wandb.log({key: wandb.Image(f)})
             plt.close(f)
+            if export_format is not None:
+                for path in self.loss_statistics[split].export(export_dir, prefix=split, format=export_format).values():
+                    wandb.save(path, base_path=self.args.output_dir, policy="now")
 
 
 def main():
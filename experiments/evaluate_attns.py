@@ -8,14 +8,17 @@ set_random_seed(23456)
 import argparse
 from typing import Dict, Optional, List
 import os
-from models.config import BertForTokenClassificationConfig
-from models.bert_ner import BertForTokenClassification
+from models.factory import load_config, load_model
 from utils import get_parser
 from dataset.ner_dataset import NERDataset
 from dataset.ner_processor import NERProcessor
 from dataset.collate_fn import DataCollator
 import torch
 from metrics.ner_f1 import ner_span_metrics, compute_ner_pos_f1
+from metrics.attention_stats import AttentionStatistics
+from metrics.attention_store import AttentionStoreWriter
+from metrics.position_decoding import PositionDecodingStatistics
+import numpy as np
 from transformers import Trainer, TrainingArguments
 from datasets import Dataset
 import wandb
@@ -55,12 +58,18 @@ class BertForNEREval(Trainer):
                                        padding=self.all_args.padding)
 
         # Model loading
-        bert_config = BertForTokenClassificationConfig.from_pretrained(self.model_path,
-                                                                       watch_attentions=self.watch_attentions,
-                                                                       output_attentions=self.watch_attentions,
-                                                                       output_hidden_states=self.watch_attentions)
+        bert_config = load_config(self.model_path,
+                                  watch_attentions=self.watch_attentions,
+                                  attention_capture=all_args.attention_capture,
+                                  attention_topk=all_args.attention_topk,
+                                  output_attentions=self.watch_attentions,
+                                  output_hidden_states=self.watch_attentions,
+                                  attention_chunk_size=all_args.attention_chunk_size,
+                                  position_extension=all_args.position_extension,
+                                  extended_max_position_embeddings=all_args.extended_max_position_embeddings)
         print(f"DEBUG INFO -> check bert_config \n {bert_config}")
-        model = BertForTokenClassification.from_pretrained(self.model_path, config=bert_config)
+        model = load_model(self.model_path, config=bert_config, low_cpu_mem_usage=all_args.low_cpu_mem_usage,
+                           cache=True)
 
         super(BertForNEREval, self).__init__(model, args=training_args,
                                              data_collator=self.collate_fn, tokenizer=processor.tokenizer,
@@ -76,13 +85,17 @@ class BertForNEREval(Trainer):
              ) -> Dict[str, float]:
         if k is None or duplicate_mode == "shift":
             self.compute_metrics = lambda p: compute_ner_pos_f1(p=p,
-                                                                label_list=self.dataset.labels)
+                                                                label_list=self.dataset.labels,
+                                                                constrained=self.all_args.constrained_decoding,
+                                                                tokenizer=self.tokenizer)
         else:
             self.compute_metrics = lambda p: ner_span_metrics(all_preds_scores=p.predictions,
                                                               all_labels=p.label_ids,
                                                               all_inputs=p.inputs,
                                                               label_list=self.dataset.labels,
-                                                              k=k)
+                                                              k=k,
+                                                              constrained=self.all_args.constrained_decoding,
+                                                              tokenizer=self.tokenizer)
         return super().evaluate(eval_dataset=test_dataset, ignore_keys=ignore_keys, metric_key_prefix=metric_key_prefix)
 
     def eval_attn(self,
@@ -103,9 +116,23 @@ class BertForNEREval(Trainer):
         logger.info(f"  Num examples = {self.num_examples(dataloader)}")
         batch_size = self.args.eval_batch_size
         logger.info(f"  Batch size = {batch_size}")
+        tempdir = tempfile.TemporaryDirectory()
+        # Attention matrices are streamed to memory-mapped arrays instead of being kept in RAM
+        store_dir = os.path.join(tempdir.name, "attention_store")
+        attention_store = None
+        if self.all_args.attention_capture != "none":
+            lengths = [sum(mask) - 2 for mask in test_dataset["attention_mask"]]  # without [CLS] and [SEP]
+            attention_store = AttentionStoreWriter(store_dir, lengths=lengths,
+                                                   num_layers=self.model.config.num_hidden_layers,
+                                                   num_heads=self.model.config.num_attention_heads,
+                                                   capture=self.all_args.attention_capture,
+                                                   topk=self.all_args.attention_topk)
+        attention_statistics = None
+        if self.all_args.attention_statistics:
+            attention_statistics = AttentionStatistics(num_layers=self.model.config.num_hidden_layers,
+                                                       num_heads=self.model.config.num_attention_heads,
+                                                       max_length=self.max_length, device=self.args.device)
         sequence_info = []
-        attention_scores = []
-        raw_attention_scores = []
         positions_cosine = []
         words_cosine = []
         for step, inputs in enumerate(dataloader):
@@ -117,27 +144,34 @@ class BertForNEREval(Trainer):
             fwd_inputs = {k: v for k, v in inputs.items() if k not in ignored_inputs}
             fwd_inputs = self._prepare_inputs(fwd_inputs)
             with torch.no_grad():
-                outputs = self.model.dissected_feed_forward(**fwd_inputs, return_dict=False)
-            cos_results = outputs[-2]
-            attn_dict = outputs[-1]
-            sequence_info.append({"id": inputs["id"][0], "tokens": inputs["original_tokens"][0],
-                            "labels": [self.dataset.id2label[l] for l in inputs["original_tags"][0]]})
-            attention_scores.append(attn_dict["attention_probs"])
-            raw_attention_scores.append(attn_dict["attention_scores"])
-            positions_cosine.append(cos_results["positions_cosine"])
-            words_cosine.append(cos_results["words_cosine"])
-        tempdir = tempfile.TemporaryDirectory()
+                outputs = self.model.dissected_feed_forward(**fwd_inputs, return_dict=False,
+                                                            attention_statistics=attention_statistics)
+            # One cosine/attention entry per sequence of the batch
+            # "shift" mode does not duplicate the tokens, so there are no original tokens/tags
+            tokens = inputs.get("original_tokens", inputs["tokens"])
+            tags = inputs.get("original_tags", inputs["ner_tags"])
+            for b, (cos_results, attn_dict) in enumerate(zip(outputs[-2], outputs[-1])):
+                sequence_info.append({"id": inputs["id"][b], "tokens": tokens[b],
+                                      "labels": [self.dataset.id2label[l] for l in tags[b]]})
+                if attention_store is not None:
+                    attention_store.append(attn_dict)
+                positions_cosine.append(cos_results["positions_cosine"])
+                words_cosine.append(cos_results["words_cosine"])
         seq_file = os.path.join(tempdir.name, "seq_info.pt")
         torch.save(sequence_info, seq_file)
         wandb.save(seq_file, policy="now")
 
-        attn_scores = os.path.join(tempdir.name, "attention_scores.pt")
-        torch.save(attention_scores, attn_scores)
-        wandb.save(attn_scores, policy="now")
+        if attention_store is not None:
+            attention_store.close()
+            for file in attention_store.files():
+                wandb.save(os.path.join(store_dir, file), base_path=tempdir.name, policy="now")
 
-        attn_raw = os.path.join(tempdir.name, "attention_raw.pt")
-        torch.save(raw_attention_scores, attn_raw)
-        wandb.save(attn_raw, policy="now")
+        if attention_statistics is not None:
+            for name, summary in [("attention_stats.csv", attention_statistics.summary()),
+                                  ("attention_stats_copy.csv", attention_statistics.copy_summary())]:
+                summary_file = os.path.join(tempdir.name, name)
+                summary.to_csv(summary_file, index=False)
+                wandb.save(summary_file, policy="now")
 
         position_cosine = os.path.join(tempdir.name, "pos_cos.pt")
         torch.save(positions_cosine, position_cosine)
@@ -148,6 +182,45 @@ class BertForNEREval(Trainer):
         wandb.save(word_cosine, policy="now")
         return tempdir
 
+    def eval_position_decoding(self,
+                               test_dataset: Optional[Dataset],
+                               ):
+        """
+        Decode the position of every token from the hidden states of each layer against the whole position embedding
+        table, in batches of the regular forward pass. Saves the per layer/position summary and the mean cosine matrix.
+        """
+        position_embedding_type = getattr(self.model.config, "position_embedding_type", None)
+        if position_embedding_type != "absolute":
+            logger.warning(f"Position decoding needs absolute position embeddings, got {position_embedding_type}")
+            return None
+        dataloader = self.get_eval_dataloader(test_dataset)
+        logger.info(f"***** Running Position Decoding *****")
+        logger.info(f"  Num examples = {self.num_examples(dataloader)}")
+        position_embeddings = self.model.base_model.embeddings.position_embeddings
+        if hasattr(self.model.base_model, "embeddings_project"):
+            # ELECTRA with embedding_size != hidden_size: the hidden states live in the projected space
+            with torch.no_grad():
+                position_embeddings = self.model.base_model.embeddings_project(position_embeddings.weight)
+        position_decoding = PositionDecodingStatistics(position_embeddings,
+                                                       num_layers=self.model.config.num_hidden_layers + 1,
+                                                       max_length=self.max_length, device=self.args.device)
+        self.model.eval()
+        for inputs in dataloader:
+            inputs = self._prepare_inputs(inputs)
+            inputs.pop("labels", None)
+            with torch.no_grad():
+                outputs = self.model(**inputs, output_hidden_states=True, return_dict=True)
+            position_decoding.update(outputs.hidden_states, inputs["attention_mask"], inputs.get("position_ids"))
+
+        tempdir = tempfile.TemporaryDirectory()
+        summary_file = os.path.join(tempdir.name, "position_decoding.csv")
+        position_decoding.summary().to_csv(summary_file, index=False)
+        wandb.save(summary_file, policy="now")
+        matrix_file = os.path.join(tempdir.name, "position_decoding_cosine.npy")
+        np.save(matrix_file, position_decoding.cosine_matrix().astype(np.float32))
+        wandb.save(matrix_file, policy="now")
+        return tempdir
+
 
 def main():
     parser = get_parser(HF=False)
@@ -180,7 +253,7 @@ def main():
         model_path = model_artifact.download()
         task_eval = BertForNEREval(model_path, all_args=args, dataset=dataset, processor=processor)
 
-        tempdir = None
+        tempdirs = []
         if args.duplicate:
             for k in range(1, 11):
                 test_dataset = dataset.dataset["test_"].map(processor.tokenize_and_align_labels,
@@ -189,16 +262,22 @@ def main():
                                                             load_from_cache_file=False, batched=True)
 
                 task_eval.test(test_dataset=test_dataset, metric_key_prefix=f"test_k={k}", k=k, duplicate_mode=args.duplicate_mode)
-        elif args.watch_attentions:
+        elif args.watch_attentions or args.position_decoding:
+            # Copies are delimited by the processor's `copy_spans`, so every duplication mode is analysed the same way
             test_dataset = dataset.dataset["test_"].map(processor.tokenize_and_align_labels,
-                                                        fn_kwargs={"duplicate": True, "k": 10},
+                                                        fn_kwargs={"duplicate": True, "k": 10,
+                                                                   "duplicate_mode": args.duplicate_mode},
                                                         load_from_cache_file=False,
                                                         batched=True)
-            tempdir = task_eval.eval_attn(test_dataset=test_dataset)
+            if args.watch_attentions:
+                tempdirs.append(task_eval.eval_attn(test_dataset=test_dataset))
+            if args.position_decoding:
+                tempdirs.append(task_eval.eval_position_decoding(test_dataset=test_dataset))
 
         wandb.finish()
-        if tempdir is not None:
-            tempdir.cleanup()
+        for tempdir in tempdirs:
+            if tempdir is not None:
+                tempdir.cleanup()
         task_eval = None
         import gc
         gc.collect()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# file: export_model.py
+#
+# Export a (fine-tuned) BertForTokenClassification checkpoint to TorchScript and/or ONNX, then check that the
+# exported runner reproduces the PyTorch logits for several batch sizes, sequence lengths and shifted position ids,
+# with dense and chunked self-attention.
+from utils import set_random_seed
+
+set_random_seed(23456)
+import os
+
+import pandas as pd
+import torch
+
+from experiments.benchmark import timeit
+from models.bert_ner import BertForTokenClassification
+from models.config import BertForTokenClassificationConfig
+from models.export import export_model, ExportedTokenClassifier, default_inputs
+from utils import get_parser
+
+
+def verify_export(model: BertForTokenClassification, runner: ExportedTokenClassifier, max_length: int,
+                  repeat: int = 5) -> pd.DataFrame:
+    """Max absolute logit difference and latency of the exported runner vs. the PyTorch model."""
+    results = []
+    for batch_size, seq_length in [(1, min(16, max_length)), (4, min(64, max_length)), (8, max_length)]:
+        input_ids = torch.randint(model.config.vocab_size, (batch_size, seq_length))
+        attention_mask = torch.ones_like(input_ids)
+        attention_mask[0, seq_length // 2:] = 0  # one padded sequence
+        for shift in [0, max(0, model.config.max_position_embeddings - seq_length)]:
+            inputs = default_inputs(input_ids, attention_mask)
+            position_ids = inputs[-1] + shift
+            with torch.inference_mode():
+                expected = model(input_ids, attention_mask=attention_mask, position_ids=position_ids).logits.numpy()
+                torch_ms = timeit(lambda: model(input_ids, attention_mask=attention_mask, position_ids=position_ids),
+                                  repeat=repeat, warmup=1)
+            logits = runner(input_ids, attention_mask, position_ids=position_ids)
+            exported_ms = timeit(lambda: runner(input_ids, attention_mask, position_ids=position_ids),
+                                 repeat=repeat, warmup=1)
+            results.append({"backend": runner.backend, "batch_size": batch_size, "seq_length": seq_length,
+                            "position_shift": shift, "max_abs_diff": float(abs(logits - expected).max()),
+                            "torch_ms": torch_ms, "exported_ms": exported_ms})
+    return pd.DataFrame(results)
+
+
+def main():
+    parser = get_parser(HF=False)
+    args = parser.parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    results = []
+    # The chunked self-attention loops over the sequence in Python: its export must not depend on the traced length
+    for chunk_size in [None, args.attention_chunk_size or 8]:
+        bert_config = BertForTokenClassificationConfig.from_pretrained(args.model, fused_attention=args.fused_attention,
+                                                                       attention_chunk_size=chunk_size)
+        model = BertForTokenClassification.from_pretrained(args.model, config=bert_config).eval()
+        export_dir = args.export_dir if chunk_size is None else os.path.join(args.export_dir, f"chunk{chunk_size}")
+        paths = export_model(model, export_dir, formats=args.export_formats, opset=args.onnx_opset)
+        for export_format, path in paths.items():
+            print(f"Exported {export_format} model to {path}")
+            verified = verify_export(model, ExportedTokenClassifier(path, num_threads=args.threads),
+                                     max_length=min(args.max_length, bert_config.max_position_embeddings))
+            verified.insert(1, "attention_chunk_size", chunk_size)
+            results.append(verified)
+    results = pd.concat(results, ignore_index=True)
+    print(results.to_string(index=False, float_format="%.6f"))
+    max_diff = results["max_abs_diff"].max()
+    if max_diff > args.export_atol:
+        raise ValueError(f"Exported logits differ from PyTorch by {max_diff:.2e} > {args.export_atol:.2e}")
+
+
+if __name__ == "__main__":
+    main()
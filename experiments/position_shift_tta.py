@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# file: position_shift_tta.py
+#
+from utils import set_random_seed
+
+set_random_seed(23456)
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+import wandb
+
+from dataset.ner_dataset import NERDataset
+from dataset.ner_processor import NERProcessor, duplicate_seq
+from inference.predictor import NERPredictor
+from metrics.ner_f1 import metric
+from models.factory import load_model
+from utils import get_parser
+
+os.environ['WANDB_LOG_MODEL'] = "true"
+
+
+def evaluate_shifts(predictor: NERPredictor, words, tags, label_list, k: int) -> dict:
+    """Overall span F1 and throughput of the predictor on pre-split sentences with gold tag ids."""
+    features = predictor.tokenize(words)
+    start = time.perf_counter()
+    labels, _ = predictor.predict_word_labels(features)
+    seconds = time.perf_counter() - start
+    predictions = [[predictor.id2label[int(label)] for label in sentence_labels] for sentence_labels in labels]
+    # Separators between copies (`duplicate_mode="sep"`) are tagged -100 and count as outside tokens
+    references = [[label_list[tag] if tag != -100 else "O" for tag in sentence_tags] for sentence_tags in tags]
+    results = metric.compute(predictions=predictions, references=references)
+    return {"k": k, "num_shifts": len(predictor.position_shifts), "f1": results["overall_f1"],
+            "precision": results["overall_precision"], "recall": results["overall_recall"],
+            "sentences_per_second": len(words) / seconds}
+
+
+def main():
+    parser = get_parser(HF=False)
+    args = parser.parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    experiment_name = f"{args.experiment}-{args.dataset}"
+    entity = args.wandb_user
+    os.environ["WANDB_DIR"] = args.wandb_dir
+    api = wandb.Api()
+    experiment_ref = f"bert_position_bias_no_cv-{args.dataset}"
+    runs = api.runs(entity + "/" + experiment_ref)
+    tags = [f"max_length={args.max_length}", f"pos_emb_type={args.position_embedding_type}",
+            f"tta_shifts={args.tta_shifts}", f"max_position_shift={args.max_position_shift}"]
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    for run in runs:
+        config = vars(args)
+        tta_run = wandb.init(project=experiment_name, name=run.name, tags=tags, config=config)
+        print(f"Run Name:{run.name}")
+
+        # Dataset
+        dataset = NERDataset(dataset=args.dataset, debugging=args.debugging)
+        test_dataset = dataset.dataset["test_"][:]
+
+        # Download the fine-tuned model
+        run_path = "/".join(run.path[:-1])
+        model_artifact = tta_run.use_artifact(f"{run_path}/model-{run.id}:latest", type="model")
+        model_path = model_artifact.download()
+        model = load_model(model_path, cache=False).eval()
+        processor = NERProcessor(pretrained_checkpoint=model_path, max_length=args.max_length, kwargs={})
+
+        results = []
+        for k in (range(1, 11) if args.duplicate else [1]):
+            duplicated = duplicate_seq(test_dataset, k=k, mode=args.duplicate_mode)
+            for num_shifts in args.tta_shifts:
+                predictor = NERPredictor(model, processor, batch_size=args.batch_size, device=device,
+                                         stride=args.window_stride, position_shifts=num_shifts,
+                                         max_position_shift=args.max_position_shift,
+                                         constrained_decoding=args.constrained_decoding)
+                row = evaluate_shifts(predictor, duplicated["tokens"], duplicated["ner_tags"], dataset.labels, k)
+                print(row)
+                results.append(row)
+        results = pd.DataFrame(results)
+        # F1 gain and throughput cost with respect to the first number of shifts (a single forward pass by default)
+        baseline = results.groupby("k")[["f1", "sentences_per_second"]].transform("first")
+        results["f1_gain"] = results["f1"] - baseline["f1"]
+        results["slowdown"] = baseline["sentences_per_second"] / results["sentences_per_second"]
+        print(results.to_string(float_format="%.4f"))
+        wandb.log({"tta_results": wandb.Table(dataframe=results),
+                   "max_f1_gain": results["f1_gain"].max(),
+                   "best_num_shifts": int(results.loc[np.argmax(results["f1"].values), "num_shifts"])})
+
+        wandb.finish()
+
+
+if __name__ == "__main__":
+    main()
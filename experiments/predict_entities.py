@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# file: predict_entities.py
+#
+import json
+
+import numpy as np
+import torch
+
+from inference.predictor import NERPredictor
+from utils import get_parser
+
+
+def main():
+    parser = get_parser(HF=False)
+    args = parser.parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    with open(args.predict_file) as f:
+        texts = [line.rstrip("\n") for line in f]
+
+    position_weights = np.load(args.position_weights) if args.position_weights is not None else None
+    predictor = NERPredictor.from_pretrained(args.model, max_length=args.max_length, batch_size=args.batch_size,
+                                             device="cuda" if torch.cuda.is_available() else "cpu",
+                                             stride=args.window_stride, position_weights=position_weights,
+                                             position_shifts=args.position_shifts,
+                                             max_position_shift=args.max_position_shift,
+                                             constrained_decoding=args.constrained_decoding)
+    entities = predictor.predict_entities(texts)
+    with open(args.predictions_file, "w") as f:
+        for text, text_entities in zip(texts, entities):
+            f.write(json.dumps({"text": text, "entities": text_entities}) + "\n")
+
+    throughput = predictor.throughput
+    print(f"{throughput['sentences']} sentences ({throughput['tokens']} tokens) in {throughput['seconds']:.2f}s: "
+          f"{throughput['sentences_per_second']:.1f} sentences/s, {throughput['tokens_per_second']:.1f} tokens/s")
+    print(f"Saved predictions to {args.predictions_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# file: prune_heads.py
+#
+from utils import set_random_seed
+
+set_random_seed(23456)
+import os
+import tempfile
+import time
+
+import pandas as pd
+import torch
+import wandb
+from transformers import Trainer, TrainingArguments
+
+from dataset.collate_fn import DataCollator
+from dataset.ner_dataset import NERDataset
+from dataset.ner_processor import NERProcessor
+from metrics.head_importance import head_importance, heads_to_prune, importance_frame
+from metrics.ner_f1 import ner_span_metrics
+from models.factory import load_model
+from utils import get_parser
+
+os.environ['WANDB_LOG_MODEL'] = "true"
+
+
+def cpu_trainer(model, dataset: NERDataset, processor: NERProcessor, args, output_dir: str, k: int = 1) -> Trainer:
+    """Trainer evaluating on CPU with the k-copy span metrics of `ner_span_metrics`."""
+    training_args = TrainingArguments(output_dir, per_device_eval_batch_size=args.batch_size,
+                                      include_inputs_for_metrics=True, no_cuda=True, report_to=[])
+    return Trainer(model, args=training_args,
+                   data_collator=DataCollator(tokenizer=processor.tokenizer, max_length=args.max_length,
+                                              padding=args.padding),
+                   tokenizer=processor.tokenizer,
+                   compute_metrics=lambda p: ner_span_metrics(all_preds_scores=p.predictions, all_labels=p.label_ids,
+                                                              all_inputs=p.inputs, label_list=dataset.labels, k=k,
+                                                              constrained=args.constrained_decoding,
+                                                              tokenizer=processor.tokenizer))
+
+
+def evaluate_per_k(model, dataset: NERDataset, processor: NERProcessor, test_datasets: dict, args,
+                   name: str) -> pd.DataFrame:
+    """Overall F1/precision/recall and CPU throughput of the model on the test set duplicated k times."""
+    rows = []
+    with tempfile.TemporaryDirectory() as output_dir:
+        for k, test_dataset in test_datasets.items():
+            trainer = cpu_trainer(model, dataset, processor, args, output_dir, k=k)
+            metrics = trainer.evaluate(eval_dataset=test_dataset, metric_key_prefix=f"test_{name}")
+            rows.append({"model": name, "k": k, "f1": metrics[f"test_{name}_overall_f1"],
+                         "precision": metrics[f"test_{name}_overall_precision"],
+                         "recall": metrics[f"test_{name}_overall_recall"],
+                         "samples_per_second": metrics[f"test_{name}_samples_per_second"]})
+    return pd.DataFrame(rows)
+
+
+def main():
+    parser = get_parser(HF=False)
+    args = parser.parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    experiment_name = f"{args.experiment}-{args.dataset}"
+    entity = args.wandb_user
+    os.environ["WANDB_DIR"] = args.wandb_dir
+    api = wandb.Api()
+    experiment_ref = f"bert_position_bias_no_cv-{args.dataset}"
+    runs = api.runs(entity + "/" + experiment_ref)
+    tags = [f"max_length={args.max_length}", f"pos_emb_type={args.position_embedding_type}",
+            f"head_importance={args.head_importance}", f"prune_fraction={args.prune_fraction}"]
+    for run in runs:
+        config = vars(args)
+        prune_run = wandb.init(project=experiment_name, name=run.name, tags=tags, config=config)
+        print(f"Run Name:{run.name}")
+
+        # Dataset
+        dataset = NERDataset(dataset=args.dataset, debugging=args.debugging)
+        processor = NERProcessor(pretrained_checkpoint=args.model, max_length=args.max_length,
+                                 kwargs=config)
+        dev_dataset = dataset.dataset["dev_"].map(processor.tokenize_and_align_labels, batched=True)
+        test_datasets = {k: dataset.dataset["test_"].map(processor.tokenize_and_align_labels,
+                                                         fn_kwargs={"duplicate": True, "k": k,
+                                                                    "duplicate_mode": args.duplicate_mode},
+                                                         load_from_cache_file=False, batched=True)
+                         for k in range(1, 11)}
+
+        # Download the fine-tuned model
+        run_path = "/".join(run.path[:-1])
+        model_artifact = prune_run.use_artifact(f"{run_path}/model-{run.id}:latest", type="model")
+        model_path = model_artifact.download()
+        model = load_model(model_path, cache=False).eval()
+
+        # Head importance on the dev set
+        with tempfile.TemporaryDirectory() as output_dir:
+            dev_dataloader = cpu_trainer(model, dataset, processor, args, output_dir).get_eval_dataloader(dev_dataset)
+            start = time.perf_counter()
+            importance = head_importance(model, dev_dataloader, method=args.head_importance,
+                                         device=torch.device("cpu"))
+            print(f"Head importance ({args.head_importance}) computed in {time.perf_counter() - start:.1f}s")
+        pruned_heads = heads_to_prune(importance, fraction=args.prune_fraction)
+        importance_table = importance_frame(importance, pruned_heads)
+        print(f"Pruned heads per layer: {pruned_heads}")
+
+        results = evaluate_per_k(model, dataset, processor, test_datasets, args, name="full")
+        model.prune_heads(pruned_heads)
+        results = pd.concat([results, evaluate_per_k(model, dataset, processor, test_datasets, args, name="pruned")])
+        parity = results.pivot(index="k", columns="model", values="f1")
+        parity["f1_drop"] = parity["full"] - parity["pruned"]
+        print(results.to_string(float_format="%.4f"))
+        wandb.log({"head_importance": wandb.Table(dataframe=importance_table),
+                   "pruning_results": wandb.Table(dataframe=results),
+                   "pruned_head_count": int(importance_table["pruned"].sum()),
+                   "max_f1_drop": parity["f1_drop"].max()})
+
+        # Save the pruned model, `config.pruned_heads` makes `from_pretrained` rebuild the slimmer architecture
+        output_dir = os.path.join(args.wandb_dir, "pruned", run.id)
+        model.save_pretrained(output_dir)
+        processor.tokenizer.save_pretrained(output_dir)
+        importance_table.to_csv(os.path.join(output_dir, "head_importance.csv"), index=False)
+        metadata = {"pruned_heads": {str(layer): heads for layer, heads in pruned_heads.items()},
+                    "max_f1_drop": parity["f1_drop"].max()}
+        artifact = wandb.Artifact(f"model-{run.id}-pruned", type="model", metadata=metadata)
+        artifact.add_dir(output_dir)
+        prune_run.log_artifact(artifact)
+        print(f"Saved pruned model to {output_dir}")
+
+        wandb.finish()
+
+
+if __name__ == "__main__":
+    main()
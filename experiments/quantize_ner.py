@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# file: quantize_ner.py
+#
+from utils import set_random_seed
+
+set_random_seed(23456)
+import os
+import tempfile
+from typing import Dict
+
+import pandas as pd
+import torch
+import wandb
+from datasets import Dataset
+from transformers import Trainer, TrainingArguments
+
+from dataset.collate_fn import DataCollator
+from dataset.ner_dataset import NERDataset
+from dataset.ner_processor import NERProcessor
+from metrics.ner_f1 import compute_ner_pos_f1
+from models.bert_ner import BertForTokenClassification
+from models.config import BertForTokenClassificationConfig
+from utils import get_parser
+
+os.environ['WANDB_LOG_MODEL'] = "true"
+
+
+def evaluate_on_cpu(model: BertForTokenClassification, test_dataset: Dataset, dataset: NERDataset,
+                    processor: NERProcessor, args, metric_key_prefix: str) -> Dict[str, float]:
+    """seqeval metrics of `compute_ner_pos_f1` on the test set, evaluated on CPU."""
+    with tempfile.TemporaryDirectory() as output_dir:
+        training_args = TrainingArguments(output_dir, per_device_eval_batch_size=args.batch_size,
+                                          include_inputs_for_metrics=True, no_cuda=True, report_to=[])
+        trainer = Trainer(model, args=training_args,
+                          data_collator=DataCollator(tokenizer=processor.tokenizer, max_length=args.max_length,
+                                                     padding=args.padding),
+                          tokenizer=processor.tokenizer,
+                          compute_metrics=lambda p: compute_ner_pos_f1(p=p, label_list=dataset.labels,
+                                                                       constrained=args.constrained_decoding,
+                                                                       tokenizer=processor.tokenizer))
+        return trainer.evaluate(eval_dataset=test_dataset, metric_key_prefix=metric_key_prefix)
+
+
+def main():
+    parser = get_parser(HF=False)
+    args = parser.parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    experiment_name = f"{args.experiment}-{args.dataset}"
+    entity = args.wandb_user
+    os.environ["WANDB_DIR"] = args.wandb_dir
+    api = wandb.Api()
+    experiment_ref = f"bert_position_bias_no_cv-{args.dataset}"
+    runs = api.runs(entity + "/" + experiment_ref)
+    tags = [f"max_length={args.max_length}", f"pos_emb_type={args.position_embedding_type}", "quantization=int8"]
+    for run in runs:
+        config = vars(args)
+        quantize_run = wandb.init(project=experiment_name, name=run.name, tags=tags, config=config)
+        print(f"Run Name:{run.name}")
+
+        # Dataset
+        dataset = NERDataset(dataset=args.dataset, debugging=args.debugging)
+        processor = NERProcessor(pretrained_checkpoint=args.model, max_length=args.max_length,
+                                 kwargs=config)
+        test_dataset = dataset.dataset["test_"].map(processor.tokenize_and_align_labels,
+                                                    fn_kwargs={"duplicate": True, "k": 1},
+                                                    load_from_cache_file=False, batched=True)
+
+        # Download the fine-tuned model
+        run_path = "/".join(run.path[:-1])
+        model_artifact = quantize_run.use_artifact(f"{run_path}/model-{run.id}:latest", type="model")
+        model_path = model_artifact.download()
+        bert_config = BertForTokenClassificationConfig.from_pretrained(model_path)
+        model = BertForTokenClassification.from_pretrained(model_path, config=bert_config).eval()
+        quantized_model = model.quantize_dynamic()
+
+        results = {}
+        for name, m in [("fp32", model), ("int8", quantized_model)]:
+            metrics = evaluate_on_cpu(m, test_dataset, dataset=dataset, processor=processor, args=args,
+                                      metric_key_prefix=f"test_{name}")
+            results[name] = {"f1": metrics[f"test_{name}_overall_f1"],
+                             "precision": metrics[f"test_{name}_overall_precision"],
+                             "recall": metrics[f"test_{name}_overall_recall"],
+                             "samples_per_second": metrics[f"test_{name}_samples_per_second"]}
+        parity = pd.DataFrame(results).T
+        f1_drop = results["fp32"]["f1"] - results["int8"]["f1"]
+        print(parity.to_string(float_format="%.4f"))
+        print(f"F1 drop (fp32 - int8): {f1_drop:.4f} (tolerance {args.f1_tolerance})")
+        parity_table = wandb.Table(dataframe=parity.rename_axis("precision_mode").reset_index())
+        wandb.log({"quantization_parity": parity_table,
+                   "int8_f1_drop": f1_drop, "int8_f1_parity": f1_drop <= args.f1_tolerance})
+
+        # Save the quantized model next to the run and log it as an artifact
+        output_dir = os.path.join(args.wandb_dir, "quantized", run.id)
+        quantized_model.save_quantized(output_dir)
+        artifact = wandb.Artifact(f"model-{run.id}-int8", type="model", metadata={"f1_drop": f1_drop})
+        artifact.add_dir(output_dir)
+        quantize_run.log_artifact(artifact)
+
+        # Sanity check of the saved model: same logits after reloading
+        reloaded = BertForTokenClassification.from_quantized(output_dir)
+        sample = next(iter(test_dataset.with_format("torch", columns=["input_ids", "attention_mask"])))
+        with torch.inference_mode():
+            inputs = {key: value.unsqueeze(0) for key, value in sample.items()}
+            max_diff = (quantized_model(**inputs).logits - reloaded(**inputs).logits).abs().max().item()
+        print(f"Saved int8 model to {output_dir} (max logit diff after reload: {max_diff:.2e})")
+
+        wandb.finish()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# file: serve_ner.py
+#
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from inference.predictor import NERPredictor
+from inference.server import create_tiny_checkpoint, request, serve
+from utils import get_parser
+
+
+def smoke_test(args):
+    """Serve a tiny random-init checkpoint in a child process, send concurrent requests and print the metrics."""
+    with tempfile.TemporaryDirectory() as tempdir:
+        predictor = NERPredictor.from_pretrained(create_tiny_checkpoint(os.path.join(tempdir, "tiny")),
+                                                 max_length=128, device="cpu", stride=32)
+        unix_socket = args.unix_socket or os.path.join(tempdir, "ner.sock")
+        context = multiprocessing.get_context("fork")
+        ready = context.Event()
+        process = context.Process(
+            target=serve, args=(predictor,),
+            kwargs={"unix_socket": unix_socket, "workers": args.workers, "max_batch_size": args.max_batch_size,
+                    "max_wait_ms": args.max_wait_ms, "tokenizer_threads": args.tokenizer_threads, "ready": ready})
+        process.start()
+        try:
+            # Wait until every worker has warmed up, requests sent earlier would only queue behind the warm-up
+            if not ready.wait(timeout=120):
+                raise RuntimeError("The NER server did not start within 120s")
+            request(unix_socket, "/health")
+            texts = ["john smith lives in new york city", "acme corp works for paris", "the a of"]
+            with ThreadPoolExecutor(max_workers=8) as clients:
+                responses = list(clients.map(lambda i: request(unix_socket, "/predict", {"texts": texts[i % 3:]}),
+                                             range(64)))
+            assert all(len(response["entities"]) == len(texts[i % 3:]) for i, response in enumerate(responses))
+            print(f"Entities of {texts[0]!r}: {responses[0]['entities'][0]}")
+            print(f"Metrics: {request(unix_socket, '/metrics')}")
+        finally:
+            process.terminate()
+            process.join()
+
+
+def main():
+    parser = get_parser(HF=False)
+    args = parser.parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    if args.smoke_test:
+        smoke_test(args)
+        return
+    position_weights = np.load(args.position_weights) if args.position_weights is not None else None
+    predictor = NERPredictor.from_pretrained(args.model, max_length=args.max_length, device="cpu",
+                                             stride=args.window_stride, position_weights=position_weights,
+                                             position_shifts=args.position_shifts,
+                                             max_position_shift=args.max_position_shift,
+                                             constrained_decoding=args.constrained_decoding)
+    serve(predictor, host=args.host, port=args.port, unix_socket=args.unix_socket, workers=args.workers,
+          max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms, tokenizer_threads=args.tokenizer_threads)
+
+
+if __name__ == "__main__":
+    main()
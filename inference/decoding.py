@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# file: decoding.py
+#
+from typing import Dict, List, Mapping, NamedTuple, Sequence, Tuple, Union
+
+import numpy as np
+import torch
+
+# Tag prefixes of the IOBES scheme, "O" (and unknown prefixes) is 0
+PREFIXES = {"B": 1, "I": 2, "E": 3, "S": 4}
+
+
+class LabelScheme(NamedTuple):
+    """IOBES prefix and entity type id per label id, with the entity type names."""
+    prefix: np.ndarray
+    entity_type: np.ndarray
+    types: List[str]
+
+
+def label_scheme(id2label: Mapping[int, str]) -> LabelScheme:
+    """Split labels like "B-PER" into their prefix and type, as lookup arrays indexed by label id."""
+    num_labels = max(int(i) for i in id2label) + 1
+    prefix = np.zeros(num_labels, dtype=np.int8)
+    entity_type = np.full(num_labels, -1, dtype=np.int64)
+    types = []
+    for i, label in id2label.items():
+        tag, _, name = label.partition("-")
+        if tag not in PREFIXES or not name:
+            continue
+        if name not in types:
+            types.append(name)
+        prefix[int(i)] = PREFIXES[tag]
+        entity_type[int(i)] = types.index(name)
+    return LabelScheme(prefix, entity_type, types)
+
+
+def decode_iobes(label_ids: np.ndarray, sequence_ids: np.ndarray, scheme: LabelScheme) -> Dict[str, np.ndarray]:
+    """
+    Entity spans of flattened label sequences, without a Python loop over tokens.
+
+    `label_ids` and `sequence_ids` are `[N]` arrays of the words of all sequences concatenated (sequence ids
+    non-decreasing). An entity begins at B/S, or leniently at an I/E that does not continue the previous word's entity
+    (other type, or after O/E/S), and runs until the next word that is O, begins an entity or starts a new sequence.
+    Returns the `sequence`, `start`, `end` (exclusive, word indices within the sequence) and `type` of every entity.
+    """
+    label_ids = np.asarray(label_ids)
+    sequence_ids = np.asarray(sequence_ids)
+    if not len(label_ids):
+        empty = np.zeros(0, dtype=np.int64)
+        return {"sequence": empty, "start": empty, "end": empty, "type": empty}
+    prefix = scheme.prefix[label_ids]
+    entity_type = scheme.entity_type[label_ids]
+    inside = prefix > 0
+
+    first = np.ones(len(label_ids), dtype=bool)
+    first[1:] = sequence_ids[1:] != sequence_ids[:-1]
+    previous_prefix = np.concatenate([[0], prefix[:-1]])
+    previous_type = np.concatenate([[-1], entity_type[:-1]])
+    continues = ~first & (previous_prefix > 0) & (previous_prefix < PREFIXES["E"]) & (previous_type == entity_type)
+    begins = inside & ((prefix == PREFIXES["B"]) | (prefix == PREFIXES["S"]) | ~continues)
+
+    # A word ends its entity when the next word is outside, begins an entity or belongs to the next sequence
+    next_starts = np.concatenate([first[1:] | ~inside[1:] | begins[1:], [True]])
+    ends = inside & next_starts
+
+    starts, stops = np.flatnonzero(begins), np.flatnonzero(ends)
+    sequence_starts = np.flatnonzero(first)
+    offsets = sequence_starts[np.searchsorted(sequence_starts, starts, side="right") - 1]
+    return {"sequence": sequence_ids[starts], "start": starts - offsets, "end": stops + 1 - offsets,
+            "type": entity_type[starts]}
+
+
+def allowed_transitions(scheme: LabelScheme) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Valid IOBES label sequences as boolean `start[C]`, `transitions[C, C]` (previous, next) and `end[C]` masks: a
+    sequence starts with O/B/S and ends with O/E/S, B/I are followed by I/E of the same type and O/E/S by O/B/S.
+    """
+    prefix, entity_type = scheme.prefix, scheme.entity_type
+    closed = (prefix == 0) | (prefix == PREFIXES["E"]) | (prefix == PREFIXES["S"])
+    opens = (prefix == 0) | (prefix == PREFIXES["B"]) | (prefix == PREFIXES["S"])
+    open_entity = (prefix == PREFIXES["B"]) | (prefix == PREFIXES["I"])
+    continues = (prefix == PREFIXES["I"]) | (prefix == PREFIXES["E"])
+    transitions = (closed[:, None] & opens[None, :]) | \
+        (open_entity[:, None] & continues[None, :] & (entity_type[:, None] == entity_type[None, :]))
+    return opens, transitions, closed
+
+
+@torch.no_grad()
+def viterbi_decode(scores: Union[np.ndarray, torch.Tensor], mask: Union[np.ndarray, torch.Tensor],
+                   scheme: LabelScheme, batch_size: int = 256) -> np.ndarray:
+    """
+    Most likely valid IOBES label ids `[batch, seq_len]` of `scores` (logits or log-probabilities `[batch, seq_len,
+    num_labels]`), a drop-in replacement of their argmax. Only the positions of `mask` (e.g. `labels != -100`) form
+    the label sequence, other positions keep their argmax. The Viterbi recursion is vectorized over chunks of
+    `batch_size` sequences: the masked positions of each sequence are packed to the left, and sequences that are
+    shorter than the longest of their chunk carry their scores over the remaining steps.
+    """
+    scores = torch.as_tensor(scores)
+    log_probs = torch.log_softmax(scores.float(), dim=-1)
+    mask = torch.as_tensor(mask, dtype=torch.bool, device=log_probs.device)
+    num_labels = log_probs.shape[-1]
+    start, transitions, end = (torch.from_numpy(np.where(allowed, 0.0, -np.inf)).float().to(log_probs.device)
+                               for allowed in allowed_transitions(scheme))
+    labels = log_probs.argmax(-1)
+    for chunk in range(0, log_probs.shape[0], batch_size):
+        chunk_log_probs, chunk_mask = log_probs[chunk:chunk + batch_size], mask[chunk:chunk + batch_size]
+        lengths = chunk_mask.sum(-1)
+        max_length = int(lengths.max()) if len(lengths) else 0
+        if not max_length:
+            continue
+        # Positions of the label sequence first, in order
+        order = torch.sort((~chunk_mask).to(torch.int8), dim=-1, stable=True).indices[:, :max_length]
+        emissions = chunk_log_probs.gather(1, order[..., None].expand(-1, -1, num_labels))
+
+        score = start + emissions[:, 0]
+        identity = torch.arange(num_labels, device=log_probs.device).expand_as(score)
+        backpointers = []
+        for t in range(1, max_length):
+            best, backpointer = (score[:, :, None] + transitions).max(1)
+            active = (t < lengths)[:, None]
+            score = torch.where(active, best + emissions[:, t], score)
+            backpointers.append(torch.where(active, backpointer, identity))
+        last = (score + end).argmax(-1)
+        path = [last]
+        for backpointer in reversed(backpointers):
+            last = backpointer.gather(1, last[:, None]).squeeze(1)
+            path.append(last)
+        path = torch.stack(path[::-1], dim=1)
+
+        valid = torch.arange(max_length, device=log_probs.device) < lengths[:, None]
+        chunk_labels = labels[chunk:chunk + batch_size]
+        chunk_labels.scatter_(1, order, torch.where(valid, path, chunk_labels.gather(1, order)))
+    return labels.cpu().numpy()
+
+
+def entity_spans(label_ids: Sequence[Sequence[int]], id2label: Mapping[int, str]) -> List[List[tuple]]:
+    """`(type, start, end)` word spans of each label id sequence."""
+    scheme = label_scheme(id2label)
+    lengths = [len(labels) for labels in label_ids]
+    flat = np.concatenate([np.asarray(labels, dtype=np.int64) for labels in label_ids]) if label_ids else \
+        np.zeros(0, dtype=np.int64)
+    spans = decode_iobes(flat, np.repeat(np.arange(len(lengths)), lengths), scheme)
+    entities = [[] for _ in lengths]
+    for sequence, start, end, entity_type in zip(*(spans[key].tolist() for key in ("sequence", "start", "end",
+                                                                                  "type"))):
+        entities[sequence].append((scheme.types[entity_type], start, end))
+    return entities
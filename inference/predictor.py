@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# file: predictor.py
+#
+import inspect
+import re
+import time
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from dataset.ner_processor import NERProcessor
+from inference.decoding import decode_iobes, label_scheme, viterbi_decode
+from method.position_shift import shift_offsets, shifted_position_ids
+from models.factory import load_model
+
+Text = Union[str, Sequence[str]]
+
+
+class EncodedTexts(NamedTuple):
+    """Texts with their words, word character offsets and model features (see `NERPredictor.tokenize`)."""
+    texts: List[Text]
+    words: List[List[str]]
+    offsets: List[List[Tuple[int, int]]]
+    features: List[Dict[str, list]]
+
+
+def split_words(text: Text) -> Tuple[List[str], List[Tuple[int, int]]]:
+    """Whitespace-separated words of a text with their character offsets. Pre-split tokens are taken as is, with
+    offsets in their single-space-joined text."""
+    if isinstance(text, str):
+        matches = list(re.finditer(r"\S+", text))
+        return [match.group() for match in matches], [match.span() for match in matches]
+    words, offsets, start = list(text), [], 0
+    for word in words:
+        offsets.append((start, start + len(word)))
+        start += len(word) + 1
+    return words, offsets
+
+
+def position_reliability(length: int, min_weight: float = 0.1) -> np.ndarray:
+    """
+    Default reliability of the predictions at each position of a window: linearly decreasing from 1 at the first
+    position to `min_weight` at the last one, as tokens late in the input are tagged worse (position bias).
+    """
+    return np.linspace(1.0, min_weight, length, dtype=np.float32)
+
+
+class NERPredictor(object):
+    """
+    Batched entity prediction from raw texts (or pre-split tokens) with a fine-tuned token classifier.
+
+    Texts are tokenized in bulk and split into windows of at most `max_length` tokens (special tokens included, capped
+    at the model's `max_position_embeddings`) that overlap by `stride` subwords, so documents of any length are
+    classified without truncation. The windows of all texts are sorted by length, batched in buckets of similar
+    lengths (so padding is minimal) and classified under `torch.inference_mode`. Overlapping tokens merge the
+    log-probabilities of their windows, weighted by the reliability of their position in each window
+    (`position_weights`, see `position_reliability`): a token is mostly tagged by the window where it comes earliest.
+    Texts that fit in one window are classified exactly as a single sequence.
+
+    The label of each word is the label of its first subword; the IOBES labels of all words are decoded into entity
+    spans at once (`decode_iobes`) and mapped back to word indices and character offsets. The throughput of the last
+    call is kept in `throughput` (sentences, words and subword tokens per second). With `constrained_decoding`, the
+    word labels of each text are the most likely valid IOBES sequence (`viterbi_decode`) instead of the argmax.
+
+    With `position_shifts > 1`, each window is classified under that many deterministic position offsets (from 0 to
+    `max_position_shift`, see `logits`) and the logits are averaged: a test-time version of the random position shift
+    used in training.
+    """
+
+    def __init__(self, model: nn.Module, processor: NERProcessor, batch_size: int = 32,
+                 device: Optional[Union[str, torch.device]] = None, stride: int = 128,
+                 position_weights: Optional[Sequence[float]] = None, position_shifts: int = 1,
+                 max_position_shift: Optional[int] = None, constrained_decoding: bool = False):
+        self.device = torch.device(device) if device is not None else next(model.parameters()).device
+        self.model = model.to(self.device).eval()
+        self.processor = processor
+        self.batch_size = batch_size
+        self.id2label = {int(i): label for i, label in model.config.id2label.items()}
+        self.scheme = label_scheme(self.id2label)
+        self.outside_id = int(np.flatnonzero(self.scheme.prefix == 0)[0])
+        self.constrained_decoding = constrained_decoding
+        config = model.config
+        self.max_positions = getattr(config, "max_position_embeddings", None)
+        # Windows never go past the model's position embeddings, whatever the processor's `max_length`
+        self.max_length = processor.max_length or processor.tokenizer.model_max_length
+        if self.max_positions:
+            self.max_length = min(self.max_length, self.max_positions)
+        self.model_inputs = set(inspect.signature(model.forward).parameters)
+        self.throughput: Dict[str, float] = {}
+
+        tokenizer = processor.tokenizer
+        # Special tokens around a window, e.g. [CLS] ... [SEP]
+        probe = tokenizer.build_inputs_with_special_tokens([-1])
+        self.prefix_length = probe.index(-1)
+        self.window_length = self.max_length - tokenizer.num_special_tokens_to_add()
+        if not 0 <= stride < self.window_length:
+            raise ValueError(f"The window stride ({stride}) must be smaller than the window length "
+                             f"({self.window_length})")
+        self.stride = stride
+        self.position_weights = np.asarray(position_weights if position_weights is not None
+                                           else position_reliability(self.max_length), dtype=np.float32)
+        if len(self.position_weights) < self.max_length:
+            raise ValueError(f"{len(self.position_weights)} position weights for windows of {self.max_length} tokens")
+        if not np.isfinite(self.position_weights).all() or (self.position_weights < 0).any() \
+                or not self.position_weights.any():
+            raise ValueError("Position weights must be finite, non-negative and not all zero")
+        # Positions of weight 0 (e.g. an F1 of 0) keep a tiny weight, so a token that only such positions cover gets
+        # the unweighted mean of its windows instead of no prediction
+        self.position_weights = np.maximum(self.position_weights, 1e-6 * self.position_weights.max())
+
+        # Test-time position augmentation: every window is also classified with its tokens shifted to later positions
+        if position_shifts > 1 and ("position_ids" not in self.model_inputs
+                                    or getattr(config, "position_embedding_type", "absolute") != "absolute"
+                                    or not self.max_positions):
+            raise ValueError("Position shifts require a model with absolute position embeddings")
+        max_position_shift = max_position_shift if max_position_shift is not None else (self.max_positions or 0) // 2
+        self.position_shifts = shift_offsets(position_shifts, max_position_shift)
+
+    @classmethod
+    def from_pretrained(cls, name_or_path: str, max_length: Optional[int] = 512, batch_size: int = 32,
+                        device: Optional[Union[str, torch.device]] = None, stride: int = 128,
+                        position_weights: Optional[Sequence[float]] = None, position_shifts: int = 1,
+                        max_position_shift: Optional[int] = None, constrained_decoding: bool = False,
+                        **kwargs) -> "NERPredictor":
+        """Predictor of a fine-tuned checkpoint, `kwargs` override attributes of its config."""
+        processor = NERProcessor(pretrained_checkpoint=name_or_path, max_length=max_length, kwargs={})
+        model = load_model(name_or_path, cache=False, **kwargs)
+        return cls(model, processor, batch_size=batch_size, device=device, stride=stride,
+                   position_weights=position_weights, position_shifts=position_shifts,
+                   max_position_shift=max_position_shift, constrained_decoding=constrained_decoding)
+
+    def tokenize(self, words: List[List[str]]) -> List[Dict[str, list]]:
+        """Subwords of all texts (without special tokens) in one tokenizer call, with the subword index of the first
+        subword of each word (-1 for words without subwords, e.g. a zero-width space stripped by the tokenizer)."""
+        encodings = self.processor.tokenizer(words, is_split_into_words=True, add_special_tokens=False,
+                                             verbose=False)
+        features = []
+        for i in range(len(words)):
+            word_ids = np.array([-1 if word is None else word for word in encodings.word_ids(batch_index=i)],
+                                dtype=np.int64)
+            starts = np.flatnonzero((word_ids >= 0) & (word_ids != np.concatenate([[-1], word_ids[:-1]])))
+            first_subword = np.full(len(words[i]), -1, dtype=np.int64)
+            first_subword[word_ids[starts]] = starts
+            features.append({"input_ids": encodings["input_ids"][i], "first_subword": first_subword})
+        return features
+
+    def windows(self, features: List[Dict[str, list]]) -> List[Tuple[int, int, List[int]]]:
+        """`(text index, first subword, input ids with special tokens)` of the overlapping windows of every text."""
+        windows = []
+        step = self.window_length - self.stride
+        for i, feature in enumerate(features):
+            input_ids = feature["input_ids"]
+            start = 0
+            while True:
+                windows.append((i, start, self.processor.tokenizer.build_inputs_with_special_tokens(
+                    input_ids[start:start + self.window_length])))
+                if start + self.window_length >= len(input_ids):
+                    break
+                start += step
+        return windows
+
+    def buckets(self, lengths: Sequence[int], batch_size: int) -> List[np.ndarray]:
+        """Indices of the sequences batched by (descending) length."""
+        order = np.argsort(-np.asarray(lengths), kind="stable")
+        return [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+
+    def _batch_inputs(self, input_ids: List[List[int]]) -> Dict[str, torch.Tensor]:
+        seq_length = max(len(ids) for ids in input_ids)
+        pad_token_id = self.processor.tokenizer.pad_token_id or 0
+        inputs = {"input_ids": torch.tensor([ids + [pad_token_id] * (seq_length - len(ids)) for ids in input_ids]),
+                  "attention_mask": torch.tensor([[1] * len(ids) + [0] * (seq_length - len(ids))
+                                                  for ids in input_ids])}
+        if "token_type_ids" in self.model_inputs:
+            inputs["token_type_ids"] = torch.zeros_like(inputs["input_ids"])
+        return {key: value.to(self.device) for key, value in inputs.items()}
+
+    def logits(self, inputs: Dict[str, torch.Tensor]) -> torch.Tensor:
+        """
+        Logits `[batch, seq_len, num_labels]` of a batch. With position shifts, the batch is repeated once per shift
+        with the deterministic shifted position ids of `shifted_position_ids`, classified in a single forward pass and
+        the logits of each token are averaged over the shifts.
+        """
+        if self.position_shifts == [0]:
+            return self.model(**inputs, return_dict=True).logits.float()
+        num_shifts, batch_size = len(self.position_shifts), inputs["input_ids"].shape[0]
+        position_ids = shifted_position_ids(inputs["attention_mask"], self.position_shifts, self.max_positions)
+        stacked = {key: value.repeat(num_shifts, 1) for key, value in inputs.items()}
+        logits = self.model(**stacked, position_ids=position_ids, return_dict=True).logits.float()
+        return logits.view(num_shifts, batch_size, *logits.shape[1:]).mean(0)
+
+    @torch.inference_mode()
+    def predict_word_labels(self, features: List[Dict[str, list]],
+                            batch_size: Optional[int] = None) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+        """Label id and probability of the first subword of every word of each text, merged over its windows."""
+        batch_size = batch_size or self.batch_size
+        num_labels = len(self.id2label)
+        merged = [np.zeros((len(feature["input_ids"]), num_labels), dtype=np.float32) for feature in features]
+        weights = [np.zeros((len(feature["input_ids"]), 1), dtype=np.float32) for feature in features]
+        windows = self.windows(features)
+        for bucket in self.buckets([len(window[2]) for window in windows], batch_size):
+            inputs = self._batch_inputs([windows[i][2] for i in bucket])
+            log_probs = torch.log_softmax(self.logits(inputs), dim=-1).cpu().numpy()
+            for row, i in enumerate(bucket):
+                text, start, input_ids = windows[i]
+                length = min(self.window_length, len(features[text]["input_ids"]) - start)
+                positions = slice(self.prefix_length, self.prefix_length + length)
+                weight = self.position_weights[positions, None]
+                merged[text][start:start + length] += weight * log_probs[row, positions]
+                weights[text][start:start + length] += weight
+
+        # Weighted mean of the window log-probabilities of the first subwords, renormalized. Words without subwords
+        # are outside of any entity
+        word_probs = []
+        for feature, text_log_probs, text_weights in zip(features, merged, weights):
+            first_subword = feature["first_subword"]
+            has_subwords = first_subword >= 0
+            probs = np.zeros((len(first_subword), num_labels), dtype=np.float32)
+            probs[~has_subwords, self.outside_id] = 1.0
+            subwords = first_subword[has_subwords]
+            probs[has_subwords] = torch.softmax(torch.from_numpy(text_log_probs[subwords]
+                                                                 / np.maximum(text_weights[subwords], 1e-12)),
+                                                dim=-1).numpy()
+            word_probs.append(probs)
+        if not self.constrained_decoding:
+            return [probs.argmax(-1) for probs in word_probs], [probs.max(-1) for probs in word_probs]
+
+        lengths = [len(probs) for probs in word_probs]
+        padded = np.ones((len(word_probs), max(lengths, default=0), num_labels), dtype=np.float32)
+        mask = np.arange(padded.shape[1]) < np.asarray(lengths, dtype=np.int64)[:, None]
+        if word_probs:
+            padded[mask] = np.concatenate(word_probs)
+        label_ids = viterbi_decode(np.log(np.maximum(padded, 1e-30)), mask, self.scheme)
+        labels = [label_ids[i, :length] for i, length in enumerate(lengths)]
+        scores = [np.take_along_axis(probs, label[:, None], axis=-1)[:, 0] for probs, label in zip(word_probs, labels)]
+        return labels, scores
+
+    def encode(self, texts: Sequence[Text]) -> EncodedTexts:
+        """Words, character offsets and encodings of a batch of texts."""
+        words, offsets = zip(*[split_words(text) for text in texts]) if len(texts) else ((), ())
+        return EncodedTexts(list(texts), list(words), list(offsets), self.tokenize(list(words)))
+
+    def decode(self, encoded: EncodedTexts, labels: List[np.ndarray],
+               scores: List[np.ndarray]) -> List[List[Dict[str, Union[str, int, float]]]]:
+        """Entities of the encoded texts from the label id and probability of their words."""
+        texts, words, offsets = encoded.texts, encoded.words, encoded.offsets
+        lengths = [len(label) for label in labels]
+        flat_scores = np.concatenate(scores) if lengths else np.zeros(0)
+        spans = decode_iobes(np.concatenate(labels) if lengths else np.zeros(0, dtype=np.int64),
+                             np.repeat(np.arange(len(lengths)), lengths), self.scheme)
+        score_sums = np.concatenate([[0.0], np.cumsum(flat_scores)])
+        sequence_offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)[spans["sequence"]]
+        span_scores = (score_sums[sequence_offsets + spans["end"]] - score_sums[sequence_offsets + spans["start"]]) \
+            / np.maximum(spans["end"] - spans["start"], 1)
+
+        entities = [[] for _ in texts]
+        for sequence, begin, end, entity_type, score in zip(spans["sequence"].tolist(), spans["start"].tolist(),
+                                                             spans["end"].tolist(), spans["type"].tolist(),
+                                                             span_scores.tolist()):
+            start_char, end_char = offsets[sequence][begin][0], offsets[sequence][end - 1][1]
+            text = texts[sequence]
+            entities[sequence].append({
+                "text": text[start_char:end_char] if isinstance(text, str) else " ".join(words[sequence][begin:end]),
+                "label": self.scheme.types[entity_type], "start": begin, "end": end,
+                "start_char": start_char, "end_char": end_char, "score": score})
+        return entities
+
+    def predict_entities(self, texts: Union[Text, Sequence[Text]],
+                         batch_size: Optional[int] = None) -> List[List[Dict[str, Union[str, int, float]]]]:
+        """
+        Entities of every text: `{"text", "label", "start", "end" (word indices, end exclusive), "start_char",
+        "end_char", "score" (mean probability of the entity's word labels)}`. `texts` are strings (split on
+        whitespace) or lists of pre-split tokens; a single string is treated as a batch of one.
+        """
+        if isinstance(texts, str):
+            texts = [texts]
+        start = time.perf_counter()
+        encoded = self.encode(texts)
+        labels, scores = self.predict_word_labels(encoded.features, batch_size=batch_size)
+        entities = self.decode(encoded, labels, scores)
+
+        seconds = time.perf_counter() - start
+        self.throughput = {"sentences": len(texts), "words": sum(len(w) for w in encoded.words),
+                           "tokens": sum(len(feature["input_ids"]) for feature in encoded.features),
+                           "seconds": seconds}
+        for key in ("sentences", "words", "tokens"):
+            self.throughput[f"{key}_per_second"] = self.throughput[key] / max(seconds, 1e-9)
+        return entities
@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# file: server.py
+#
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import torch
+
+from inference.predictor import NERPredictor, Text
+
+
+class LatencyStatistics(object):
+    """Request latencies of the last `window` requests, with running counters of requests and batches."""
+
+    def __init__(self, window: int = 10000):
+        self.latencies = deque(maxlen=window)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.texts = 0
+        self.batches = 0
+        self.batched_texts = 0
+
+    def record_batch(self, num_texts: int):
+        with self.lock:
+            self.batches += 1
+            self.batched_texts += num_texts
+
+    def record_request(self, num_texts: int, latency: float):
+        with self.lock:
+            self.requests += 1
+            self.texts += num_texts
+            self.latencies.append(latency)
+
+    def summary(self) -> Dict[str, float]:
+        with self.lock:
+            latencies = np.asarray(self.latencies, dtype=np.float64) * 1000
+            summary = {"requests": self.requests, "texts": self.texts, "batches": self.batches,
+                       "mean_batch_size": self.batched_texts / max(self.batches, 1)}
+        for percentile in (50, 90, 99):
+            summary[f"latency_p{percentile}_ms"] = float(np.percentile(latencies, percentile)) if len(latencies) \
+                else 0.0
+        return summary
+
+
+class MicroBatcher(object):
+    """
+    Dynamic micro-batching in front of a `NERPredictor`.
+
+    Submitted requests are tokenized on a thread pool and queued; a single batching thread takes the first queued
+    request, coalesces the following ones until `max_batch_size` texts are gathered or `max_wait_ms` has passed,
+    classifies them in one `predict_word_labels` call and resolves every request's future with its entities.
+    """
+
+    def __init__(self, predictor: NERPredictor, max_batch_size: int = 32, max_wait_ms: float = 5.0,
+                 tokenizer_threads: int = 2):
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.tokenizers = ThreadPoolExecutor(max_workers=tokenizer_threads, thread_name_prefix="tokenizer")
+        self.requests = queue.Queue()
+        self.statistics = LatencyStatistics()
+        self.thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+        self.thread.start()
+
+    @property
+    def queue_depth(self) -> int:
+        """Requests tokenized and waiting for a batch."""
+        return self.requests.qsize()
+
+    def submit(self, texts: Sequence[Text]) -> Future:
+        """Future of the entities of `texts` (see `NERPredictor.predict_entities`)."""
+        future = Future()
+        if not texts:
+            future.set_result([])
+            return future
+        start = time.perf_counter()
+
+        def enqueue(encoding: Future):
+            if encoding.exception() is not None:
+                future.set_exception(encoding.exception())
+            else:
+                self.requests.put((encoding.result(), future, start))
+
+        self.tokenizers.submit(self.predictor.encode, list(texts)).add_done_callback(enqueue)
+        return future
+
+    def predict_entities(self, texts: Sequence[Text], timeout: Optional[float] = None) -> List[List[dict]]:
+        return self.submit(texts).result(timeout=timeout)
+
+    def _next_batch(self) -> Optional[List[tuple]]:
+        batch = [self.requests.get()]
+        if batch[0] is None:
+            return None
+        size = len(batch[0][0].texts)
+        deadline = time.perf_counter() + self.max_wait
+        while size < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None:
+                # Closed: answer the gathered requests first
+                self.requests.put(None)
+                break
+            batch.append(request)
+            size += len(request[0].texts)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                features = [feature for encoded, _, _ in batch for feature in encoded.features]
+                labels, scores = self.predictor.predict_word_labels(features, batch_size=self.max_batch_size)
+                self.statistics.record_batch(len(features))
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            offset = 0
+            for encoded, future, start in batch:
+                end = offset + len(encoded.features)
+                # A request failing to decode only fails its own future
+                try:
+                    future.set_result(self.predictor.decode(encoded, labels[offset:end], scores[offset:end]))
+                    self.statistics.record_request(len(encoded.texts), time.perf_counter() - start)
+                except Exception as e:
+                    future.set_exception(e)
+                offset = end
+
+    def close(self):
+        self.tokenizers.shutdown(wait=True)
+        self.requests.put(None)
+
+
+class NERRequestHandler(BaseHTTPRequestHandler):
+    """
+    `POST /predict` with `{"texts": [...]}` (or `{"text": "..."}`) answers `{"entities": [[...], ...]}`,
+    `GET /metrics` the latency percentiles, queue depth and batch statistics of the worker, `GET /health` "ok".
+    """
+    server_version = "NERServer/1.0"
+
+    def address_string(self) -> str:
+        # Unix socket clients have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _reply(self, status: int, body: dict):
+        payload = json.dumps(body).encode()
+        try:
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up (e.g. timed out) before the answer
+            pass
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._reply(200, {"status": "ok"})
+        elif self.path == "/metrics":
+            batcher = self.server.batcher
+            self._reply(200, dict(batcher.statistics.summary(), queue_depth=batcher.queue_depth, worker=os.getpid()))
+        else:
+            self._reply(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/predict":
+            self._reply(404, {"error": f"Unknown path {self.path}"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            texts = request["texts"] if "texts" in request else [request["text"]]
+            if not _valid_texts(texts):
+                raise ValueError("`texts` must be a list of strings or of lists of string tokens, `text` one of them")
+        except (ValueError, KeyError, TypeError) as e:
+            self._reply(400, {"error": f"Expected a JSON body with `texts` or `text`: {e}"})
+            return
+        try:
+            self._reply(200, {"entities": self.server.batcher.predict_entities(texts,
+                                                                               timeout=self.server.request_timeout)})
+        except Exception as e:
+            self._reply(500, {"error": str(e)})
+
+
+def _valid_texts(texts) -> bool:
+    """A list of texts, each a string or a list of pre-split string tokens."""
+    return isinstance(texts, list) and all(
+        isinstance(text, str) or (isinstance(text, list) and all(isinstance(token, str) for token in text))
+        for text in texts)
+
+
+class NERHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, batcher: Optional[MicroBatcher] = None, bind_and_activate: bool = True,
+                 request_timeout: float = 60.0, verbose: bool = False):
+        super().__init__(address, NERRequestHandler, bind_and_activate=bind_and_activate)
+        self.batcher = batcher
+        self.request_timeout = request_timeout
+        self.verbose = verbose
+
+
+class NERUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, path: str, batcher: Optional[MicroBatcher] = None, bind_and_activate: bool = True,
+                 request_timeout: float = 60.0, verbose: bool = False):
+        if bind_and_activate and os.path.exists(path):
+            os.unlink(path)
+        super().__init__(path, NERRequestHandler, bind_and_activate=bind_and_activate)
+        self.batcher = batcher
+        self.request_timeout = request_timeout
+        self.verbose = verbose
+
+
+def _serve_worker(server, predictor: NERPredictor, threads: int, batcher_kwargs: dict, ready=None):
+    torch.set_num_threads(threads)
+    # The first forward pass is much slower than the next ones, keep it out of the request latencies
+    predictor.predict_entities(["warm up"])
+    server.batcher = MicroBatcher(predictor, **batcher_kwargs)
+    if ready is not None:
+        ready.set()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.batcher.close()
+
+
+def serve(predictor: NERPredictor, host: str = "127.0.0.1", port: int = 8000, unix_socket: Optional[str] = None,
+          workers: int = 1, max_batch_size: int = 32, max_wait_ms: float = 5.0, tokenizer_threads: int = 2,
+          verbose: bool = False, ready=None):
+    """
+    Serve the predictor over HTTP (`host:port`) or a Unix socket until interrupted. `ready` (a multiprocessing
+    `Event`) is set once every worker has warmed up and accepts requests.
+
+    With `workers > 1`, the listening socket is bound once and `workers` processes are forked to accept on it
+    (pre-fork model). The model weights are moved to shared memory before forking, so all workers read the same
+    weights; each worker runs its own micro-batcher and reports its own `/metrics`, and the CPU threads are split
+    evenly between the workers.
+    """
+    if unix_socket is not None:
+        server = NERUnixHTTPServer(unix_socket, verbose=verbose)
+        address = unix_socket
+    else:
+        server = NERHTTPServer((host, port), verbose=verbose)
+        address = "http://%s:%d" % server.server_address[:2]
+    batcher_kwargs = {"max_batch_size": max_batch_size, "max_wait_ms": max_wait_ms,
+                      "tokenizer_threads": tokenizer_threads}
+    threads = max(torch.get_num_threads() // workers, 1)
+    print(f"Serving {workers} worker(s) on {address}", flush=True)
+    if workers == 1:
+        _serve_worker(server, predictor, threads, batcher_kwargs, ready=ready)
+        server.server_close()
+        return
+
+    predictor.model.share_memory()
+    context = multiprocessing.get_context("fork")
+    workers_ready = [context.Event() for _ in range(workers)]
+    processes = [context.Process(target=_serve_worker, args=(server, predictor, threads, batcher_kwargs),
+                                 kwargs={"ready": worker_ready}, daemon=True) for worker_ready in workers_ready]
+    for process in processes:
+        process.start()
+    # Terminating the parent stops the workers
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        if ready is not None:
+            for worker_ready in workers_ready:
+                worker_ready.wait()
+            ready.set()
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+        server.server_close()
+        if unix_socket is not None and os.path.exists(unix_socket):
+            os.unlink(unix_socket)
+
+
+def request(address: str, path: str = "/metrics", body: Optional[dict] = None, timeout: float = 60.0) -> dict:
+    """Minimal client: JSON `GET` (or `POST` with `body`) to `http://host:port` or to a Unix socket path."""
+    payload = json.dumps(body).encode() if body is not None else b""
+    method = "POST" if body is not None else "GET"
+    if address.startswith("http://"):
+        host, port = address[len("http://"):].rsplit(":", 1)
+        connection = socket.create_connection((host, int(port)), timeout=timeout)
+    else:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.settimeout(timeout)
+        connection.connect(address)
+    with connection:
+        connection.sendall(f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+                           f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode() + payload)
+        response = b""
+        while chunk := connection.recv(65536):
+            response += chunk
+    header, _, body_bytes = response.partition(b"\r\n\r\n")
+    status = int(header.split(b" ", 2)[1])
+    result = json.loads(body_bytes)
+    if status != 200:
+        raise RuntimeError(f"{method} {path} failed with {status}: {result.get('error')}")
+    return result
+
+
+def create_tiny_checkpoint(output_dir: str, labels: Optional[List[str]] = None, words: Optional[List[str]] = None,
+                           seed: int = 0) -> str:
+    """Tiny random-init BERT token classifier with a word-level vocabulary, to run the server fully offline."""
+    from transformers import BertTokenizerFast
+
+    from models.bert_ner import BertForTokenClassification
+    from models.config import BertForTokenClassificationConfig
+
+    labels = labels or ["O", "S-MISC", "B-MISC", "I-MISC", "E-MISC", "S-ORG", "B-ORG", "I-ORG", "E-ORG", "S-LOC",
+                        "B-LOC", "I-LOC", "E-LOC", "S-PER", "B-PER", "I-PER", "E-PER"]
+    words = words or "the a of in and to john smith lives new york city works for acme corp paris germany .".split()
+    os.makedirs(output_dir, exist_ok=True)
+    vocab_file = os.path.join(output_dir, "vocab.txt")
+    with open(vocab_file, "w") as f:
+        f.write("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + list(dict.fromkeys(words))))
+    tokenizer = BertTokenizerFast(vocab_file)
+    tokenizer.save_pretrained(output_dir)
+    config = BertForTokenClassificationConfig(vocab_size=len(tokenizer), hidden_size=32, num_hidden_layers=2,
+                                              num_attention_heads=2, intermediate_size=64,
+                                              max_position_embeddings=128, id2label=dict(enumerate(labels)),
+                                              label2id={label: i for i, label in enumerate(labels)})
+    torch.manual_seed(seed)
+    BertForTokenClassification(config).save_pretrained(output_dir)
+    return output_dir
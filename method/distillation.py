@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# file: distillation.py
+#
+import os
+from typing import Callable, Dict, Iterable, List, Optional
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.data import Dataset
+
+# Padding values of the cached views when they are collated back into batches
+_PAD_VALUES = {"input_ids": 0, "attention_mask": 0, "token_type_ids": 0, "labels": -100, "position_ids": 0,
+               "teacher_logits": 0.0}
+
+
+def distillation_loss(student_logits: torch.Tensor, teacher_logits: torch.Tensor, labels: torch.Tensor,
+                      temperature: float = 2.0) -> torch.Tensor:
+    """
+    KL divergence between the temperature-softened teacher and student label distributions over the labeled tokens
+    (`labels != -100`), scaled by `temperature ** 2` (Hinton et al.). `student_logits` is either `[batch, seq_len,
+    num_labels]` or the `[num_labeled, num_labels]` logits of a model with `classify_labeled_only`.
+    """
+    mask = labels != -100
+    if student_logits.dim() == 3:
+        student_logits = student_logits[mask]
+    teacher_logits = teacher_logits[mask]
+    if not len(teacher_logits):
+        return student_logits.sum() * 0.0
+    student_log_probs = F.log_softmax(student_logits.float() / temperature, dim=-1)
+    teacher_probs = F.softmax(teacher_logits.float() / temperature, dim=-1)
+    return F.kl_div(student_log_probs, teacher_probs, reduction="batchmean") * temperature ** 2
+
+
+@torch.no_grad()
+def teacher_logits(teacher: nn.Module, batch: Dict[str, torch.Tensor]) -> torch.Tensor:
+    """Logits `[batch, seq_len, num_labels]` of the teacher on a batch (labels are not passed)."""
+    device = next(teacher.parameters()).device
+    inputs = {key: value.to(device) for key, value in batch.items()
+              if key in ("input_ids", "attention_mask", "token_type_ids", "position_ids")}
+    return teacher(**inputs, return_dict=True).logits
+
+
+class SoftLabelCache(Dataset):
+    """
+    Training views with the teacher's soft labels, computed once and saved to `<cache_dir>/soft_labels.pt`.
+
+    Every batch of the training dataloader is stored as is and, for each function of `augmentations` (e.g.
+    `concatenate_batch`, `random_shift`), as one augmented view, so the student sees the same concatenation/shift
+    augmentations as `BertForNERTask` without running the teacher during training. The cache is rebuilt when its
+    `metadata` (teacher, augmentations, ...) differs. Items are single (unpadded) sequences with their
+    `teacher_logits` in float16, batched again with `collate`.
+    """
+
+    def __init__(self, examples: List[Dict[str, torch.Tensor]], metadata: Optional[dict] = None):
+        self.examples = examples
+        self.metadata = metadata or {}
+
+    def __len__(self):
+        return len(self.examples)
+
+    def __getitem__(self, index: int) -> Dict[str, torch.Tensor]:
+        return self.examples[index]
+
+    @classmethod
+    def build(cls, teacher: nn.Module, dataloader: Iterable[Dict[str, torch.Tensor]],
+              augmentations: Optional[Dict[str, Callable]] = None, cache_dir: Optional[str] = None,
+              metadata: Optional[dict] = None) -> "SoftLabelCache":
+        augmentations = augmentations or {}
+        metadata = dict(metadata or {}, augmentations=sorted(augmentations))
+        path = os.path.join(cache_dir, "soft_labels.pt") if cache_dir is not None else None
+        if path is not None and os.path.exists(path):
+            cached = torch.load(path)
+            if cached["metadata"] == metadata:
+                return cls(cached["examples"], metadata)
+
+        was_training = teacher.training
+        teacher.eval()
+        examples = []
+        for batch in dataloader:
+            views = [batch] + [augment({key: value.clone() for key, value in batch.items()})
+                               for augment in augmentations.values()]
+            for view in views:
+                logits = teacher_logits(teacher, view).cpu()
+                examples += cls._split(view, logits)
+        teacher.train(was_training)
+        cache = cls(examples, metadata)
+        if path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            torch.save({"metadata": metadata, "examples": examples}, path)
+        return cache
+
+    @staticmethod
+    def _split(batch: Dict[str, torch.Tensor], logits: torch.Tensor) -> List[Dict[str, torch.Tensor]]:
+        """Per-sequence views, trimmed after the last non-padding token, with explicit position ids."""
+        attention_mask = batch["attention_mask"].cpu()
+        seq_length = attention_mask.shape[-1]
+        position_ids = batch.get("position_ids")
+        if position_ids is None:
+            position_ids = torch.arange(seq_length).expand_as(attention_mask)
+        columns = {key: batch[key].cpu() for key in ("input_ids", "attention_mask", "token_type_ids", "labels")
+                   if key in batch}
+        columns["position_ids"] = position_ids.cpu().long()
+        columns["teacher_logits"] = logits.half()
+        trailing_padding = (attention_mask.flip(-1) == 0).long().cumprod(-1).sum(-1)
+        lengths = seq_length - trailing_padding
+        return [{key: value[i, :length] for key, value in columns.items()} for i, length in enumerate(lengths.tolist())]
+
+    @staticmethod
+    def collate(examples: List[Dict[str, torch.Tensor]]) -> Dict[str, torch.Tensor]:
+        """Right-pad cached views to the longest one of the batch."""
+        max_length = max(len(example["input_ids"]) for example in examples)
+        batch = {}
+        for key in examples[0]:
+            values = [example[key] for example in examples]
+            padded = values[0].new_full((len(values), max_length) + values[0].shape[1:], _PAD_VALUES[key])
+            for i, value in enumerate(values):
+                padded[i, :len(value)] = value
+            batch[key] = padded
+        batch["teacher_logits"] = batch["teacher_logits"].float()
+        return batch
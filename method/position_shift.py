@@ -16,3 +16,27 @@ def random_shift(batch, max_length=None, k=1):
     batch["position_ids"] = torch.Tensor(position_ids).to(dtype=batch["input_ids"].dtype)
 
     return batch
+
+
+def shift_offsets(num_shifts, max_shift):
+    """`num_shifts` evenly spaced position offsets from 0 (the unshifted input) to `max_shift`."""
+    if num_shifts <= 1:
+        return [0]
+    return [int(round(i * max_shift / (num_shifts - 1))) for i in range(num_shifts)]
+
+
+def shifted_position_ids(attention_mask, shifts, max_position):
+    """
+    Deterministic counterpart of `random_shift` for test-time augmentation: position ids `[len(shifts) * batch,
+    seq_len]` of the batch under each shift (shift-major). As in `random_shift`, every non-padding token but the first
+    ([CLS]) is moved by the shift and padding keeps its position; the shift of a sequence is capped so its last token
+    stays below `max_position`.
+    """
+    batch_size, seq_len = attention_mask.shape
+    device = attention_mask.device
+    positions = torch.arange(seq_len, device=device).expand(batch_size, -1)
+    lengths = attention_mask.sum(-1)
+    shifts = torch.as_tensor(shifts, device=device).view(-1, 1)
+    shifts = torch.minimum(shifts, (max_position - lengths).clamp(min=0).view(1, -1))  # [num_shifts, batch]
+    moved = attention_mask.bool() & (positions > 0)
+    return (positions + shifts.unsqueeze(-1) * moved).reshape(-1, seq_len)
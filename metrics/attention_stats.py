@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# file: attention_stats.py
+#
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+import torch
+
+
+class AttentionStatistics(object):
+    """
+    Streaming statistics of attention maps, accumulated during evaluation instead of storing raw matrices.
+
+    For every query token the following metrics are computed from its attention distribution:
+        - entropy:        entropy of the attention distribution over all keys
+        - distance:       mean attention distance `sum_j p_ij * |i - j|`
+        - cls_mass:       attention mass on the [CLS] token
+        - sep_mass:       attention mass on the final [SEP] token
+        - same_copy_mass: attention mass on the tokens of the same k-copy as the query
+
+    Running count, mean and M2 (Welford) are kept per layer/head/query position and per layer/head/k-copy, so the
+    memory is O(layers x heads x max_length) whatever the number of evaluated sentences.
+    """
+    METRICS = ("entropy", "distance", "cls_mass", "sep_mass", "same_copy_mass")
+
+    def __init__(self, num_layers: int, num_heads: int, max_length: int = 512, max_k: int = 10,
+                 device: Optional[torch.device] = None):
+        self.num_layers = num_layers
+        self.num_heads = num_heads
+        self.max_length = max_length
+        self.max_k = max_k
+        self.device = device
+        self.reset()
+
+    def reset(self):
+        shape = (len(self.METRICS), self.num_layers, self.num_heads)
+        kwargs = {"dtype": torch.float64, "device": self.device}
+        self.position_count = torch.zeros(self.num_layers, self.max_length, **kwargs)
+        self.position_mean = torch.zeros(shape + (self.max_length,), **kwargs)
+        self.position_m2 = torch.zeros(shape + (self.max_length,), **kwargs)
+        self.copy_count = torch.zeros(self.num_layers, self.max_k, **kwargs)
+        self.copy_mean = torch.zeros(shape + (self.max_k,), **kwargs)
+        self.copy_m2 = torch.zeros(shape + (self.max_k,), **kwargs)
+
+    @staticmethod
+    def _merge(count, mean, m2, index, values, size):
+        """Merge the batch `values` `[metrics, heads, N]` binned by `index` `[N]` into the running moments."""
+        ones = torch.ones_like(index, dtype=torch.float64)
+        batch_count = torch.zeros(size, dtype=torch.float64, device=count.device).index_add_(0, index, ones)
+        batch_sum = torch.zeros(values.shape[:-1] + (size,), dtype=torch.float64,
+                                device=count.device).index_add_(-1, index, values)
+        batch_mean = batch_sum / batch_count.clamp(min=1)
+        centered = values - batch_mean[..., index]
+        batch_m2 = torch.zeros_like(batch_sum).index_add_(-1, index, centered ** 2)
+
+        # Chan et al. parallel update of the Welford accumulators
+        total = count + batch_count
+        delta = batch_mean - mean
+        weight = batch_count / total.clamp(min=1)
+        mean += delta * weight
+        m2 += batch_m2 + delta ** 2 * count * weight
+        count.copy_(total)
+
+    @torch.no_grad()
+    def update(self, layer: int, attention_probs: torch.Tensor, attention_mask: torch.Tensor, k: int = 1,
+               copy_ids: Optional[torch.Tensor] = None):
+        """
+        Accumulate the attention probabilities `[batch, heads, seq_len, seq_len]` of a (0-based) layer, with left or
+        right padding. Query positions are counted from the first token after [CLS]; the k copies are given by
+        `copy_ids` (`[batch, seq_len]` copy index per token, -1 outside all copies), or are the k equal chunks of the
+        tokens between [CLS] and the final [SEP].
+        """
+        probs = attention_probs.detach().to(torch.float64)
+        batch_size, _, seq_len, _ = probs.shape
+        mask = attention_mask.to(probs.device).bool()
+        lengths = mask.sum(-1)
+        # [CLS] index: 0 with right padding, the first non-padding token with left padding
+        first = mask.int().argmax(-1)
+        last = first + lengths - 1
+        positions = torch.arange(seq_len, device=probs.device)
+
+        # Queries: tokens between [CLS] and the final [SEP]
+        queries = mask & (positions > first.unsqueeze(-1)) & (positions < last.unsqueeze(-1))
+        token_position = positions - first.unsqueeze(-1) - 1
+        if copy_ids is None:
+            chunk_size = ((lengths - 2) // k).clamp(min=1).unsqueeze(-1)
+            copy = (token_position // chunk_size).clamp(max=k - 1)
+        else:
+            copy = copy_ids.to(probs.device)
+        copied = queries & (copy >= 0)
+        in_copy = copied.unsqueeze(-1) & copied.unsqueeze(1) & (copy.unsqueeze(-1) == copy.unsqueeze(1))
+
+        entropy = -torch.special.xlogy(probs, probs).sum(-1)
+        distance = (probs * (positions.view(-1, 1) - positions.view(1, -1)).abs()).sum(-1)
+        cls_mass = probs.gather(-1, first.view(-1, 1, 1, 1).expand(-1, probs.shape[1], seq_len, 1))[..., 0]
+        sep_mass = probs.gather(-1, last.view(-1, 1, 1, 1).expand(-1, probs.shape[1], seq_len, 1))[..., 0]
+        same_copy_mass = (probs * in_copy.unsqueeze(1)).sum(-1)
+        metrics = torch.stack([entropy, distance, cls_mass, sep_mass, same_copy_mass])  # [metrics, b, heads, seq]
+
+        values = metrics.permute(0, 2, 1, 3)[..., queries]  # [metrics, heads, N]
+        self._merge(self.position_count[layer], self.position_mean[:, layer], self.position_m2[:, layer],
+                    token_position[queries].clamp(max=self.max_length - 1), values, self.max_length)
+        in_copy_queries = copied[queries]
+        self._merge(self.copy_count[layer], self.copy_mean[:, layer], self.copy_m2[:, layer],
+                    copy[copied].clamp(max=self.max_k - 1), values[..., in_copy_queries], self.max_k)
+
+    def _frame(self, count, mean, m2, column: str) -> pd.DataFrame:
+        count = count.cpu().numpy()
+        mean = mean.cpu().numpy()
+        std = np.sqrt(m2.cpu().numpy() / np.maximum(count - 1, 1)[None, :, None, :])
+        metric, layer, head, bin_ = np.nonzero(np.broadcast_to(count[None, :, None, :] > 0, mean.shape))
+        return pd.DataFrame({"metric": np.asarray(self.METRICS)[metric], "layer": layer + 1, "head": head,
+                             column: bin_ if column == "position" else bin_ + 1,
+                             "count": count[layer, bin_].astype(np.int64),
+                             "mean": mean[metric, layer, head, bin_], "std": std[metric, layer, head, bin_]})
+
+    def summary(self) -> pd.DataFrame:
+        """Long-format table of count/mean/std per metric, layer, head and query position."""
+        return self._frame(self.position_count, self.position_mean, self.position_m2, "position")
+
+    def copy_summary(self) -> pd.DataFrame:
+        """Long-format table of count/mean/std per metric, layer, head and k-copy (1-based)."""
+        return self._frame(self.copy_count, self.copy_mean, self.copy_m2, "copy")
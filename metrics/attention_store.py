@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# file: attention_store.py
+#
+import json
+import os
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+from numpy.lib.format import open_memmap
+
+ATTENTION_KINDS = ("attention_probs", "attention_scores")
+CAPTURE_MODES = ("float32", "float16", "bfloat16", "uint8", "topk")
+
+
+def _layer_file(path: str, kind: str, layer: int, suffix: str = "") -> str:
+    return os.path.join(path, kind, f"layer_{layer}{suffix}.npy")
+
+
+def _storage_dtype(capture: str, kind: str) -> np.dtype:
+    if capture in ["float16", "topk"] or (capture == "uint8" and kind != "attention_probs"):
+        return np.dtype(np.float16)
+    if capture == "bfloat16":
+        return np.dtype(np.uint16)
+    if capture == "uint8":
+        return np.dtype(np.uint8)
+    return np.dtype(np.float32)
+
+
+def capture_attention(attention: torch.Tensor, capture: str = "float32", topk: int = 8,
+                      kind: str = "attention_probs"):
+    """
+    Reduce a captured `[num_heads, L, L]` attention tensor on its device, then move it to the host.
+
+    Error bounds with respect to the float32 values:
+        - float16: relative error <= 2**-11 (~4.9e-4) for |x| >= 6.1e-5, absolute error <= 2**-25 (~3e-8) for the
+          subnormal probabilities below.
+        - bfloat16: relative error <= 2**-8 (~3.9e-3) over the full float32 range. NumPy has no bfloat16, so the
+          upper 16 bits of the float32 pattern are stored as uint16.
+        - uint8: probabilities are quantized to `round(255 * p)`, absolute error <= 1/510 (~2e-3). Raw scores are not
+          bounded and fall back to float16.
+        - topk: only the `topk` largest keys of each query row are kept (float16 values and int16 key indices). The
+          error of a dropped entry is its own value, which is bounded by the smallest kept value of the row; the
+          dropped probability mass of a row is exactly `1 - sum(kept values)`.
+
+    Returns a NumPy array, or a dict with `values` and `indices` `[num_heads, L, topk]` arrays for `topk`.
+    """
+    attention = attention.detach()
+    if capture == "float32":
+        return attention.float().cpu().numpy()
+    if capture == "bfloat16":
+        return attention.to(torch.bfloat16).view(torch.int16).cpu().numpy().view(np.uint16)
+    if capture == "uint8" and kind == "attention_probs":
+        return torch.round(attention.float() * 255).to(torch.uint8).cpu().numpy()
+    if capture == "topk":
+        values, indices = attention.topk(min(topk, attention.shape[-1]), dim=-1)
+        return {"values": values.half().cpu().numpy(), "indices": indices.to(torch.int16).cpu().numpy()}
+    if capture in CAPTURE_MODES:
+        return attention.half().cpu().numpy()
+    raise ValueError(f"Unknown attention capture mode {capture}, choose one of {CAPTURE_MODES}")
+
+
+def restore_attention(stored, capture: str = "float32", kind: str = "attention_probs",
+                      length: Optional[int] = None) -> np.ndarray:
+    """
+    Inverse of `capture_attention`: returns the dense float32 attention. Keys dropped by `topk` are restored as 0
+    for probabilities and -inf for scores.
+    """
+    if capture == "topk":
+        values, indices = stored["values"], stored["indices"].astype(np.int64)
+        length = length if length is not None else values.shape[-2]
+        fill = 0.0 if kind == "attention_probs" else -np.inf
+        dense = np.full(values.shape[:-1] + (length,), fill, dtype=np.float32)
+        np.put_along_axis(dense, indices, values.astype(np.float32), axis=-1)
+        return dense
+    if capture == "bfloat16":
+        return (stored.astype(np.uint32) << 16).view(np.float32)
+    if capture == "uint8" and kind == "attention_probs":
+        return stored.astype(np.float32) / 255
+    return stored.astype(np.float32)
+
+
+class AttentionStoreWriter(object):
+    """
+    Stream captured attention matrices into preallocated memory-mapped `.npy` arrays.
+
+    Each (kind, layer) pair is stored in its own `[num_heads, total]` array in which the `[num_heads, L, L]` block of
+    every sentence is flattened at a fixed offset. Offsets and lengths are known upfront from the tokenized test set,
+    so the arrays are allocated once and nothing but the current batch is ever kept in host memory.
+
+    With `capture="topk"` a block only holds `[num_heads, L, min(topk, L)]` values, and the key indices are stored
+    next to them in `layer_<i>_indices.npy`. See `capture_attention` for the other capture modes.
+
+    Layout of `path`:
+        meta.json                       number of layers/heads, capture mode and stored kinds
+        index.npy                       ragged index `[num_sentences, 2]` of (offset, length) per sentence
+        <kind>/layer_<i>.npy            `[num_heads, total]` flattened attention blocks of layer i (1-based)
+    """
+
+    def __init__(self, path: str, lengths: Sequence[int], num_layers: int, num_heads: int,
+                 kinds: Sequence[str] = ATTENTION_KINDS, capture: str = "float32", topk: int = 8):
+        if capture not in CAPTURE_MODES:
+            raise ValueError(f"Unknown attention capture mode {capture}, choose one of {CAPTURE_MODES}")
+        self.path = path
+        self.num_layers = num_layers
+        self.num_heads = num_heads
+        self.kinds = list(kinds)
+        self.capture = capture
+        self.topk = topk
+
+        lengths = np.asarray(lengths, dtype=np.int64)
+        sizes = lengths * np.minimum(lengths, topk) if capture == "topk" else lengths ** 2
+        offsets = np.zeros_like(sizes)
+        offsets[1:] = np.cumsum(sizes)[:-1]
+        self.index = np.stack([offsets, lengths], axis=1)
+        total = int(sizes.sum())
+
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "index.npy"), self.index)
+        self.arrays = {}
+        self.indices = {}
+        for kind in self.kinds:
+            os.makedirs(os.path.join(path, kind), exist_ok=True)
+            self.arrays[kind] = [open_memmap(_layer_file(path, kind, i + 1), mode="w+",
+                                             dtype=_storage_dtype(capture, kind), shape=(num_heads, total))
+                                 for i in range(num_layers)]
+            if capture == "topk":
+                self.indices[kind] = [open_memmap(_layer_file(path, kind, i + 1, "_indices"), mode="w+",
+                                                  dtype=np.int16, shape=(num_heads, total))
+                                      for i in range(num_layers)]
+        self.cursor = 0
+
+    def __len__(self):
+        return self.cursor
+
+    def append(self, attn_dict: Dict[str, Dict[str, np.ndarray]]):
+        """
+        Write the attention of the next sentence, given as returned by `dissected_feed_forward`, i.e.
+        `{kind: {"layer_<i>": [num_heads, L, L]}}` already reduced with `capture_attention`.
+        """
+        if self.cursor >= self.index.shape[0]:
+            raise IndexError(f"The store was allocated for {self.index.shape[0]} sentences")
+        offset, length = self.index[self.cursor]
+        size = length * min(length, self.topk) if self.capture == "topk" else length * length
+        for kind in self.kinds:
+            for i, array in enumerate(self.arrays[kind]):
+                block = attn_dict[kind][f"layer_{i + 1}"]
+                if self.capture == "topk":
+                    self.indices[kind][i][:, offset:offset + size] = block["indices"].reshape(self.num_heads, -1)
+                    block = block["values"]
+                if block.shape[-2] != length:
+                    raise ValueError(f"Sentence {self.cursor} has length {block.shape[-2]}, "
+                                     f"expected {length} from the index")
+                array[:, offset:offset + size] = block.reshape(self.num_heads, -1)
+        self.cursor += 1
+
+    def close(self):
+        for kind in self.kinds:
+            for array in self.arrays[kind] + self.indices.get(kind, []):
+                array.flush()
+        meta = {"num_layers": self.num_layers, "num_heads": self.num_heads, "kinds": self.kinds,
+                "capture": self.capture, "topk": self.topk, "num_sentences": self.cursor}
+        with open(os.path.join(self.path, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        self.arrays = {}
+        self.indices = {}
+
+    def files(self) -> List[str]:
+        """Relative paths of all files making up the store."""
+        files = ["meta.json", "index.npy"]
+        suffixes = ["", "_indices"] if self.capture == "topk" else [""]
+        for kind in self.kinds:
+            files += [os.path.relpath(_layer_file(self.path, kind, i + 1, suffix), self.path)
+                      for i in range(self.num_layers) for suffix in suffixes]
+        return files
+
+
+class AttentionStore(object):
+    """
+    Read-only, zero-copy view over a store written by `AttentionStoreWriter`.
+
+    Layer arrays are memory-mapped on first access, so reading one head of one layer of one sentence only touches
+    the pages holding that block. Blocks are decoded back to float32 according to the capture mode of the store.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.num_layers = self.meta["num_layers"]
+        self.num_heads = self.meta["num_heads"]
+        self.kinds = self.meta["kinds"]
+        self.capture = self.meta.get("capture", "float32")
+        self.topk = self.meta.get("topk")
+        self.index = np.load(os.path.join(path, "index.npy"))[:self.meta["num_sentences"]]
+        self._arrays = {}
+
+    def __len__(self):
+        return self.index.shape[0]
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return self.index[:, 1]
+
+    def layer(self, layer: int, kind: str = "attention_probs", suffix: str = "") -> np.ndarray:
+        """Memory-mapped `[num_heads, total]` array of a layer (1-based, as in the `layer_<i>` keys)."""
+        key = (kind, layer, suffix)
+        if key not in self._arrays:
+            self._arrays[key] = np.load(_layer_file(self.path, kind, layer, suffix), mmap_mode="r")
+        return self._arrays[key]
+
+    def get_stored(self, sentence: int, layer: int, kind: str = "attention_probs", head: Optional[int] = None):
+        """
+        Stored (still encoded) block of a sentence as `[num_heads, L, L]`, or `[L, L]` if `head` is given. For `topk`
+        stores a dict of `values` and `indices` `[..., L, topk]` arrays is returned.
+        """
+        offset, length = self.index[sentence]
+        width = min(length, self.topk) if self.capture == "topk" else length
+        heads = head if head is not None else slice(None)
+        shape = (length, width) if head is not None else (self.num_heads, length, width)
+        block = self.layer(layer, kind)[heads, offset:offset + length * width].reshape(shape)
+        if self.capture == "topk":
+            indices = self.layer(layer, kind, "_indices")[heads, offset:offset + length * width].reshape(shape)
+            return {"values": block, "indices": indices}
+        return block
+
+    def get(self, sentence: int, layer: int, kind: str = "attention_probs",
+            head: Optional[int] = None) -> np.ndarray:
+        """Attention of a sentence as float32 `[num_heads, L, L]`, or `[L, L]` if `head` is given."""
+        block = self.get_stored(sentence, layer, kind=kind, head=head)
+        if self.capture == "float32":
+            return block
+        return restore_attention(block, capture=self.capture, kind=kind, length=int(self.index[sentence, 1]))
+
+    def sentence(self, sentence: int, kind: str = "attention_probs") -> Dict[str, np.ndarray]:
+        """All layers of a sentence in the `{"layer_<i>": [num_heads, L, L]}` format of `dissected_feed_forward`."""
+        return {f"layer_{i}": self.get(sentence, i, kind=kind) for i in range(1, self.num_layers + 1)}
+
+    def shape(self, sentence: int) -> Tuple[int, int, int]:
+        length = int(self.index[sentence, 1])
+        return self.num_heads, length, length
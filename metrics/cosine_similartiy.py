@@ -1,18 +1,21 @@
-from typing import Tuple, Optional, Dict
+from typing import Tuple, Optional, Dict, Sequence
 
+import numpy as np
 import torch
-import torch.nn.functional as F
 
 
 def apply_chunking_to_tensors(
-        chunk_size: int, chunk_dim: int, input_tensor
+        chunk_size: int, chunk_dim: int, input_tensor, spans: Optional[Sequence[Sequence[int]]] = None
 ) -> torch.Tensor:
     """
     This function chunks the `input_tensors` into smaller input tensor parts of size `chunk_size` over the dimension
     `chunk_dim`. It then applies a layer `cosine similarity` to each chunk independently to save memory.
 
-
+    If `spans` (`[[start, end], ...]` offsets along `chunk_dim`) is given, the chunks are these (possibly ragged)
+    slices and `chunk_size` is ignored.
     """
+    if spans is not None:
+        return tuple(input_tensor.narrow(chunk_dim, int(start), int(end) - int(start)) for start, end in spans)
 
     if chunk_size > 0:
         tensor_shape = input_tensor.shape[chunk_dim]
@@ -31,45 +34,87 @@ def apply_chunking_to_tensors(
     return input_tensor
 
 
+def copy_ids_from_spans(copy_spans: Sequence[Sequence[Sequence[int]]], seq_length: int,
+                        device: Optional[torch.device] = None, offsets: Optional[Sequence[int]] = None) -> torch.Tensor:
+    """
+    Per-token copy index `[batch, seq_length]` from the `copy_spans` (`[[start, end], ...]` per sequence) emitted by
+    `NERProcessor` for duplicated sequences; tokens outside every copy ([CLS], [SEP], padding) get -1. The spans are
+    relative to the unpadded sequence: with left padding, `offsets` gives the index of each sequence's first token.
+    """
+    offsets = offsets if offsets is not None else [0] * len(copy_spans)
+    copy_ids = torch.full((len(copy_spans), seq_length), -1, dtype=torch.long)
+    for i, (spans, offset) in enumerate(zip(copy_spans, offsets)):
+        for c, (start, end) in enumerate(spans):
+            copy_ids[i, offset + start:offset + end] = c
+    return copy_ids.to(device)
+
+
 def cosine_similarity(word_embeds: torch.FloatTensor,
-                      position_embeds: torch.FloatTensor,
+                      position_embeds: Optional[torch.FloatTensor],
                       embedding_output: torch.FloatTensor,
                       all_hidden_states: Optional[Dict] = None,
-                      k: Optional[int] = None):
+                      k: Optional[int] = None,
+                      copy_ids: Optional[torch.Tensor] = None):
     """
     Calculate cosine similarity between position and word embeddings, and between attentions score/probabilities.
-    """
-    # Chunk embeddings into k chunks
-    chunk_size = int(embedding_output.shape[-2] / k)
-
-    embedding_output = apply_chunking_to_tensors(chunk_size=chunk_size, chunk_dim=0, input_tensor=embedding_output)
-    position_embeds = apply_chunking_to_tensors(chunk_size=chunk_size, chunk_dim=0, input_tensor=position_embeds)
-    word_embeds = apply_chunking_to_tensors(chunk_size=chunk_size, chunk_dim=0, input_tensor=word_embeds)
-
-    assert len(embedding_output) == len(position_embeds) == len(word_embeds)
-
-    cosine_positions = {f"pos_sim_k={i + 1}": [] for i in range(k)}
-    cosine_words = {f"word_sim_k={i + 1}": [] for i in range(k)}
-    for i, embedding_at_k in enumerate(embedding_output):
-        last_layer_position_similarity = F.cosine_similarity(position_embeds[0], embedding_at_k, dim=-1)
-        last_layer_word_similarity = F.cosine_similarity(word_embeds[0], embedding_at_k, dim=-1)
-
-        cosine_positions[f"pos_sim_k={i + 1}"].append(last_layer_position_similarity)
-        cosine_words[f"word_sim_k={i + 1}"].append(last_layer_word_similarity)
-
-    if all_hidden_states is not None:
-        for key, layer in all_hidden_states.items():
-            layer_emb = apply_chunking_to_tensors(chunk_size=chunk_size, chunk_dim=0, input_tensor=layer)
-            for i, layer_emb_at_k in enumerate(layer_emb):
-                layer_position_similarity = F.cosine_similarity(position_embeds[0], layer_emb_at_k, dim=-1)
-                cosine_positions[f"pos_sim_k={i + 1}"].append(layer_position_similarity)
-
-                layer_word_similarty = F.cosine_similarity(word_embeds[0], layer_emb_at_k, dim=-1)
-                cosine_words[f"word_sim_k={i + 1}"].append(layer_word_similarty)
 
+    Every token of copy c is compared with the position embedding at its offset j inside the copy and with the word
+    embedding of the j-th token of the first copy, so `word_embeds` and `position_embeds` only need to cover the
+    first copy (`[first_copy_length, hidden]`, longer inputs are cut down to it). Copies are given by `copy_ids` (`[seq_len]` copy index per token,
+    -1 for tokens outside all copies, e.g. the [SEP] between copies in "sep" mode), so they may have different lengths
+    (truncated last copy); without `copy_ids` the sequence is split into `k` equal chunks.
+
+    All layers are stacked into one `[layers, seq_len, hidden]` tensor (`all_hidden_states` may also be given stacked
+    as `[layers, seq_len, hidden]`); the similarities of every layer and token are computed with a single einsum (and
+    one norm per vector) on device, and only the final `[2, tokens, layers]` array is moved to the host. Returns
+    `{"positions_cosine": {"pos_sim_k=<i>": [len_i, layers]}, "words_cosine": {...}}`, `positions_cosine` is empty when
+    `position_embeds` is None.
+    """
+    seq_length = embedding_output.shape[-2]
+    device = embedding_output.device
+    tokens = torch.arange(seq_length, device=device)
+    if copy_ids is None:
+        # Chunk embeddings into k chunks, the tokens left over by the division are ignored
+        chunk_size = max(seq_length // k, 1)
+        copy_ids = torch.where(tokens < chunk_size * k, tokens // chunk_size, torch.full_like(tokens, -1))
+    copy_ids = copy_ids.to(device)
+    in_copy = copy_ids >= 0
+    num_copies = int(copy_ids.max().item()) + 1 if in_copy.any() else 0
+
+    # Offset of each token inside its copy. Tokens outside the copies are compared with offset 0 and dropped from the
+    # (small) result, which is cheaper than gathering the hidden states
+    starts = torch.full((max(num_copies, 1),), seq_length, dtype=torch.long, device=device)
+    starts = starts.scatter_reduce(0, copy_ids[in_copy], tokens[in_copy], reduce="amin")
+    offsets = torch.where(in_copy, tokens - starts[copy_ids.clamp(min=0)], torch.zeros_like(tokens))
+    first_copy_length = max(int((copy_ids == 0).sum().item()), 1)
+    offsets = offsets.clamp(max=first_copy_length - 1)
+
+    if isinstance(all_hidden_states, torch.Tensor):
+        hidden_states = torch.cat([embedding_output.unsqueeze(0), all_hidden_states])
+    else:
+        layers = [embedding_output] + (list(all_hidden_states.values()) if all_hidden_states is not None else [])
+        hidden_states = torch.stack(layers)  # [layers, seq_len, hidden]
+
+    # The references (and their norms) only depend on the offset inside the copy: they are computed once for the first
+    # copy and broadcast to the other copies. Full-sequence references are cut down to the first copy
+    if word_embeds.shape[0] > first_copy_length:
+        word_embeds = word_embeds[int(starts[0]):int(starts[0]) + first_copy_length]
+    # Models without position embeddings (e.g. ALiBi) only get the word similarities
+    references = [word_embeds] if position_embeds is None else [position_embeds[:first_copy_length], word_embeds]
+    references = torch.stack(references)  # [2, first_copy_length, hidden]
+    reference_norms = torch.linalg.vector_norm(references, dim=-1)
+
+    # Dot products first, then divided by the norms: cheaper than materializing normalized copies of all layers
+    dots = torch.einsum("lth,rth->rlt", hidden_states, references[:, offsets])
+    norms = torch.linalg.vector_norm(hidden_states, dim=-1) * reference_norms[:, offsets][:, None]
     # cosine metric : (seq_len, layers)
-    cosine_positions = {k: torch.transpose(torch.stack(v), 0, 1).detach().cpu().numpy() for k, v in cosine_positions.items()}
-    cosine_words = {k: torch.transpose(torch.stack(v), 0, 1).detach().cpu().numpy() for k, v in cosine_words.items()}
+    similarities = (dots / norms.clamp(min=1e-8))[..., in_copy].transpose(1, 2).detach().float().cpu().numpy()
+
+    # Tokens of a copy are contiguous, split the host array per copy
+    boundaries = np.cumsum(torch.bincount(copy_ids[in_copy], minlength=num_copies).cpu().numpy())[:-1]
+    cosine_words = {f"word_sim_k={i + 1}": sim for i, sim in enumerate(np.split(similarities[-1], boundaries))}
+    cosine_positions = {} if position_embeds is None else {
+        f"pos_sim_k={i + 1}": sim for i, sim in enumerate(np.split(similarities[0], boundaries))}
 
     output = {'positions_cosine': cosine_positions, 'words_cosine': cosine_words}
 
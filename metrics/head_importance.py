@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# file: head_importance.py
+#
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+import pandas as pd
+import torch
+from transformers import PreTrainedModel
+
+HEAD_IMPORTANCE_METHODS = ("gradient", "entropy")
+
+
+def _heads_shape(model: PreTrainedModel):
+    config = model.config
+    return config.num_hidden_layers, config.num_attention_heads
+
+
+def _batch_inputs(batch: Dict[str, torch.Tensor], device: torch.device) -> Dict[str, torch.Tensor]:
+    keys = ("input_ids", "attention_mask", "token_type_ids", "labels")
+    return {key: value.to(device) for key, value in batch.items() if key in keys}
+
+
+def gradient_head_importance(model: PreTrainedModel, dataloader: Iterable[Dict[str, torch.Tensor]],
+                             device: Optional[torch.device] = None, normalize: bool = True) -> torch.Tensor:
+    """
+    Importance `[layers, heads]` of every attention head as the accumulated absolute gradient of the loss w.r.t. a
+    head mask of ones (Michel et al., Are Sixteen Heads Really Better than One?), i.e. the first-order change of the
+    dev loss when the head is masked. With `normalize`, the scores of each layer are divided by their L2 norm.
+    """
+    device = device if device is not None else model.device
+    head_mask = torch.ones(_heads_shape(model), device=device, requires_grad=True)
+    importance = torch.zeros_like(head_mask, dtype=torch.float64)
+    was_training = model.training
+    model.eval()
+    for batch in dataloader:
+        outputs = model(**_batch_inputs(batch, device), head_mask=head_mask)
+        outputs.loss.backward()
+        importance += head_mask.grad.detach().abs().double()
+        head_mask.grad = None
+    model.zero_grad(set_to_none=True)
+    model.train(was_training)
+    if normalize:
+        importance = importance / torch.linalg.vector_norm(importance, dim=-1, keepdim=True).clamp(min=1e-20)
+    return importance.float().cpu()
+
+
+@torch.no_grad()
+def entropy_head_importance(model: PreTrainedModel, dataloader: Iterable[Dict[str, torch.Tensor]],
+                            device: Optional[torch.device] = None) -> torch.Tensor:
+    """
+    Importance `[layers, heads]` of every attention head as its negated mean attention entropy over the non-padding
+    queries: heads that attend almost uniformly (high entropy) score lowest.
+    """
+    device = device if device is not None else model.device
+    entropy = torch.zeros(_heads_shape(model), dtype=torch.float64, device=device)
+    count = 0
+    for batch in dataloader:
+        inputs = _batch_inputs(batch, device)
+        inputs.pop("labels", None)
+        outputs = model(**inputs, output_attentions=True, return_dict=True)
+        mask = inputs["attention_mask"].bool()
+        for layer, probs in enumerate(outputs.attentions):
+            probs = probs.double()
+            layer_entropy = -torch.special.xlogy(probs, probs).sum(-1)  # [batch, heads, seq_len]
+            entropy[layer] += (layer_entropy * mask.unsqueeze(1)).sum((0, 2))
+        count += mask.sum().item()
+    return (-entropy / max(count, 1)).float().cpu()
+
+
+def head_importance(model: PreTrainedModel, dataloader: Iterable[Dict[str, torch.Tensor]], method: str = "gradient",
+                    device: Optional[torch.device] = None) -> torch.Tensor:
+    """Importance `[layers, heads]` of every attention head with one of `HEAD_IMPORTANCE_METHODS`."""
+    if method == "gradient":
+        return gradient_head_importance(model, dataloader, device=device)
+    if method == "entropy":
+        return entropy_head_importance(model, dataloader, device=device)
+    raise ValueError(f"Unknown head importance method {method}, choose one of {HEAD_IMPORTANCE_METHODS}")
+
+
+def heads_to_prune(importance: torch.Tensor, fraction: float, min_heads_per_layer: int = 1) -> Dict[int, List[int]]:
+    """
+    The `fraction` of least important heads over the whole model, as the `{layer: [heads]}` dict of `prune_heads`.
+    At least `min_heads_per_layer` heads are kept in every layer.
+    """
+    num_layers, num_heads = importance.shape
+    budget = int(round(fraction * num_layers * num_heads))
+    kept = [num_heads] * num_layers
+    pruned = {}
+    for index in torch.argsort(importance.flatten()).tolist():
+        if budget == 0:
+            break
+        layer, head = divmod(index, num_heads)
+        if kept[layer] <= min_heads_per_layer:
+            continue
+        pruned.setdefault(layer, []).append(head)
+        kept[layer] -= 1
+        budget -= 1
+    return {layer: sorted(heads) for layer, heads in sorted(pruned.items())}
+
+
+def importance_frame(importance: torch.Tensor, pruned: Optional[Dict[int, List[int]]] = None) -> pd.DataFrame:
+    """Long-format table of the importance per layer (1-based) and head, with the pruned heads flagged."""
+    num_layers, num_heads = importance.shape
+    layer, head = np.divmod(np.arange(num_layers * num_heads), num_heads)
+    pruned = pruned or {}
+    return pd.DataFrame({"layer": layer + 1, "head": head, "importance": importance.flatten().numpy(),
+                         "pruned": [h in pruned.get(l, ()) for l, h in zip(layer.tolist(), head.tolist())]})
@@ -43,6 +43,7 @@ from seqeval.metrics import classification_report, accuracy_score
 from seqeval.metrics.sequence_labeling import get_entities
 from seqeval.metrics.v1 import check_consistent_length
 
+from inference.decoding import label_scheme, viterbi_decode
 from plot_utils.plot import plot_pos_dist, plt
 
 # metric = load_metric("seqeval")
@@ -253,9 +254,48 @@ def _find_class_pos(labels, class_label):
     return inds
 
 
-def compute_ner_pos_f1(p, label_list):
+def continuation_subwords(input_ids, tokenizer):
+    """
+    Boolean mask of the tokens that continue the word of the previous token: "##" pieces of WordPiece vocabularies,
+    and pieces without a leading space marker ("Ġ" or "▁") of BPE/SentencePiece ones. Padding ids (-100) are False.
+    """
+    vocab = tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))
+    special = set(tokenizer.all_special_tokens)
+    if any(token.startswith("##") for token in vocab):
+        continuation = np.array([token.startswith("##") for token in vocab])
+    else:
+        continuation = np.array([not token.startswith(("Ġ", "▁")) and token not in special for token in vocab])
+    input_ids = np.asarray(input_ids)
+    return continuation[np.clip(input_ids, 0, len(vocab) - 1)] & (input_ids >= 0)
+
+
+def constrained_predictions(predictions_scores, labels, inputs, label_list, tokenizer):
+    """
+    Valid IOBES label ids (see `viterbi_decode`) of the words of each sequence: the sequence is decoded over the first
+    labeled subword of every word, and the other labeled subwords of a word (`label_all_tokens`) copy its label, as the
+    gold labels repeat the word's tag.
+    """
+    if inputs is None or tokenizer is None:
+        raise ValueError("Constrained decoding needs the input ids (include_inputs_for_metrics) and the tokenizer")
+    labels = np.asarray(labels)
+    labeled = labels != -100
+    # The first labeled token of a sequence always starts a word
+    word_starts = labeled & (~continuation_subwords(inputs, tokenizer) | (np.cumsum(labeled, axis=1) == 1))
+    scheme = label_scheme(dict(enumerate(label_list)))
+    predictions = viterbi_decode(predictions_scores, word_starts, scheme)
+    # Position of the word start of every token, in its sequence
+    positions = np.arange(labels.shape[1])
+    word_start_positions = np.maximum.accumulate(np.where(word_starts, positions, 0), axis=1)
+    word_predictions = np.take_along_axis(predictions, word_start_positions, axis=1)
+    return np.where(labeled & ~word_starts, word_predictions, predictions)
+
+
+def compute_ner_pos_f1(p, label_list, constrained=False, tokenizer=None):
     predictions_scores, labels, inputs = p
-    predictions = np.argmax(predictions_scores, axis=2)
+    if constrained:
+        predictions = constrained_predictions(predictions_scores, labels, inputs, label_list, tokenizer)
+    else:
+        predictions = np.argmax(predictions_scores, axis=2)
 
     # Remove ignored index (special tokens)
     true_predictions = [
@@ -303,9 +343,12 @@ def _chunk_sequences(seq, num):
     return out
 
 
-def ner_span_metrics(all_preds_scores, all_labels, all_inputs, label_list, k):
+def ner_span_metrics(all_preds_scores, all_labels, all_inputs, label_list, k, constrained=False, tokenizer=None):
     # predictions_scores, labels, inputs = p
-    all_preds = np.argmax(all_preds_scores, axis=2)
+    if constrained:
+        all_preds = constrained_predictions(all_preds_scores, all_labels, all_inputs, label_list, tokenizer)
+    else:
+        all_preds = np.argmax(all_preds_scores, axis=2)
 
     # Remove ignored index (special tokens)
     true_predictions = [
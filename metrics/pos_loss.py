@@ -2,12 +2,14 @@
 # -*- coding: utf-8 -*-
 # file: pos_loss.py
 #
-from typing import Optional, List, Union
+import os
+from typing import Dict, Optional, Tuple
 
+import numpy as np
+import pandas as pd
 import torch
 from torch import Tensor
 from torch.nn import CrossEntropyLoss, Module
-import torch.nn.functional as F
 
 
 class CrossEntropyLossPerPosition(Module):
@@ -18,41 +20,121 @@ class CrossEntropyLossPerPosition(Module):
                                         label_smoothing=label_smoothing,
                                         reduction="none")
 
+    def _token_losses(self, input: Tensor, target: Tensor) -> Tensor:
+        # One cross-entropy call over the flattened [B * L, C] logits
+        return self.ce_loss(input.reshape(-1, input.shape[-1]), target.reshape(-1)).view(target.shape)
+
     def forward(self, input: Tensor, target: Tensor) -> Tensor:
-        # Average losses per position (without counting zeros)
-        return torch.stack([self.ce_loss(input[i], target[i]) for i in range(input.shape[0])]).T
+        """Loss of every token `[L, B]` (zeros at ignored positions) of the `[B, L, C]` logits."""
+        return self._token_losses(input, target).T
 
+    def loss_and_per_position(self, input: Tensor, target: Tensor) -> Tuple[Tensor, Tensor]:
+        """
+        Mean cross-entropy (as `CrossEntropyLoss(reduction="mean")`) and the `[L, B]` losses per position from a
+        single cross-entropy call, so the logits are only read once.
+        """
+        token_losses = self._token_losses(input, target)
+        valid = target != self.ce_loss.ignore_index
+        if self.ce_loss.weight is None:
+            normalizer = valid.sum()
+        else:
+            normalizer = (self.ce_loss.weight[target.masked_fill(~valid, 0)] * valid).sum()
+        return token_losses.sum() / normalizer, token_losses.T
 
-def padded_stack(
-        tensors: List[torch.Tensor], side: str = "right", mode: str = "constant", value: Union[int, float] = 0
-) -> torch.Tensor:
-    """
-    Stack tensors along first dimension and pad them along last dimension to ensure their size is equal.
+    def packed(self, input: Tensor, target: Tensor) -> Tensor:
+        """
+        Loss of every token `[L, B]` from the `[num_labeled, C]` logits of the labeled tokens (`target !=
+        ignore_index`, in row-major order) of a model with `classify_labeled_only`.
+        """
+        valid = target != self.ce_loss.ignore_index
+        token_losses = input.new_zeros(target.shape)
+        token_losses[valid] = self.ce_loss(input, target[valid])
+        return token_losses.T
 
-    Args:
-        tensors (List[torch.Tensor]): list of tensors to stack
-        side (str): side on which to pad - "left" or "right". Defaults to "right".
-        mode (str): 'constant', 'reflect', 'replicate' or 'circular'. Default: 'constant'
-        value (Union[int, float]): value to use for constant padding
 
-    Returns:
-        torch.Tensor: stacked tensor
+class PositionLossStatistics(object):
     """
-    full_size = max([x.size(-1) for x in tensors])
+    Running statistics of the token losses per position, kept detached on the device of the losses.
 
-    def make_padding(pad):
-        if side == "left":
-            return (pad, 0)
-        elif side == "right":
-            return (0, pad)
-        else:
-            raise ValueError(f"side for padding '{side}' is unknown")
-
-    out = torch.stack(
-        [
-            F.pad(x, make_padding(full_size - x.size(-1)), mode=mode, value=value) if full_size - x.size(-1) > 0 else x
-            for x in tensors
-        ],
-        dim=0,
-    )
-    return out
+    Per position the count, sum and sum of squares of the losses are accumulated together with a histogram over
+    `bins` fixed bins on `[0, max_loss]` (larger losses fall in the last bin), so memory is O(max_length x bins)
+    whatever the number of steps. Call `reset()` to start a new epoch.
+    """
+
+    def __init__(self, max_length: int = 512, bins: int = 100, max_loss: float = 10.0,
+                 device: Optional[torch.device] = None):
+        self.max_length = max_length
+        self.bins = bins
+        self.max_loss = max_loss
+        self.device = device
+        self.reset()
+
+    def reset(self):
+        kwargs = {"dtype": torch.float64, "device": self.device}
+        self.count = torch.zeros(self.max_length, **kwargs)
+        self.sum = torch.zeros(self.max_length, **kwargs)
+        self.sum_squares = torch.zeros(self.max_length, **kwargs)
+        self.histogram = torch.zeros(self.max_length, self.bins, **kwargs)
+
+    def __len__(self):
+        return int(self.count.sum().item())
+
+    @torch.no_grad()
+    def update(self, losses: Tensor, mask: Tensor):
+        """Accumulate the token losses `[batch, seq_len]` where `mask` (e.g. `labels != -100`) is set."""
+        if self.count.device != losses.device:
+            self.device = losses.device
+            for name in ["count", "sum", "sum_squares", "histogram"]:
+                setattr(self, name, getattr(self, name).to(losses.device))
+        mask = mask.to(losses.device).bool()
+        positions = torch.arange(losses.shape[-1], device=losses.device).expand_as(losses)[mask]
+        positions = positions.clamp(max=self.max_length - 1)
+        values = losses.detach()[mask].to(torch.float64)
+        self.count.index_add_(0, positions, torch.ones_like(values))
+        self.sum.index_add_(0, positions, values)
+        self.sum_squares.index_add_(0, positions, values ** 2)
+        bins = (values * (self.bins / self.max_loss)).long().clamp(0, self.bins - 1)
+        self.histogram.view(-1).index_add_(0, positions * self.bins + bins, torch.ones_like(values))
+
+    def mean(self) -> Tensor:
+        return self.sum / self.count.clamp(min=1)
+
+    def std(self) -> Tensor:
+        variance = (self.sum_squares - self.count * self.mean() ** 2) / (self.count - 1).clamp(min=1)
+        return variance.clamp(min=0).sqrt()
+
+    def bin_centers(self) -> np.ndarray:
+        return (np.arange(self.bins) + 0.5) * (self.max_loss / self.bins)
+
+    def histogram_frame(self) -> pd.DataFrame:
+        """Long-format table of the non-empty histogram bins: position, loss (bin center) and count."""
+        histogram = self.histogram.cpu().numpy()
+        position, bin_ = np.nonzero(histogram)
+        return pd.DataFrame({"position": position, "loss": self.bin_centers()[bin_],
+                             "count": histogram[position, bin_].astype(np.int64)})
+
+    def summary_frame(self) -> pd.DataFrame:
+        """Count, mean and std of the loss per (non-empty) position."""
+        count = self.count.cpu().numpy()
+        position = np.nonzero(count)[0]
+        return pd.DataFrame({"position": position, "count": count[position].astype(np.int64),
+                             "mean": self.mean().cpu().numpy()[position],
+                             "std": self.std().cpu().numpy()[position]})
+
+    def export(self, output_dir: str, prefix: str = "train", format: str = "parquet") -> Dict[str, str]:
+        """
+        Write the `histogram_frame` and `summary_frame` tables to `<output_dir>/<prefix>_loss_{histogram,summary}`
+        as Parquet (requires pyarrow or fastparquet) or CSV for offline plotting. Returns `{table: path}`.
+        """
+        if format not in ["parquet", "csv"]:
+            raise ValueError(f"Unknown export format {format}, choose one of ['parquet', 'csv']")
+        os.makedirs(output_dir, exist_ok=True)
+        files = {}
+        for name, frame in [("histogram", self.histogram_frame()), ("summary", self.summary_frame())]:
+            path = os.path.join(output_dir, f"{prefix}_loss_{name}.{format}")
+            if format == "parquet":
+                frame.to_parquet(path, index=False)
+            else:
+                frame.to_csv(path, index=False)
+            files[name] = path
+        return files
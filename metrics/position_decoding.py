@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# file: position_decoding.py
+#
+import weakref
+from typing import Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn as nn
+
+# Normalized position tables, keyed by the position embedding module of each loaded checkpoint
+_NORMALIZED_TABLES = weakref.WeakKeyDictionary()
+
+
+def normalized_position_table(position_embeddings: Union[nn.Embedding, torch.Tensor]) -> torch.Tensor:
+    """
+    L2-normalized position embedding table `[num_positions, hidden]` in float32. The table of an `nn.Embedding` is
+    cached per module and only recomputed when its weights are updated in place or moved to another device.
+    """
+    if not isinstance(position_embeddings, nn.Embedding):
+        return _normalize(position_embeddings)
+    weight = position_embeddings.weight
+    key = (weight.device, weight.data_ptr(), weight._version)
+    cached = _NORMALIZED_TABLES.get(position_embeddings)
+    if cached is None or cached[0] != key:
+        cached = (key, _normalize(weight))
+        _NORMALIZED_TABLES[position_embeddings] = cached
+    return cached[1]
+
+
+def _normalize(table: torch.Tensor) -> torch.Tensor:
+    table = table.detach().float()
+    return table / torch.linalg.vector_norm(table, dim=-1, keepdim=True).clamp(min=1e-8)
+
+
+def position_cosine(hidden_states: torch.Tensor, position_table: torch.Tensor) -> torch.Tensor:
+    """
+    Cosine matrix `[..., tokens, num_positions]` between hidden states `[..., tokens, hidden]` and every row of a
+    normalized position table (see `normalized_position_table`): one matmul, divided by the hidden state norms.
+    """
+    if hidden_states.shape[-1] != position_table.shape[-1]:
+        raise ValueError(f"Hidden size {hidden_states.shape[-1]} does not match the position embedding size "
+                         f"{position_table.shape[-1]}")
+    hidden_states = hidden_states.float()
+    norms = torch.linalg.vector_norm(hidden_states, dim=-1, keepdim=True).clamp(min=1e-8)
+    return (hidden_states @ position_table.T) / norms
+
+
+@torch.no_grad()
+def decode_positions(hidden_states: torch.Tensor, position_table: torch.Tensor,
+                     positions: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Decode the position of every token as the most similar position embedding.
+
+    Returns the cosine matrix `[..., tokens, num_positions]`, the decoded (argmax) position and its error
+    `decoded - positions` `[..., tokens]`, and the cosine with the token's own position embedding `[..., tokens]`.
+    """
+    cosine = position_cosine(hidden_states, position_table)
+    decoded = cosine.argmax(-1)
+    positions = positions.clamp(max=position_table.shape[0] - 1).expand_as(decoded)
+    true_cosine = cosine.gather(-1, positions.unsqueeze(-1)).squeeze(-1)
+    return cosine, decoded, decoded - positions, true_cosine
+
+
+class PositionDecodingStatistics(object):
+    """
+    Streaming statistics of the position information left in the hidden states of every layer.
+
+    Each token is decoded against the whole position embedding table (`decode_positions`); per layer and true
+    position the following are accumulated:
+        - accuracy:         fraction of tokens whose decoded position is their position
+        - abs_error, error: mean absolute and signed error of the decoded position
+        - max_cosine:       mean cosine with the decoded position embedding
+        - true_cosine:      mean cosine with the token's own position embedding
+    together with the mean cosine profile over all positions (`cosine_matrix`). Memory is O(layers x max_length x
+    num_positions) whatever the number of evaluated sentences.
+    """
+    METRICS = ("accuracy", "abs_error", "error", "max_cosine", "true_cosine")
+
+    def __init__(self, position_embeddings: Union[nn.Embedding, torch.Tensor], num_layers: int,
+                 max_length: int = 512, device: Optional[torch.device] = None):
+        self.position_embeddings = position_embeddings
+        self.num_layers = num_layers
+        self.max_length = max_length
+        self.device = device
+        self.reset()
+
+    @property
+    def num_positions(self) -> int:
+        return normalized_position_table(self.position_embeddings).shape[0]
+
+    def reset(self):
+        kwargs = {"dtype": torch.float64, "device": self.device}
+        self.count = torch.zeros(self.max_length, **kwargs)
+        self.sums = torch.zeros(len(self.METRICS), self.num_layers, self.max_length, **kwargs)
+        self.cosine_sum = torch.zeros(self.num_layers, self.max_length, self.num_positions, **kwargs)
+
+    @torch.no_grad()
+    def update(self, hidden_states: Sequence[torch.Tensor], attention_mask: torch.Tensor,
+               position_ids: Optional[torch.Tensor] = None):
+        """
+        Accumulate the hidden states of all layers (`[batch, seq_len, hidden]` each, e.g. the `hidden_states` output
+        of the model, embedding output included) for the non-padding tokens. `position_ids` defaults to `0..L-1`.
+        """
+        mask = attention_mask.bool().to(self.count.device)
+        if position_ids is None:
+            position_ids = torch.arange(mask.shape[-1], device=mask.device).expand_as(mask)
+        positions = position_ids.to(mask.device)[mask]
+        bins = positions.clamp(max=self.max_length - 1)
+        table = normalized_position_table(self.position_embeddings).to(mask.device)
+
+        self.count.index_add_(0, bins, torch.ones_like(bins, dtype=torch.float64))
+        # One layer at a time: the cosine matrix of a layer is [tokens, num_positions]
+        for layer, layer_hidden_states in enumerate(hidden_states):
+            cosine, decoded, error, true_cosine = decode_positions(layer_hidden_states.to(mask.device)[mask], table,
+                                                                   positions)
+            max_cosine = cosine.gather(-1, decoded.unsqueeze(-1)).squeeze(-1)
+            values = torch.stack([(error == 0).double(), error.abs().double(), error.double(), max_cosine.double(),
+                                  true_cosine.double()])
+            self.sums[:, layer].index_add_(-1, bins, values)
+            self.cosine_sum[layer].index_add_(0, bins, cosine.double())
+
+    def summary(self) -> pd.DataFrame:
+        """Long-format table of the mean metrics per layer (0 is the embedding output) and true position."""
+        count = self.count.cpu().numpy()
+        means = (self.sums / self.count.clamp(min=1)).cpu().numpy()
+        layer, position = np.nonzero(np.broadcast_to(count > 0, means.shape[1:]))
+        frame = pd.DataFrame({"layer": layer, "position": position, "count": count[position].astype(np.int64)})
+        for i, metric in enumerate(self.METRICS):
+            frame[metric] = means[i, layer, position]
+        return frame
+
+    def cosine_matrix(self) -> np.ndarray:
+        """Mean cosine `[layers, max_length, num_positions]` between tokens at a position and every position
+        embedding (NaN for unseen positions)."""
+        count = self.count.cpu().numpy()
+        with np.errstate(invalid="ignore"):
+            return self.cosine_sum.cpu().numpy() / np.where(count > 0, count, np.nan)[None, :, None]
@@ -29,8 +29,20 @@ class BertSelfAttention(nn.Module):
         if self.position_embedding_type == "relative_key" or self.position_embedding_type == "relative_key_query":
             self.max_position_embeddings = config.max_position_embeddings
             self.distance_embedding = nn.Embedding(2 * config.max_position_embeddings - 1, self.attention_head_size)
+            # Relative scores are computed per distance and skewed into place instead of gathering an L x L x d
+            # tensor of distance embeddings; the distance indices are cached per sequence length.
+            self.relative_position_skew = True
+            self.relative_position_block_size = getattr(config, "relative_position_block_size", 64)
+            # Below this length the dense gather is small and its single einsum is faster than the blockwise matmuls
+            self.relative_position_skew_min_length = getattr(config, "relative_position_skew_min_length", 384)
+            self._distance_windows = {}
 
         self.is_decoder = config.is_decoder
+        # Dispatch to torch's fused scaled-dot-product attention (flash/memory-efficient kernels) when possible
+        self.fused_attention = getattr(config, "fused_attention", True) and hasattr(nn.functional,
+                                                                                    "scaled_dot_product_attention")
+        # Queries are processed in chunks of this many rows when the sequence is longer (None: no chunking)
+        self.attention_chunk_size = getattr(config, "attention_chunk_size", None)
 
     def transpose_for_scores(self, x: torch.Tensor) -> torch.Tensor:
         new_x_shape = x.size()[:-1] + (self.num_attention_heads, self.attention_head_size)
@@ -84,24 +96,46 @@ class BertSelfAttention(nn.Module):
             # if encoder bi-directional self-attention `past_key_value` is always `None`
             past_key_value = (key_layer, value_layer)
 
+        seq_length = query_layer.size()[-2]
+        if self.attention_chunk_size and seq_length > self.attention_chunk_size and not output_attentions:
+            # Query-chunked attention: only the [batch, heads, chunk, L] scores of one chunk are live at a time, so
+            # long inputs (e.g. with extended position embeddings) run with bounded memory
+            context_layer = torch.cat([
+                self._attend(query_layer[..., start:start + self.attention_chunk_size, :], key_layer, value_layer,
+                             _mask_rows(attention_mask, start, self.attention_chunk_size), head_mask,
+                             query_start=start)[0]
+                for start in range(0, seq_length, self.attention_chunk_size)], dim=-2)
+            return self._merge_outputs(context_layer, None, past_key_value, output_attentions)
+
+        context_layer, attention_probs = self._attend(query_layer, key_layer, value_layer, attention_mask, head_mask,
+                                                      output_attentions=output_attentions)
+        return self._merge_outputs(context_layer, attention_probs, past_key_value, output_attentions)
+
+    def _attend(self, query_layer: torch.Tensor, key_layer: torch.Tensor, value_layer: torch.Tensor,
+                attention_mask: Optional[torch.FloatTensor] = None, head_mask: Optional[torch.FloatTensor] = None,
+                query_start: int = 0, output_attentions: bool = False) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        """Context (and attention probabilities, None on the fused path) of the queries starting at `query_start`."""
+        if (
+                self.fused_attention
+                and self.position_embedding_type == "absolute"
+                and not output_attentions
+                and head_mask is None
+        ):
+            # Fast path: the attention matrix is never materialized, the explicit path below is only needed to
+            # return the attention probabilities for analysis or to apply relative positions and head masks.
+            context_layer = nn.functional.scaled_dot_product_attention(
+                query_layer, key_layer, value_layer,
+                attn_mask=attention_mask,
+                dropout_p=self.dropout.p if self.training else 0.0,
+            )
+            return context_layer, None
+
         # Take the dot product between "query" and "key" to get the raw attention scores.
         attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
 
         if self.position_embedding_type == "relative_key" or self.position_embedding_type == "relative_key_query":
-            seq_length = hidden_states.size()[1]
-            position_ids_l = torch.arange(seq_length, dtype=torch.long, device=hidden_states.device).view(-1, 1)
-            position_ids_r = torch.arange(seq_length, dtype=torch.long, device=hidden_states.device).view(1, -1)
-            distance = position_ids_l - position_ids_r
-            positional_embedding = self.distance_embedding(distance + self.max_position_embeddings - 1)
-            positional_embedding = positional_embedding.to(dtype=query_layer.dtype)  # fp16 compatibility
-
-            if self.position_embedding_type == "relative_key":
-                relative_position_scores = torch.einsum("bhld,lrd->bhlr", query_layer, positional_embedding)
-                attention_scores = attention_scores + relative_position_scores
-            elif self.position_embedding_type == "relative_key_query":
-                relative_position_scores_query = torch.einsum("bhld,lrd->bhlr", query_layer, positional_embedding)
-                relative_position_scores_key = torch.einsum("bhrd,lrd->bhlr", key_layer, positional_embedding)
-                attention_scores = attention_scores + relative_position_scores_query + relative_position_scores_key
+            attention_scores = attention_scores + self.relative_position_scores(query_layer, key_layer,
+                                                                                query_start=query_start)
 
         attention_scores = attention_scores / math.sqrt(self.attention_head_size)
         if attention_mask is not None:
@@ -120,7 +154,86 @@ class BertSelfAttention(nn.Module):
             attention_probs = attention_probs * head_mask
 
         context_layer = torch.matmul(attention_probs, value_layer)
-
+        return context_layer, attention_probs
+
+    def relative_position_scores(self, query_layer: torch.Tensor, key_layer: torch.Tensor,
+                                 query_start: int = 0) -> torch.Tensor:
+        """
+        Relative position scores `[batch, heads, Lq, L]` of "relative_key" (query-distance) and "relative_key_query"
+        (query-distance + key-distance) attention, for the queries at positions `query_start..query_start + Lq - 1`
+        (all of them by default, a chunk with query-chunked attention).
+
+        Queries (and keys) are processed in blocks of `relative_position_block_size` rows. A block of t rows only
+        needs the t + L - 1 distances it spans: their scores are computed with one matmul against that slice of the
+        distance embeddings and skewed into place, so neither the L x L x d distance embeddings nor a full
+        L x (2L - 1) score window is materialized. Sequences shorter than `relative_position_skew_min_length` use the
+        dense gather.
+        """
+        query_length, seq_length = query_layer.size()[-2], key_layer.size()[-2]
+        if not self.relative_position_skew or seq_length < self.relative_position_skew_min_length \
+                or query_start + query_length > seq_length:
+            return self._dense_relative_position_scores(query_layer, key_layer, query_start=query_start)
+
+        # window[c] embeds the distance (L - 1) - c, i.e. all distances of the sequence from L - 1 down to -(L - 1)
+        window = self.distance_embedding(self._distance_window(seq_length, query_layer.device))
+        window = window.to(dtype=query_layer.dtype)  # fp16 compatibility
+        flipped_window = window.flip(0)
+        block_size = self.relative_position_block_size
+
+        scores = query_layer.new_empty(query_layer.size()[:-1] + (seq_length,))
+        # Distances spanned by query rows [start, end): from end - 1 down to start - (L - 1)
+        for start in range(0, query_length, block_size):
+            end = min(start + block_size, query_length)
+            row_start, row_end = query_start + start, query_start + end
+            # score[l, r] = q_l . E[l - r]
+            scores[..., start:end, :] = self._skew(torch.matmul(
+                query_layer[..., start:end, :],
+                window[seq_length - row_end:2 * seq_length - 1 - row_start].transpose(0, 1)))
+        if self.position_embedding_type == "relative_key_query":
+            # Distances between key rows [start, end) and the queries: from query_start - (end - 1) up
+            query_end = query_start + query_length
+            for start in range(0, seq_length, block_size):
+                end = min(start + block_size, seq_length)
+                # score[l, r] += k_r . E[l - r], skewed per key row then transposed
+                scores[..., :, start:end] += self._skew(torch.matmul(
+                    key_layer[..., start:end, :],
+                    flipped_window[seq_length + query_start - end:seq_length + query_end - 1 - start].transpose(0, 1)
+                )).transpose(-1, -2)
+        return scores
+
+    def _distance_window(self, seq_length: int, device: torch.device) -> torch.Tensor:
+        key = (seq_length, device)
+        if key not in self._distance_windows:
+            self._distance_windows[key] = torch.arange(seq_length - 1, -seq_length, -1, dtype=torch.long,
+                                                       device=device) + self.max_position_embeddings - 1
+        return self._distance_windows[key]
+
+    @staticmethod
+    def _skew(x: torch.Tensor) -> torch.Tensor:
+        """View `[..., t, t + L - 1]` as `[..., t, L]` with `out[..., i, j] = x[..., i, (t - 1) - i + j]` (no copy)."""
+        x = x.contiguous()
+        rows, columns = x.size()[-2:]
+        return x.as_strided(size=x.size()[:-1] + (columns - rows + 1,),
+                            stride=x.stride()[:-2] + (x.stride(-2) - 1, 1),
+                            storage_offset=x.storage_offset() + rows - 1)
+
+    def _dense_relative_position_scores(self, query_layer: torch.Tensor, key_layer: torch.Tensor,
+                                        query_start: int = 0) -> torch.Tensor:
+        query_length, seq_length = query_layer.size()[-2], key_layer.size()[-2]
+        position_ids_l = torch.arange(query_start, query_start + query_length, dtype=torch.long,
+                                      device=query_layer.device).view(-1, 1)
+        position_ids_r = torch.arange(seq_length, dtype=torch.long, device=query_layer.device).view(1, -1)
+        distance = position_ids_l - position_ids_r
+        positional_embedding = self.distance_embedding(distance + self.max_position_embeddings - 1)
+        positional_embedding = positional_embedding.to(dtype=query_layer.dtype)  # fp16 compatibility
+
+        relative_position_scores = torch.einsum("bhld,lrd->bhlr", query_layer, positional_embedding)
+        if self.position_embedding_type == "relative_key_query":
+            relative_position_scores_key = torch.einsum("bhrd,lrd->bhlr", key_layer, positional_embedding)
+            relative_position_scores = relative_position_scores + relative_position_scores_key
+        return relative_position_scores
+
+    def _merge_outputs(self, context_layer, attention_probs, past_key_value, output_attentions):
         context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
         new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
         context_layer = context_layer.view(new_context_layer_shape)
@@ -129,4 +242,11 @@ class BertSelfAttention(nn.Module):
 
         if self.is_decoder:
             outputs = outputs + (past_key_value,)
-        return outputs
\ No newline at end of file
+        return outputs
+
+
+def _mask_rows(attention_mask: Optional[torch.Tensor], start: int, size: int) -> Optional[torch.Tensor]:
+    """Rows of an additive attention mask for a chunk of queries (broadcast masks `[.., 1, L]` are kept)."""
+    if attention_mask is None or attention_mask.size(-2) == 1:
+        return attention_mask
+    return attention_mask[..., start:start + size, :]
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# file: classifier_head.py
+#
+from typing import Optional, Tuple
+
+import torch
+from torch.nn import CrossEntropyLoss
+
+
+class LabeledOnlyClassifierMixin(object):
+    """
+    Token classification head of the models with `classify_labeled_only`, shared by the BERT and ELECTRA classifiers
+    (which define `dropout`, `classifier`, `num_labels` and `scatter_logits`).
+    """
+
+    def _classify_labeled_only(self, sequence_output: torch.Tensor, attention_mask: Optional[torch.Tensor] = None,
+                               labels: Optional[torch.Tensor] = None) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        """
+        Dropout, classifier and loss on the valid tokens only: labeled tokens (`labels != -100`) if labels are given,
+        else non-padding tokens. Padding and ignored subwords are never classified, which saves most of the head's
+        compute and activations with `max_length` padding.
+
+        Returns the `[num_valid, num_labels]` logits in training, or the `[batch, seq_len, num_labels]` logits with
+        zeros at the skipped positions in eval mode or when `scatter_logits` is set.
+        """
+        if labels is not None:
+            valid = labels != -100
+        elif attention_mask is not None:
+            valid = attention_mask.bool()
+        else:
+            valid = torch.ones(sequence_output.shape[:-1], dtype=torch.bool, device=sequence_output.device)
+        logits = self.classifier(self.dropout(sequence_output[valid]))
+
+        loss = None
+        if labels is not None:
+            loss_fct = CrossEntropyLoss()
+            loss = loss_fct(logits, labels[valid])
+
+        if not self.training or self.scatter_logits:
+            scattered = logits.new_zeros(sequence_output.shape[:-1] + (self.num_labels,))
+            scattered[valid] = logits
+            logits = scattered
+        return logits, loss
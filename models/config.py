@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 # file: config.py
 #
-from transformers import BertConfig
+from transformers import BertConfig, BloomConfig, ElectraConfig
 
 
 class BertForTokenClassificationConfig(BertConfig):
@@ -13,3 +13,28 @@ class BertForTokenClassificationConfig(BertConfig):
         self.truncated_normal = kwargs.get("truncated_normal", False)
         self.position_embedding_type = kwargs.get("position_embedding_type", "absolute")
         self.watch_attentions = kwargs.get("watch_attentions", False)
+        self.attention_capture = kwargs.get("attention_capture", "float32")
+        self.attention_topk = kwargs.get("attention_topk", 8)
+        self.fused_attention = kwargs.get("fused_attention", False)
+        self.attention_chunk_size = kwargs.get("attention_chunk_size", None)
+        self.position_extension = kwargs.get("position_extension", "none")
+        self.extended_max_position_embeddings = kwargs.get("extended_max_position_embeddings", None)
+        self.classify_labeled_only = kwargs.get("classify_labeled_only", False)
+
+
+class ElectraForTokenClassificationConfig(ElectraConfig):
+    def __init__(self, **kwargs):
+        super(ElectraForTokenClassificationConfig, self).__init__(**kwargs)
+        self.position_embedding_type = kwargs.get("position_embedding_type", "absolute")
+        self.watch_attentions = kwargs.get("watch_attentions", False)
+        self.attention_capture = kwargs.get("attention_capture", "float32")
+        self.attention_topk = kwargs.get("attention_topk", 8)
+        self.classify_labeled_only = kwargs.get("classify_labeled_only", False)
+
+
+class BloomForTokenClassificationConfig(BloomConfig):
+    def __init__(self, **kwargs):
+        super(BloomForTokenClassificationConfig, self).__init__(**kwargs)
+        self.watch_attentions = kwargs.get("watch_attentions", False)
+        self.attention_capture = kwargs.get("attention_capture", "float32")
+        self.attention_topk = kwargs.get("attention_topk", 8)
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# file: dissection.py
+#
+import math
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple, Type
+
+import torch
+import torch.nn as nn
+from transformers import PreTrainedModel, apply_chunking_to_forward
+from transformers.utils import ModelOutput
+
+from metrics.attention_stats import AttentionStatistics
+from metrics.attention_store import capture_attention
+from metrics.cosine_similartiy import cosine_similarity, copy_ids_from_spans
+from models.attention import BertSelfAttention
+
+DISSECTION_ADAPTERS: Dict[str, Type["DissectionAdapter"]] = {}
+
+
+def register_adapter(*model_types: str):
+    """Class decorator registering a `DissectionAdapter` for the given `config.model_type`s."""
+
+    def decorator(adapter_class):
+        for model_type in model_types:
+            DISSECTION_ADAPTERS[model_type] = adapter_class
+        return adapter_class
+
+    return decorator
+
+
+def get_adapter(model: PreTrainedModel) -> "DissectionAdapter":
+    model_type = model.config.model_type
+    if model_type not in DISSECTION_ADAPTERS:
+        raise ValueError(f"No dissection adapter for model type {model_type}, choose one of "
+                         f"{list(DISSECTION_ADAPTERS)} or register one with `register_adapter`")
+    return DISSECTION_ADAPTERS[model_type](model)
+
+
+@dataclass
+class DissectionOutput(ModelOutput):
+    """
+    Output of `dissect`. `cosine` and `attention_maps` hold one entry per sequence of the batch, in the formats of
+    `cosine_similarity` and `AttentionStoreWriter.append`; attention maps are empty with `attention_capture="none"`.
+    """
+    last_hidden_state: torch.FloatTensor = None
+    hidden_states: Optional[Tuple[torch.FloatTensor]] = None
+    attentions: Optional[Tuple[torch.FloatTensor]] = None
+    cosine: Optional[List[Dict[str, Dict[str, Any]]]] = None
+    attention_maps: Optional[List[Dict[str, Dict[str, Any]]]] = None
+
+
+class DissectionAdapter(object):
+    """
+    Architecture-specific steps of the dissected forward pass. The engine (`dissect`) only sees attention scores
+    `[batch, heads, L, L]` and values `[batch, heads, L, head_size]`, the adapter computes them from the hidden
+    states of a layer and turns the attention context back into the layer output.
+    """
+
+    def __init__(self, model: PreTrainedModel):
+        self.model = model
+        self.base_model = model.base_model
+
+    def layers(self) -> nn.ModuleList:
+        raise NotImplementedError
+
+    def embed(self, input_ids, token_type_ids, position_ids, inputs_embeds) -> torch.Tensor:
+        raise NotImplementedError
+
+    def attention_bias(self, attention_mask: torch.Tensor, hidden_states: torch.Tensor):
+        """Whatever `self_attention` needs to mask (and bias) the scores, computed once for all layers."""
+        raise NotImplementedError
+
+    def self_attention(self, layer: nn.Module, hidden_states: torch.Tensor,
+                       attention_bias) -> Tuple[torch.Tensor, torch.Tensor, Any]:
+        """Masked attention scores, values and the state needed by `layer_output` (e.g. the residual)."""
+        raise NotImplementedError
+
+    def attention_dropout(self, layer: nn.Module, attention_probs: torch.Tensor) -> torch.Tensor:
+        raise NotImplementedError
+
+    def layer_output(self, layer: nn.Module, context: torch.Tensor, state) -> torch.Tensor:
+        """Layer output from the attention context `[batch, L, hidden]`."""
+        raise NotImplementedError
+
+    def final_hidden_states(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        return hidden_states
+
+    def reference_embeddings(self, input_ids: torch.Tensor) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        """Word and position embeddings `[L, hidden]` the hidden states of a sequence are compared with (position
+        embeddings are None for models without them)."""
+        raise NotImplementedError
+
+
+@register_adapter("bert", "electra")
+class AbsolutePositionAdapter(DissectionAdapter):
+    """BERT-like encoders with (absolute or relative) position embeddings: BERT and ELECTRA."""
+
+    def layers(self) -> nn.ModuleList:
+        return self.base_model.encoder.layer
+
+    def embed(self, input_ids, token_type_ids, position_ids, inputs_embeds) -> torch.Tensor:
+        embedding_output = self.base_model.embeddings(input_ids=input_ids, position_ids=position_ids,
+                                                      token_type_ids=token_type_ids, inputs_embeds=inputs_embeds)
+        if hasattr(self.base_model, "embeddings_project"):
+            embedding_output = self.base_model.embeddings_project(embedding_output)
+        return embedding_output
+
+    def attention_bias(self, attention_mask: torch.Tensor, hidden_states: torch.Tensor):
+        return self.base_model.get_extended_attention_mask(attention_mask, attention_mask.shape)
+
+    def self_attention(self, layer: nn.Module, hidden_states: torch.Tensor, attention_bias):
+        attention = layer.attention.self
+        query_layer = attention.transpose_for_scores(attention.query(hidden_states))
+        key_layer = attention.transpose_for_scores(attention.key(hidden_states))
+        value_layer = attention.transpose_for_scores(attention.value(hidden_states))
+
+        attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
+        if attention.position_embedding_type in ["relative_key", "relative_key_query"]:
+            if isinstance(attention, BertSelfAttention):
+                attention_scores = attention_scores + attention.relative_position_scores(query_layer, key_layer)
+            else:
+                attention_scores = attention_scores + BertSelfAttention._dense_relative_position_scores(
+                    attention, query_layer, key_layer)
+        attention_scores = attention_scores / math.sqrt(attention.attention_head_size)
+        return attention_scores + attention_bias, value_layer, hidden_states
+
+    def attention_dropout(self, layer: nn.Module, attention_probs: torch.Tensor) -> torch.Tensor:
+        return layer.attention.self.dropout(attention_probs)
+
+    def layer_output(self, layer: nn.Module, context: torch.Tensor, state) -> torch.Tensor:
+        attention_output = layer.attention.output(context, state)
+        return apply_chunking_to_forward(layer.feed_forward_chunk, layer.chunk_size_feed_forward, layer.seq_len_dim,
+                                         attention_output)
+
+    def reference_embeddings(self, input_ids: torch.Tensor) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        embeddings = self.base_model.embeddings
+        position_ids = torch.arange(input_ids.shape[-1], dtype=torch.long, device=input_ids.device)
+        word_embeds = embeddings.word_embeddings(input_ids)
+        position_embeds = embeddings.position_embeddings(position_ids)
+        if hasattr(self.base_model, "embeddings_project"):
+            # ELECTRA with embedding_size != hidden_size: compare in the hidden space of the encoder
+            word_embeds = self.base_model.embeddings_project(word_embeds)
+            position_embeds = self.base_model.embeddings_project(position_embeds)
+        return word_embeds, position_embeds
+
+
+@register_adapter("bloom")
+class AlibiAdapter(DissectionAdapter):
+    """BLOOM: pre-LayerNorm causal decoder whose positions are an ALiBi bias on the attention scores."""
+
+    def layers(self) -> nn.ModuleList:
+        return self.base_model.h
+
+    def embed(self, input_ids, token_type_ids, position_ids, inputs_embeds) -> torch.Tensor:
+        if inputs_embeds is None:
+            inputs_embeds = self.base_model.word_embeddings(input_ids)
+        return self.base_model.word_embeddings_layernorm(inputs_embeds)
+
+    def attention_bias(self, attention_mask: torch.Tensor, hidden_states: torch.Tensor):
+        from transformers.models.bloom.modeling_bloom import build_alibi_tensor
+
+        batch_size, seq_length = attention_mask.shape
+        alibi = build_alibi_tensor(attention_mask, self.base_model.num_heads, dtype=hidden_states.dtype)
+        # [batch, 1, L, L], True where a query may not attend: future tokens and padding
+        future = torch.ones(seq_length, seq_length, dtype=torch.bool, device=attention_mask.device).triu(1)
+        causal_mask = future[None, None] | (attention_mask[:, None, None, :] == 0)
+        return alibi.view(batch_size, self.base_model.num_heads, 1, seq_length), causal_mask
+
+    def self_attention(self, layer: nn.Module, hidden_states: torch.Tensor, attention_bias):
+        alibi, causal_mask = attention_bias
+        attention = layer.self_attention
+        layernorm_output = layer.input_layernorm(hidden_states)
+        residual = layernorm_output if layer.apply_residual_connection_post_layernorm else hidden_states
+
+        # 3 x [batch, heads, L, head_dim]
+        query_layer, key_layer, value_layer = [x.transpose(1, 2) for x in
+                                               attention._split_heads(attention.query_key_value(layernorm_output))]
+        attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2)) * attention.inv_norm_factor
+        attention_scores = attention_scores + attention.beta * alibi
+        attention_scores = attention_scores.float().masked_fill(causal_mask, torch.finfo(torch.float32).min)
+        return attention_scores, value_layer, residual
+
+    def attention_dropout(self, layer: nn.Module, attention_probs: torch.Tensor) -> torch.Tensor:
+        return layer.self_attention.attention_dropout(attention_probs)
+
+    def layer_output(self, layer: nn.Module, context: torch.Tensor, state) -> torch.Tensor:
+        from transformers.models.bloom.modeling_bloom import dropout_add
+
+        attention = layer.self_attention
+        attention_output = dropout_add(attention.dense(context), state, attention.hidden_dropout,
+                                       attention.training)
+        layernorm_output = layer.post_attention_layernorm(attention_output)
+        residual = layernorm_output if layer.apply_residual_connection_post_layernorm else attention_output
+        return layer.mlp(layernorm_output, residual)
+
+    def final_hidden_states(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        return self.base_model.ln_f(hidden_states)
+
+    def reference_embeddings(self, input_ids: torch.Tensor) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        return self.base_model.word_embeddings(input_ids), None
+
+
+def dissect(
+        model: PreTrainedModel,
+        input_ids: Optional[torch.Tensor] = None,
+        attention_mask: Optional[torch.Tensor] = None,
+        token_type_ids: Optional[torch.Tensor] = None,
+        position_ids: Optional[torch.Tensor] = None,
+        head_mask: Optional[torch.Tensor] = None,
+        inputs_embeds: Optional[torch.Tensor] = None,
+        output_attentions: bool = False,
+        output_hidden_states: bool = False,
+        k: Optional[List] = None,
+        attention_statistics: Optional[AttentionStatistics] = None,
+        copy_spans: Optional[List] = None,
+        attention_capture: Optional[str] = None,
+        attention_topk: Optional[int] = None,
+) -> DissectionOutput:
+    """
+    Forward pass of a whole batch through the encoder of `model`, exposing the attention scores/probabilities and
+    the hidden states of every layer. For each sequence, the tokens between the first and the last one ([CLS] and
+    [SEP]) are analysed: attention maps are captured (`attention_capture`, `attention_topk`, defaults from the
+    model), attention statistics are accumulated, and the hidden states are compared with the word and position
+    embeddings (`cosine_similarity`) per k-copy (`k` as collated from the dataset, `[[k], ...]`, or `copy_spans`);
+    the similarities need `input_ids`.
+    """
+    adapter = get_adapter(model)
+    attention_capture = attention_capture if attention_capture is not None else getattr(model, "attention_capture",
+                                                                                         "float32")
+    attention_topk = attention_topk if attention_topk is not None else getattr(model, "attention_topk", 8)
+
+    if input_ids is not None and inputs_embeds is not None:
+        raise ValueError("You cannot specify both input_ids and inputs_embeds at the same time")
+    elif input_ids is not None:
+        input_shape = input_ids.size()
+    elif inputs_embeds is not None:
+        input_shape = inputs_embeds.size()[:-1]
+    else:
+        raise ValueError("You have to specify either input_ids or inputs_embeds")
+    batch_size, seq_length = input_shape
+    device = input_ids.device if input_ids is not None else inputs_embeds.device
+    if attention_mask is None:
+        attention_mask = torch.ones(input_shape, dtype=torch.long, device=device)
+    k = k if k is not None else [[1]] * batch_size
+
+    head_mask = model.get_head_mask(head_mask, len(adapter.layers()))
+
+    # Analysed tokens of each sequence: [first + 1, last) without the first ([CLS]) and last ([SEP]) tokens
+    lengths = attention_mask.sum(-1)
+    first = attention_mask.int().argmax(-1)
+    spans = [(start + 1, start + length - 1) for start, length in zip(first.tolist(), lengths.tolist())]
+    # Copy of every token in duplicated sequences: from the processor's boundaries if given, else k equal chunks
+    copy_ids = copy_ids_from_spans(copy_spans, seq_length, device=device,
+                                   offsets=first.tolist()) if copy_spans is not None else None
+
+    hidden_states = adapter.embed(input_ids, token_type_ids, position_ids, inputs_embeds)
+    attention_bias = adapter.attention_bias(attention_mask, hidden_states)
+    layer_states = [hidden_states]
+    all_self_attentions = () if output_attentions else None
+    attention_maps = [{"attention_probs": {}, "attention_scores": {}} for _ in range(batch_size)]
+    for i, layer in enumerate(adapter.layers()):
+        attention_scores, value_layer, state = adapter.self_attention(layer, hidden_states, attention_bias)
+        attention_probs = nn.functional.softmax(attention_scores, dim=-1, dtype=torch.float32).to(value_layer.dtype)
+        attention_probs = adapter.attention_dropout(layer, attention_probs)
+
+        if attention_capture != "none":
+            for b, (start, end) in enumerate(spans):
+                for kind, attention in [("attention_probs", attention_probs), ("attention_scores", attention_scores)]:
+                    attention_maps[b][kind][f"layer_{i + 1}"] = capture_attention(
+                        attention[b, :, start:end, start:end], capture=attention_capture, topk=attention_topk,
+                        kind=kind)
+        if attention_statistics is not None:
+            attention_statistics.update(i, attention_probs, attention_mask, k=k[0][0], copy_ids=copy_ids)
+
+        # Mask heads if we want to
+        if head_mask[i] is not None:
+            attention_probs = attention_probs * head_mask[i]
+
+        context_layer = torch.matmul(attention_probs, value_layer).permute(0, 2, 1, 3).flatten(2)
+        hidden_states = adapter.layer_output(layer, context_layer, state)
+        layer_states.append(hidden_states)
+        if output_attentions:
+            all_self_attentions = all_self_attentions + (attention_probs,)
+    sequence_output = adapter.final_hidden_states(hidden_states)
+
+    # Cosine similarity of the embedding output and every layer output with the word/position embeddings, per k
+    stacked_states = torch.stack(layer_states)  # [layers + 1, batch, L, hidden]
+    cosine = [] if input_ids is not None else None
+    for b, (start, end) in enumerate(spans if input_ids is not None else []):
+        sequence_states = stacked_states[:, b, start:end]
+        sequence_copy_ids = copy_ids[b, start:end] if copy_ids is not None else None
+        # Copies repeat the same tokens: the reference embeddings are only looked up (and projected) for the first one
+        if sequence_copy_ids is not None:
+            first_copy = (sequence_copy_ids == 0).nonzero().flatten()
+            first_start, first_length = (int(first_copy[0]), len(first_copy)) if len(first_copy) else (0, 1)
+        else:
+            first_start, first_length = 0, max((end - start) // k[b][0], 1)
+        word_embeds, position_embeds = adapter.reference_embeddings(
+            input_ids[b, start + first_start:start + first_start + first_length])
+        cosine.append(cosine_similarity(word_embeds=word_embeds, position_embeds=position_embeds,
+                                        embedding_output=sequence_states[0], all_hidden_states=sequence_states[1:],
+                                        k=k[b][0], copy_ids=sequence_copy_ids))
+
+    return DissectionOutput(
+        last_hidden_state=sequence_output,
+        hidden_states=tuple(layer_states[:-1]) + (sequence_output,) if output_hidden_states else None,
+        attentions=all_self_attentions,
+        cosine=cosine,
+        attention_maps=attention_maps,
+    )
@@ -1,23 +1,31 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 # file: bert_ner.py
-import math
 from typing import Optional, Union, Tuple, List
 
 import torch
 import torch.nn as nn
 from torch.nn import CrossEntropyLoss
-from transformers import ElectraPreTrainedModel, ElectraModel, apply_chunking_to_forward
-from transformers.modeling_outputs import TokenClassifierOutput, BaseModelOutput
+from transformers import ElectraPreTrainedModel, ElectraModel
+from transformers.modeling_outputs import TokenClassifierOutput
 
-from metrics.cosine_similartiy import cosine_similarity
+from metrics.attention_stats import AttentionStatistics
+from models.classifier_head import LabeledOnlyClassifierMixin
+from models.dissection import dissect
+from models.quantization import quantize_dynamic_int8, save_quantized, load_quantized
 
 
-class ElectraForTokenClassification(ElectraPreTrainedModel):
+class ElectraForTokenClassification(LabeledOnlyClassifierMixin, ElectraPreTrainedModel):
     def __init__(self, config):
         super().__init__(config)
         self.num_labels = config.num_labels
         self.watch_attentions = config.watch_attentions
+        self.attention_capture = getattr(config, "attention_capture", "float32")
+        self.attention_topk = getattr(config, "attention_topk", 8)
+        # Only run the classifier (and the loss) on labeled tokens, logits are scattered back in eval mode or when
+        # `scatter_logits` is set
+        self.classify_labeled_only = getattr(config, "classify_labeled_only", False)
+        self.scatter_logits = False
         self.electra = ElectraModel(config)
         classifier_dropout = (
             config.classifier_dropout if config.classifier_dropout is not None else config.hidden_dropout_prob
@@ -62,25 +70,40 @@ class ElectraForTokenClassification(ElectraPreTrainedModel):
 
         discriminator_sequence_output = discriminator_hidden_states[0]
 
-        discriminator_sequence_output = self.dropout(discriminator_sequence_output)
-        logits = self.classifier(discriminator_sequence_output)
+        if self.classify_labeled_only:
+            logits, loss = self._classify_labeled_only(discriminator_sequence_output, attention_mask, labels)
+        else:
+            discriminator_sequence_output = self.dropout(discriminator_sequence_output)
+            logits = self.classifier(discriminator_sequence_output)
 
-        loss = None
-        if labels is not None:
-            loss_fct = CrossEntropyLoss()
-            loss = loss_fct(logits.view(-1, self.num_labels), labels.view(-1))
+            loss = None
+            if labels is not None:
+                loss_fct = CrossEntropyLoss()
+                loss = loss_fct(logits.view(-1, self.num_labels), labels.view(-1))
 
         if not return_dict:
-            output = (logits,) + discriminator_sequence_output[1:]
+            output = (logits,) + discriminator_hidden_states[1:]
             return ((loss,) + output) if loss is not None else output
 
         return TokenClassifierOutput(
             loss=loss,
             logits=logits,
-            hidden_states=discriminator_sequence_output.hidden_states,
-            attentions=discriminator_sequence_output.attentions,
+            hidden_states=discriminator_hidden_states.hidden_states,
+            attentions=discriminator_hidden_states.attentions,
         )
 
+    def quantize_dynamic(self, inplace: bool = False):
+        """Int8 dynamically quantized copy of the model (encoder and classifier Linear layers) for CPU inference."""
+        return quantize_dynamic_int8(self, inplace=inplace)
+
+    def save_quantized(self, path: str):
+        """Save a model returned by `quantize_dynamic`, reload it with `from_quantized`."""
+        save_quantized(self, path)
+
+    @classmethod
+    def from_quantized(cls, path: str, **kwargs):
+        return load_quantized(cls, path, **kwargs)
+
     def dissected_feed_forward(
             self,
             input_ids: Optional[torch.Tensor] = None,
@@ -92,168 +115,21 @@ class ElectraForTokenClassification(ElectraPreTrainedModel):
             output_attentions: Optional[bool] = None,
             output_hidden_states: Optional[bool] = None,
             return_dict: Optional[bool] = None,
-            k: Optional[List] = None
+            k: Optional[List] = None,
+            attention_statistics: Optional[AttentionStatistics] = None,
+            copy_spans: Optional[List] = None
     ):
-        output_attentions = output_attentions if output_attentions is not None else self.electra.config.output_attentions
+        """Batched analysis forward pass of `models.dissection.dissect`, returns a `DissectionOutput` (or its tuple
+        `(last_hidden_state, [hidden_states], [attentions], cosine, attention_maps)` with one cosine/attention entry
+        per sequence)."""
+        output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
-            output_hidden_states if output_hidden_states is not None else self.electra.config.output_hidden_states
-        )
-        return_dict = return_dict if return_dict is not None else self.electra.config.use_return_dict
-
-        if input_ids is not None and inputs_embeds is not None:
-            raise ValueError("You cannot specify both input_ids and inputs_embeds at the same time")
-        elif input_ids is not None:
-            input_shape = input_ids.size()
-        elif inputs_embeds is not None:
-            input_shape = inputs_embeds.size()[:-1]
-        else:
-            raise ValueError("You have to specify either input_ids or inputs_embeds")
-
-        batch_size, seq_length = input_shape
-        device = input_ids.device if input_ids is not None else inputs_embeds.device
-
-        # past_key_values_length
-        past_key_values_length = 0
-
-        if attention_mask is None:
-            attention_mask = torch.ones(((batch_size, seq_length + past_key_values_length)), device=device)
-
-        if token_type_ids is None:
-            if hasattr(self.electra.embeddings, "token_type_ids"):
-                buffered_token_type_ids = self.electra.embeddings.token_type_ids[:, :seq_length]
-                buffered_token_type_ids_expanded = buffered_token_type_ids.expand(batch_size, seq_length)
-                token_type_ids = buffered_token_type_ids_expanded
-            else:
-                token_type_ids = torch.zeros(input_shape, dtype=torch.long, device=device)
-
-        # We can provide a self-attention mask of dimensions [batch_size, from_seq_length, to_seq_length]
-        # ourselves in which case we just need to make it broadcastable to all heads.
-        extended_attention_mask: torch.Tensor = self.electra.get_extended_attention_mask(attention_mask, input_shape)
-
-        # Prepare head mask if needed
-        # 1.0 in head_mask indicate we keep the head
-        # attention_probs has shape bsz x n_heads x N x N
-        # input head_mask has shape [num_heads] or [num_hidden_layers x num_heads]
-        # and head_mask is converted to shape [num_hidden_layers x batch x num_heads x seq_length x seq_length]
-        head_mask = self.electra.get_head_mask(head_mask, self.config.num_hidden_layers)
-
-        embedding_output = self.electra.embeddings(
-            input_ids=input_ids,
-            position_ids=position_ids,
-            token_type_ids=token_type_ids,
-            inputs_embeds=inputs_embeds,
-            past_key_values_length=past_key_values_length,
-        )
-
-        if hasattr(self.electra, "embeddings_project"):
-            embedding_output = self.electra.embeddings_project(embedding_output)
-
-        # Dissected Encoder code (Start)
-        sequence_mask = attention_mask.squeeze(0) == 1
-        sequence_mask[0] = sequence_mask[attention_mask.sum().item() - 1] = False  # [CLS] and [SEP] tokens
-        hidden_states = embedding_output
-        all_hidden_states = () if output_hidden_states else None
-        all_self_attentions = () if output_attentions else None
-        attn_dict = {"attention_probs": {}, "attention_scores": {}}
-        embs_dict = {}
-        for i, layer_module in enumerate(self.electra.encoder.layer):
-            if output_hidden_states:
-                all_hidden_states = all_hidden_states + (hidden_states,)
-            layer_head_mask = head_mask[i] if head_mask is not None else None
-            # Dissected BertLayer code (Start)
-
-            # Dissected BertAttention code (Start)
-            # Dissected SelfAttention code (Start)
-            mixed_query_layer = layer_module.attention.self.query(hidden_states)
-            query_layer = layer_module.attention.self.transpose_for_scores(mixed_query_layer)
-            key_layer = layer_module.attention.self.transpose_for_scores(layer_module.attention.self.key(hidden_states))
-            value_layer = layer_module.attention.self.transpose_for_scores(
-                layer_module.attention.self.value(hidden_states))
-
-            # Take the dot product between "query" and "key" to get the raw attention scores.
-            self_attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
-            self_attention_scores = self_attention_scores / math.sqrt(layer_module.attention.self.attention_head_size)
-            if extended_attention_mask is not None:
-                # Apply the attention mask is (precomputed for all layers in BertModel forward() function)
-                self_attention_scores = self_attention_scores + extended_attention_mask
-
-            # Normalize the attention scores to probabilities.
-            self_attention_probs = nn.functional.softmax(self_attention_scores, dim=-1)
-
-            # This is actually dropping out entire tokens to attend to, which might
-            # seem a bit unusual, but is taken from the original Transformer paper.
-            self_attention_probs = layer_module.attention.self.dropout(self_attention_probs)
-
-            attention_scores = self_attention_scores.squeeze(0)[:, sequence_mask, :][:, :, sequence_mask]
-            attention_probs = self_attention_probs.squeeze(0)[:, sequence_mask, :][:, :, sequence_mask]
-
-            attn_dict["attention_probs"].update({f"layer_{i + 1}": attention_probs.detach().cpu().numpy()})
-            attn_dict["attention_scores"].update({f"layer_{i + 1}": attention_scores.detach().cpu().numpy()})
-
-            # Mask heads if we want to
-            if layer_head_mask is not None:
-                self_attention_probs = self_attention_probs * layer_head_mask
-
-            context_layer = torch.matmul(self_attention_probs, value_layer)
-            context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
-            new_context_layer_shape = context_layer.size()[:-2] + (layer_module.attention.self.all_head_size,)
-            context_layer = context_layer.view(new_context_layer_shape)
-            self_attention_outputs = (context_layer, self_attention_probs)
-            # Dissected SelfAttention code (End)
-
-            attention_output = layer_module.attention.output(self_attention_outputs[0], hidden_states)
-
-            attention_outputs = (attention_output,) + self_attention_outputs[1:]
-
-            # Dissected BertAttention code (End)
-            layer_output = apply_chunking_to_forward(
-                layer_module.feed_forward_chunk, layer_module.chunk_size_feed_forward, layer_module.seq_len_dim,
-                attention_output
-            )
-
-            layer_outputs = (layer_output,) + attention_outputs[1:]
-            # Dissected BertLayer code (End)
-
-            hidden_states = layer_outputs[0]
-            embs_dict.update({f"layer_emb_{i}": hidden_states[:, sequence_mask, :].squeeze(0)})
-            if output_attentions:
-                all_self_attentions = all_self_attentions + (layer_outputs[1],)
-
-        if output_hidden_states:
-            all_hidden_states = all_hidden_states + (hidden_states,)
-
-        # Dissected Encoder code (End)
-        sequence_output = hidden_states
-
-        # Calculate cosine simlarity with intermediate representations wih each position (per k)
-        embedding_output_cut = embedding_output.squeeze(0)[sequence_mask, :]
-        inputs = input_ids[:, sequence_mask].squeeze(0)
-        seq_len = embedding_output_cut.shape[-2]
-        position_ids = torch.arange(seq_len, dtype=torch.long, device=embedding_output.device)
-
-        position_embs = self.electra.embeddings.position_embeddings(position_ids)
-        word_embs = self.electra.embeddings.word_embeddings(inputs)
-
-        k_factor = k[0][0]
-        cos_results = cosine_similarity(word_embeds=word_embs, position_embeds=position_embs,
-                                        embedding_output=embedding_output_cut, all_hidden_states=embs_dict,
-                                        k=k_factor)
-
-        if not return_dict:
-            return tuple(
-                v
-                for v in [
-                    sequence_output,
-                    all_hidden_states,
-                    all_self_attentions,
-                    cos_results,
-                    attn_dict
-                ]
-                if v is not None
-            )
-
-        return BaseModelOutput(
-            last_hidden_state=sequence_output,
-            hidden_states=all_hidden_states,
-            attentions=all_self_attentions,
+            output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
         )
+        return_dict = return_dict if return_dict is not None else self.config.use_return_dict
+        outputs = dissect(self, input_ids=input_ids, attention_mask=attention_mask,
+                          token_type_ids=token_type_ids, position_ids=position_ids, head_mask=head_mask,
+                          inputs_embeds=inputs_embeds, output_attentions=output_attentions,
+                          output_hidden_states=output_hidden_states, k=k, attention_statistics=attention_statistics,
+                          copy_spans=copy_spans)
+        return outputs if return_dict else outputs.to_tuple()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# file: export.py
+#
+import os
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+EXPORT_INPUTS = ("input_ids", "attention_mask", "token_type_ids", "position_ids")
+EXPORT_FORMATS = {"torchscript": ".pt", "onnx": ".onnx"}
+
+
+class TokenClassifierExport(nn.Module):
+    """
+    Export wrapper of a token classifier with a fixed signature `(input_ids, attention_mask, token_type_ids,
+    position_ids) -> logits`. `position_ids` is an explicit input so that shifted-position experiments can be run on
+    the exported graph; `ExportedTokenClassifier` fills in the default `0..L-1` positions when it is not given.
+    """
+
+    def __init__(self, model: nn.Module):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor, token_type_ids: torch.Tensor,
+                position_ids: torch.Tensor) -> torch.Tensor:
+        return self.model(input_ids=input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids,
+                          position_ids=position_ids, return_dict=False)[0]
+
+
+def default_inputs(input_ids: torch.Tensor, attention_mask: Optional[torch.Tensor] = None,
+                   token_type_ids: Optional[torch.Tensor] = None,
+                   position_ids: Optional[torch.Tensor] = None) -> Tuple[torch.Tensor, ...]:
+    """Complete the inputs of the export signature the way the HF model does when they are omitted."""
+    if attention_mask is None:
+        attention_mask = torch.ones_like(input_ids)
+    if token_type_ids is None:
+        token_type_ids = torch.zeros_like(input_ids)
+    if position_ids is None:
+        position_ids = torch.arange(input_ids.shape[1], dtype=torch.long,
+                                    device=input_ids.device).expand_as(input_ids)
+    return input_ids, attention_mask, token_type_ids, position_ids
+
+
+@contextmanager
+def traceable(model: nn.Module):
+    """
+    Switch `models.attention.BertSelfAttention` to its dense, unchunked path while exporting: the blockwise relative
+    skew and the query chunking loop over the sequence length in Python, which a trace would bake in.
+    """
+    skewed = [module for module in model.modules() if getattr(module, "relative_position_skew", False)]
+    chunked = [(module, module.attention_chunk_size) for module in model.modules()
+               if getattr(module, "attention_chunk_size", None)]
+    for module in skewed:
+        module.relative_position_skew = False
+    for module, _ in chunked:
+        module.attention_chunk_size = None
+    try:
+        yield model
+    finally:
+        for module in skewed:
+            module.relative_position_skew = True
+        for module, chunk_size in chunked:
+            module.attention_chunk_size = chunk_size
+
+
+def export_torchscript(model: nn.Module, path: str, example_inputs: Tuple[torch.Tensor, ...]) -> str:
+    """Trace the model to TorchScript. Batch and sequence sizes stay dynamic since no shape is baked in the trace."""
+    wrapper = TokenClassifierExport(model).eval()
+    with torch.no_grad(), traceable(model):
+        traced = torch.jit.trace(wrapper, example_inputs, check_trace=False)
+    traced = torch.jit.freeze(traced)
+    traced.save(path)
+    return path
+
+
+def export_onnx(model: nn.Module, path: str, example_inputs: Tuple[torch.Tensor, ...], opset: int = 14) -> str:
+    """Export the model to ONNX with dynamic `batch` and `sequence` axes on every input and on the logits."""
+    wrapper = TokenClassifierExport(model).eval()
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in EXPORT_INPUTS + ("logits",)}
+    with torch.no_grad(), traceable(model):
+        torch.onnx.export(wrapper, example_inputs, path, input_names=list(EXPORT_INPUTS), output_names=["logits"],
+                          dynamic_axes=dynamic_axes, opset_version=opset, do_constant_folding=True)
+    return path
+
+
+def export_model(model: nn.Module, output_dir: str, formats=tuple(EXPORT_FORMATS), opset: int = 14,
+                 example_inputs: Optional[Tuple[torch.Tensor, ...]] = None) -> Dict[str, str]:
+    """Export `model` to `<output_dir>/model.pt` and/or `<output_dir>/model.onnx`, returns `{format: path}`."""
+    os.makedirs(output_dir, exist_ok=True)
+    model = model.to("cpu").eval()
+    if example_inputs is None:
+        example_inputs = default_inputs(torch.randint(model.config.vocab_size, (2, 16)))
+    paths = {}
+    for export_format in formats:
+        path = os.path.join(output_dir, f"model{EXPORT_FORMATS[export_format]}")
+        if export_format == "torchscript":
+            paths[export_format] = export_torchscript(model, path, example_inputs)
+        elif export_format == "onnx":
+            paths[export_format] = export_onnx(model, path, example_inputs, opset=opset)
+        else:
+            raise ValueError(f"Unknown export format {export_format}, choose one of {list(EXPORT_FORMATS)}")
+    return paths
+
+
+class ExportedTokenClassifier(object):
+    """
+    Runner of a model exported with `export_model`, picked from the file extension (`.pt` TorchScript, `.onnx`
+    onnxruntime). Returns the logits `[batch, seq_len, num_labels]` as a NumPy array.
+    """
+
+    def __init__(self, path: str, num_threads: Optional[int] = None):
+        self.path = path
+        self.backend = "onnx" if path.endswith(".onnx") else "torchscript"
+        if self.backend == "onnx":
+            try:
+                import onnxruntime
+            except ImportError:
+                raise ImportError("Running ONNX models requires onnxruntime: `pip install onnxruntime`")
+            options = onnxruntime.SessionOptions()
+            if num_threads is not None:
+                options.intra_op_num_threads = num_threads
+            self.session = onnxruntime.InferenceSession(path, sess_options=options,
+                                                        providers=["CPUExecutionProvider"])
+        else:
+            if num_threads is not None:
+                torch.set_num_threads(num_threads)
+            self.module = torch.jit.load(path, map_location="cpu").eval()
+
+    def __call__(self, input_ids, attention_mask=None, token_type_ids=None, position_ids=None) -> np.ndarray:
+        inputs = default_inputs(*[torch.as_tensor(x, dtype=torch.long) if x is not None else None
+                                  for x in [input_ids, attention_mask, token_type_ids, position_ids]])
+        if self.backend == "onnx":
+            feed = {name: x.numpy() for name, x in zip(EXPORT_INPUTS, inputs)}
+            return self.session.run(["logits"], feed)[0]
+        with torch.inference_mode():
+            return self.module(*inputs).numpy()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# file: factory.py
+#
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from typing import Dict, List, Optional, Tuple, Type
+
+import torch
+import torch.nn as nn
+from transformers import PretrainedConfig, PreTrainedModel
+from transformers.modeling_utils import no_init_weights
+
+from models.bert_ner import BertForTokenClassification
+from models.bloom_ner import BloomForTokenClassification
+from models.config import BertForTokenClassificationConfig, BloomForTokenClassificationConfig, \
+    ElectraForTokenClassificationConfig
+from models.electra_ner import ElectraForTokenClassification
+
+MODEL_CLASSES: Dict[str, Tuple[Type[PretrainedConfig], Type[PreTrainedModel]]] = {}
+
+# In-process caches: raw config dicts per checkpoint, and the weights loaded from each checkpoint per model class
+# (least recently used first, at most MAX_CACHED_STATE_DICTS of them)
+_CONFIG_DICTS: Dict[str, dict] = {}
+_STATE_DICTS: "OrderedDict[Tuple[Type[PreTrainedModel], str, tuple], Dict[str, torch.Tensor]]" = OrderedDict()
+MAX_CACHED_STATE_DICTS = 2
+# Config attributes that change the loaded weights themselves (e.g. extended position tables), part of the cache key
+CACHE_KEY_ATTRIBUTES = ("position_extension", "extended_max_position_embeddings")
+
+
+def register_model(model_type: str, config_class: Type[PretrainedConfig], model_class: Type[PreTrainedModel]):
+    """Token classifier (and its config) used for checkpoints whose `config.json` has this `model_type`."""
+    MODEL_CLASSES[model_type] = (config_class, model_class)
+
+
+register_model("bert", BertForTokenClassificationConfig, BertForTokenClassification)
+register_model("electra", ElectraForTokenClassificationConfig, ElectraForTokenClassification)
+register_model("bloom", BloomForTokenClassificationConfig, BloomForTokenClassification)
+
+
+def _config_dict(name_or_path: str) -> dict:
+    if name_or_path not in _CONFIG_DICTS:
+        _CONFIG_DICTS[name_or_path], _ = PretrainedConfig.get_config_dict(name_or_path)
+    return _CONFIG_DICTS[name_or_path]
+
+
+def model_classes(name_or_path: str) -> Tuple[Type[PretrainedConfig], Type[PreTrainedModel]]:
+    """Registered config and model classes of a checkpoint (HF hub name or local path)."""
+    model_type = _config_dict(name_or_path).get("model_type")
+    if model_type not in MODEL_CLASSES:
+        raise ValueError(f"No token classifier registered for model type {model_type} ({name_or_path}), choose one "
+                         f"of {list(MODEL_CLASSES)} or register one with `register_model`")
+    return MODEL_CLASSES[model_type]
+
+
+def load_config(name_or_path: str, **kwargs) -> PretrainedConfig:
+    """Config of the registered class for the checkpoint, `kwargs` override its attributes (as in
+    `from_pretrained`). The `config.json` is only resolved once per process."""
+    config_class, _ = model_classes(name_or_path)
+    return config_class.from_dict(dict(_config_dict(name_or_path)), **kwargs)
+
+
+@contextmanager
+def empty_parameters():
+    """Create the parameters (not the buffers) of the modules built in this context on the meta device."""
+    register_parameter = nn.Module.register_parameter
+
+    def register_empty_parameter(module, name, param):
+        if param is not None:
+            param = nn.Parameter(param.to("meta"), requires_grad=param.requires_grad)
+        register_parameter(module, name, param)
+
+    nn.Module.register_parameter = register_empty_parameter
+    try:
+        yield
+    finally:
+        nn.Module.register_parameter = register_parameter
+
+
+def _assign_state_dict(model: nn.Module, state_dict: Dict[str, torch.Tensor]) -> List[str]:
+    """Replace the (meta) parameters and buffers of the model by the tensors of `state_dict` instead of copying into
+    them, as `load_state_dict(assign=True)` of recent torch versions does. Returns the missing keys."""
+    for name, tensor in state_dict.items():
+        module_name, _, attribute = name.rpartition(".")
+        module = model.get_submodule(module_name)
+        if attribute in module._parameters:
+            requires_grad = module._parameters[attribute].requires_grad
+            module._parameters[attribute] = nn.Parameter(tensor, requires_grad=requires_grad)
+        elif attribute in module._buffers:
+            module._buffers[attribute] = tensor
+    return [name for name in model.state_dict() if name not in state_dict]
+
+
+def _from_state_dict(model_class: Type[PreTrainedModel], config: PretrainedConfig,
+                     state_dict: Dict[str, torch.Tensor], low_cpu_mem_usage: bool) -> PreTrainedModel:
+    """Build the model from cached weights, skipping the random initialization of the weights that are loaded. The
+    other weights (e.g. a new classifier) are initialized as in `from_pretrained`."""
+    # With `low_cpu_mem_usage`, parameters are created on the meta device and copies of the cached tensors are
+    # assigned in place, so every weight is materialized once
+    with no_init_weights(), empty_parameters() if low_cpu_mem_usage else nullcontext():
+        model = model_class(config)
+    shapes = {name: tensor.shape for name, tensor in model.state_dict().items()}
+    state_dict = {name: tensor.clone() if low_cpu_mem_usage else tensor for name, tensor in state_dict.items()
+                  if shapes.get(name) == tensor.shape}
+    if low_cpu_mem_usage:
+        missing = _assign_state_dict(model, state_dict)
+    else:
+        missing = model.load_state_dict(state_dict, strict=False).missing_keys
+    model.tie_weights()
+
+    for module_name in sorted({name.rpartition(".")[0] for name in missing}):
+        module = model.get_submodule(module_name)
+        for name, param in list(module.named_parameters(recurse=False)):
+            if param.is_meta:
+                module._parameters[name] = nn.Parameter(torch.empty(param.shape, dtype=param.dtype),
+                                                        requires_grad=param.requires_grad)
+        # `_init_weights` initializes the whole module, restore the loaded weights of partially missing modules
+        loaded = {name: param.detach().clone() for name, param in module.named_parameters(recurse=False)
+                  if f"{module_name}.{name}" not in missing}
+        model._init_weights(module)
+        with torch.no_grad():
+            for name, tensor in loaded.items():
+                module._parameters[name].copy_(tensor)
+    return model.eval()
+
+
+def load_model(name_or_path: str, config: Optional[PretrainedConfig] = None, low_cpu_mem_usage: bool = False,
+               cache: bool = False, **kwargs) -> PreTrainedModel:
+    """
+    Token classifier of the registered class for the checkpoint, e.g. `BertForTokenClassification` for BERT
+    checkpoints. `config` defaults to `load_config(name_or_path, **kwargs)`.
+
+    With `cache`, the weights read from the checkpoint are kept in memory (one copy per checkpoint, model class and
+    `CACHE_KEY_ATTRIBUTES` of the config) and later calls build the model from them instead of reading and
+    deserializing the checkpoint again; the weights that are not in the checkpoint (classifier, relative distance
+    embeddings, ...) are still initialized anew for every model. Only the `MAX_CACHED_STATE_DICTS` most recently
+    used weights are kept. With `low_cpu_mem_usage`, these later models are built on the meta device and only the
+    copied weights are materialized.
+    """
+    config_class, model_class = model_classes(name_or_path)
+    config = config if config is not None else load_config(name_or_path, **kwargs)
+    key = (model_class, name_or_path, tuple(getattr(config, name, None) for name in CACHE_KEY_ATTRIBUTES))
+    if cache and key in _STATE_DICTS:
+        _STATE_DICTS.move_to_end(key)
+        return _from_state_dict(model_class, config, _STATE_DICTS[key], low_cpu_mem_usage=low_cpu_mem_usage)
+
+    model, loading_info = model_class.from_pretrained(name_or_path, config=config, output_loading_info=True)
+    if cache:
+        # Only the weights that come from the checkpoint, newly initialized ones differ between models
+        initialized = set(loading_info["missing_keys"]) | {name for name, _, _ in loading_info["mismatched_keys"]}
+        _STATE_DICTS[key] = {name: tensor.detach().clone() for name, tensor in model.state_dict().items()
+                             if name not in initialized}
+        while len(_STATE_DICTS) > MAX_CACHED_STATE_DICTS:
+            _STATE_DICTS.popitem(last=False)
+    return model
+
+
+def clear_cache():
+    """Free the cached configs and weights."""
+    _CONFIG_DICTS.clear()
+    _STATE_DICTS.clear()
+
+
+def build_student(name_or_path: str, num_layers: Optional[int] = None, hidden_size: Optional[int] = None,
+                  **kwargs) -> PreTrainedModel:
+    """
+    Smaller token classifier of the registered class, initialized from a (fine-tuned teacher) checkpoint:
+        - with the checkpoint's hidden size, `num_layers` evenly spaced encoder layers of the checkpoint are kept
+          (first and last included) together with its embeddings and classifier, as in DistilBERT
+        - with a smaller `hidden_size`, the student is randomly initialized with 64-dim heads and a 4x feed-forward
+    `kwargs` override the attributes of the checkpoint's config.
+    """
+    config = load_config(name_or_path, **kwargs)
+    num_layers = num_layers or config.num_hidden_layers
+    if hidden_size is not None and hidden_size != config.hidden_size:
+        config.update({"hidden_size": hidden_size, "num_attention_heads": max(hidden_size // 64, 1),
+                       "intermediate_size": 4 * hidden_size, "num_hidden_layers": num_layers})
+        _, model_class = model_classes(name_or_path)
+        return model_class(config)
+
+    model = load_model(name_or_path, config=config, cache=False)
+    encoder = getattr(model.base_model, "encoder", None)
+    if encoder is None:
+        raise ValueError(f"Layer selection is only supported for BERT-like encoders, got {config.model_type}")
+    keep = torch.linspace(0, len(encoder.layer) - 1, num_layers).round().long().unique().tolist()
+    encoder.layer = nn.ModuleList([encoder.layer[i] for i in keep])
+    model.config.num_hidden_layers = len(keep)
+    return model
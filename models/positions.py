@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# file: positions.py
+#
+import torch
+import torch.nn as nn
+
+POSITION_EXTENSIONS = ("none", "interpolate", "tile", "extrapolate")
+
+
+def extend_position_table(table: torch.Tensor, num_positions: int, method: str = "interpolate",
+                          window: int = 32) -> torch.Tensor:
+    """
+    Extend an absolute position embedding table `[P, hidden]` to `num_positions` rows:
+        - interpolate: the table is linearly resampled over the new range, the first and last rows are kept
+        - tile:        positions P.. repeat the table, i.e. row i is row `i % P`
+        - extrapolate: the first P rows are kept and continued linearly with the mean step of the last `window` rows
+    """
+    table = table.detach()
+    positions = table.shape[0]
+    if num_positions <= positions:
+        return table[:num_positions].clone()
+    if method == "interpolate":
+        return nn.functional.interpolate(table.float().T.unsqueeze(0), size=num_positions, mode="linear",
+                                         align_corners=True)[0].T.to(table.dtype).contiguous()
+    if method == "tile":
+        return table[torch.arange(num_positions, device=table.device) % positions].clone()
+    if method == "extrapolate":
+        window = min(window, positions - 1)
+        step = (table[-1] - table[-1 - window]) / window
+        steps = torch.arange(1, num_positions - positions + 1, device=table.device, dtype=table.dtype)
+        return torch.cat([table, table[-1] + steps.unsqueeze(-1) * step])
+    raise ValueError(f"Unknown position extension {method}, choose one of {POSITION_EXTENSIONS[1:]}")
+
+
+def extend_position_embeddings(embeddings: nn.Module, num_positions: int, method: str = "interpolate") -> nn.Module:
+    """
+    Extend the `position_embeddings` of a (BERT-like) embeddings module in place, together with its `position_ids` and
+    `token_type_ids` buffers.
+    """
+    old = embeddings.position_embeddings
+    embeddings.position_embeddings = nn.Embedding(num_positions, old.embedding_dim, _weight=nn.Parameter(
+        extend_position_table(old.weight, num_positions, method=method)))
+    device = old.weight.device
+    if hasattr(embeddings, "position_ids"):
+        embeddings.position_ids = torch.arange(num_positions, device=device).expand((1, -1))
+    if hasattr(embeddings, "token_type_ids"):
+        embeddings.token_type_ids = torch.zeros((1, num_positions), dtype=torch.long, device=device)
+    return embeddings
+
+
+def position_extension_hook(method: str = "interpolate"):
+    """
+    `load_state_dict` pre-hook of an embeddings module whose position table has been enlarged: a smaller table in the
+    loaded state dict (e.g. the 512 positions of a pretrained checkpoint) is extended to the module's size with
+    `extend_position_table` before being copied. The `position_ids` and `token_type_ids` buffers saved by older
+    transformers versions are regenerated at the module's size.
+    """
+
+    def hook(module, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+        key = prefix + "position_embeddings.weight"
+        num_positions = module.position_embeddings.num_embeddings
+        if key in state_dict and state_dict[key].shape[0] < num_positions:
+            state_dict[key] = extend_position_table(state_dict[key], num_positions, method=method)
+        for name in ("position_ids", "token_type_ids"):
+            key = prefix + name
+            if key in state_dict and hasattr(module, name) and state_dict[key].shape[-1] < num_positions:
+                state_dict[key] = getattr(module, name).clone()
+
+    return hook
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# file: quantization.py
+#
+import copy
+import os
+from typing import Optional, Type
+
+import torch
+import torch.nn as nn
+from transformers import PretrainedConfig, PreTrainedModel
+
+QUANTIZED_WEIGHTS_NAME = "pytorch_model_int8.bin"
+
+
+def _set_quantized_engine():
+    # fbgemm (x86) is preferred, qnnpack is the only engine on ARM
+    engines = torch.backends.quantized.supported_engines
+    for engine in ["x86", "fbgemm", "qnnpack"]:
+        if engine in engines:
+            if torch.backends.quantized.engine != engine:
+                torch.backends.quantized.engine = engine
+            return
+
+
+def quantize_dynamic_int8(model: nn.Module, inplace: bool = False) -> nn.Module:
+    """
+    Dynamic int8 quantization of all `nn.Linear` layers (query/key/value/output projections, feed-forward and
+    classifier). Weights are stored as int8 with a per-tensor scale and activations are quantized on the fly, so no
+    calibration data is needed. Embeddings and LayerNorms stay in float32. Quantized models only run on CPU.
+    """
+    _set_quantized_engine()
+    model = model if inplace else copy.deepcopy(model)
+    model.to("cpu").eval()
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+def save_quantized(model: PreTrainedModel, path: str):
+    """Save the config and the quantized state dict (packed int8 weights) of a model quantized with
+    `quantize_dynamic_int8`."""
+    os.makedirs(path, exist_ok=True)
+    model.config.save_pretrained(path)
+    torch.save(model.state_dict(), os.path.join(path, QUANTIZED_WEIGHTS_NAME))
+
+
+def load_quantized(model_class: Type[PreTrainedModel], path: str,
+                   config_class: Optional[Type[PretrainedConfig]] = None, **kwargs) -> PreTrainedModel:
+    """
+    Load a model saved with `save_quantized`: the float model is built from the config, quantized to get the same
+    module structure, then the int8 state dict is loaded. `kwargs` override attributes of the saved config.
+    """
+    config_class = config_class if config_class is not None else model_class.config_class
+    config = config_class.from_pretrained(path, **kwargs)
+    model = quantize_dynamic_int8(model_class(config), inplace=True)
+    model.load_state_dict(torch.load(os.path.join(path, QUANTIZED_WEIGHTS_NAME), map_location="cpu"))
+    return model
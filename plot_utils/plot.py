@@ -10,6 +10,7 @@ import torch
 from matplotlib.offsetbox import AnchoredText
 
 from dataset.ner_dataset import NERDataset, NERDatasetbuilder
+from metrics.attention_store import AttentionStore
 
 api = wandb.Api()
 
@@ -67,8 +68,9 @@ def plot_pos_dist(data):
 
 def plot_loss_dist(data):
     f, ax = plt.subplots(figsize=(7.25, 5.43))
-    # Plot the orbital period with horizontal boxes
-    sns.kdeplot(data=data, x="position", y="loss", kind="kde", ax=ax)
+    # Plot the orbital period with horizontal boxes. Binned losses (`PositionLossStatistics.histogram_frame`) are
+    # weighted by their count
+    sns.kdeplot(data=data, x="position", y="loss", weights="count" if "count" in data else None, ax=ax)
     # Tweak the visual presentation
     ax.set(ylabel="Loss", xlabel='positions')
 
@@ -570,12 +572,17 @@ def attn_analysis(dataset="conll03"):
         if run.state == "finished":
             seq_path = wandb.restore("seq_info.pt", run_path="/".join(run.path), root=os.path.join(save_dir, run.id))
             seq_info = torch.load(seq_path.name)
-            attn_path = wandb.restore("attention_scores.pt", run_path="/".join(run.path), root=os.path.join(save_dir, run.id))
-            attention_scores = torch.load(attn_path.name)
-            for i, attns in enumerate(attention_scores):
-                for layer, attn_scores in enumerate(attns.items):
-
-                    print("here")
+            run_dir = os.path.join(save_dir, run.id)
+            for file in run.files():
+                if file.name.startswith("attention_store/"):
+                    wandb.restore(file.name, run_path="/".join(run.path), root=run_dir)
+            # Memory-mapped: single layers/heads are read from disk without loading the whole store
+            attention_store = AttentionStore(os.path.join(run_dir, "attention_store"))
+            for i in range(len(attention_store)):
+                for layer in range(1, attention_store.num_layers + 1):
+                    attn_probs = attention_store.get(i, layer)
+                    entropy = -(attn_probs * np.log(attn_probs + 1e-12)).sum(axis=-1).mean(axis=-1)
+                    attention_df += [[i, layer, head, h] for head, h in enumerate(entropy)]
 
 def emb_analysis(dataset="conll03"):
     experiment = "bert_position_bias_eval"
@@ -0,0 +1,18 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# file: conftest.py
+#
+import pytest
+
+from inference.predictor import NERPredictor
+from inference.server import create_tiny_checkpoint
+
+
+@pytest.fixture(scope="session")
+def tiny_checkpoint(tmp_path_factory):
+    return create_tiny_checkpoint(str(tmp_path_factory.mktemp("tiny")))
+
+
+@pytest.fixture(scope="module")
+def predictor(tiny_checkpoint):
+    return NERPredictor.from_pretrained(tiny_checkpoint, max_length=64, device="cpu", stride=16)
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# file: test_attention_stats.py
+#
+import pandas as pd
+import pytest
+import torch
+
+from metrics.attention_stats import AttentionStatistics
+
+
+def _left_pad(x: torch.Tensor, lengths: torch.Tensor, dims) -> torch.Tensor:
+    """Move the first `lengths[b]` entries of every sequence to the end of the `dims` axes."""
+    padded = torch.zeros_like(x)
+    seq_len = x.shape[dims[0]]
+    for b, length in enumerate(lengths.tolist()):
+        index = [b] + [slice(None)] * (x.dim() - 1)
+        target = list(index)
+        for dim in dims:
+            index[dim] = slice(0, length)
+            target[dim] = slice(seq_len - length, seq_len)
+        padded[tuple(target)] = x[tuple(index)]
+    return padded
+
+
+@pytest.mark.parametrize("with_copy_ids", [False, True])
+def test_left_and_right_padding_agree(with_copy_ids):
+    torch.manual_seed(0)
+    batch_size, num_heads, seq_len, k = 3, 2, 12, 2
+    lengths = torch.tensor([12, 9, 6])
+    mask = (torch.arange(seq_len) < lengths.unsqueeze(-1)).long()
+    scores = torch.randn(batch_size, num_heads, seq_len, seq_len).masked_fill(~mask.bool()[:, None, None, :], -1e9)
+    probs = scores.softmax(-1) * mask[:, None, :, None]
+    copy_ids = None
+    if with_copy_ids:
+        copy_ids = torch.full((batch_size, seq_len), -1)
+        for b, length in enumerate(lengths.tolist()):
+            copy_ids[b, 1:length - 1] = torch.arange(length - 2) * k // (length - 2)
+
+    right = AttentionStatistics(num_layers=1, num_heads=num_heads, max_length=seq_len, max_k=k)
+    right.update(0, probs, mask, k=k, copy_ids=copy_ids)
+    left = AttentionStatistics(num_layers=1, num_heads=num_heads, max_length=seq_len, max_k=k)
+    left.update(0, _left_pad(probs, lengths, dims=[2, 3]), _left_pad(mask, lengths, dims=[1]), k=k,
+                copy_ids=None if copy_ids is None else _left_pad(copy_ids + 1, lengths, dims=[1]) - 1)
+
+    pd.testing.assert_frame_equal(left.summary(), right.summary())
+    pd.testing.assert_frame_equal(left.copy_summary(), right.copy_summary())
@@ -0,0 +1,16 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# file: test_cosine_similarity.py
+#
+import torch
+
+from metrics.cosine_similartiy import copy_ids_from_spans
+
+
+def test_copy_ids_follow_left_padding():
+    copy_spans = [[[1, 3], [3, 5]], [[1, 2], [2, 3]]]
+    right = copy_ids_from_spans(copy_spans, seq_length=6)
+    left = copy_ids_from_spans(copy_spans, seq_length=6, offsets=[0, 2])
+    assert right.tolist() == [[-1, 0, 0, 1, 1, -1], [-1, 0, 1, -1, -1, -1]]
+    assert torch.equal(left[0], right[0])
+    assert left[1].tolist() == [-1, -1, -1, 0, 1, -1]
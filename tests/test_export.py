@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# file: test_export.py
+#
+import numpy as np
+import pytest
+import torch
+
+from models.bert_ner import BertForTokenClassification
+from models.config import BertForTokenClassificationConfig
+from models.export import ExportedTokenClassifier, default_inputs, export_model
+
+
+@pytest.mark.parametrize("attention_chunk_size", [None, 4])
+def test_torchscript_parity_at_other_lengths(tmp_path, attention_chunk_size):
+    torch.manual_seed(0)
+    config = BertForTokenClassificationConfig(vocab_size=100, hidden_size=32, num_hidden_layers=2,
+                                              num_attention_heads=2, intermediate_size=64, max_position_embeddings=64,
+                                              num_labels=5,
+                                              attention_chunk_size=attention_chunk_size)
+    model = BertForTokenClassification(config).eval()
+    paths = export_model(model, str(tmp_path), formats=["torchscript"],
+                         example_inputs=default_inputs(torch.randint(100, (2, 16))))
+    assert getattr(model.bert.encoder.layer[0].attention.self, "attention_chunk_size", None) == attention_chunk_size
+    runner = ExportedTokenClassifier(paths["torchscript"])
+    for seq_length in [10, 16, 23]:
+        input_ids = torch.randint(100, (3, seq_length))
+        attention_mask = torch.ones_like(input_ids)
+        attention_mask[0, seq_length // 2:] = 0
+        with torch.inference_mode():
+            expected = model(input_ids, attention_mask=attention_mask).logits.numpy()
+        np.testing.assert_allclose(runner(input_ids, attention_mask), expected, atol=1e-5)
@@ -0,0 +1,17 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# file: test_predictor.py
+#
+from inference.predictor import NERPredictor
+
+
+def test_empty_batch(predictor):
+    assert predictor.predict_entities([]) == []
+    assert predictor.predict_entities([""]) == [[]]
+
+
+def test_windows_fit_the_position_embeddings(tiny_checkpoint):
+    predictor = NERPredictor.from_pretrained(tiny_checkpoint, max_length=512, device="cpu", stride=16)
+    assert predictor.max_length == predictor.model.config.max_position_embeddings
+    entities = predictor.predict_entities([" ".join(["Berlin"] * 400)])
+    assert len(entities) == 1
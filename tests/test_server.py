@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# file: test_server.py
+#
+import pytest
+
+from inference.server import MicroBatcher
+
+
+@pytest.fixture
+def batcher(predictor):
+    batcher = MicroBatcher(predictor, max_batch_size=8, max_wait_ms=200)
+    yield batcher
+    batcher.close()
+
+
+def test_empty_request(batcher):
+    assert batcher.predict_entities([], timeout=10) == []
+
+
+def test_failing_request_is_isolated(batcher, monkeypatch):
+    decode = batcher.predictor.decode
+
+    def failing_decode(encoded, labels, scores):
+        if encoded.texts == ["poison"]:
+            raise RuntimeError("decode failed")
+        return decode(encoded, labels, scores)
+
+    monkeypatch.setattr(batcher.predictor, "decode", failing_decode)
+    # Both requests are gathered in the same micro-batch within `max_wait_ms`
+    poisoned = batcher.submit(["poison"])
+    healthy = batcher.submit(["John lives in Berlin"])
+    with pytest.raises(RuntimeError):
+        poisoned.result(timeout=10)
+    assert len(healthy.result(timeout=10)) == 1
+    assert batcher.statistics.batches == 1
@@ -12,6 +12,9 @@ import numpy as np
 import argparse
 from transformers import TrainingArguments, HfArgumentParser, set_seed
 
+from metrics.head_importance import HEAD_IMPORTANCE_METHODS
+from models.positions import POSITION_EXTENSIONS
+
 
 def set_random_seed(seed: int):
     """set seeds for reproducibility"""
@@ -76,6 +79,25 @@ def get_parser(HF=True) -> argparse.ArgumentParser:
     parser.add_argument('--watch_attentions', action="store_true",
                         help='If set, attention scores will be logged',
                         )
+    parser.add_argument('--attention_capture', type=str, default="float32",
+                        choices=["float32", "float16", "bfloat16", "uint8", "topk", "none"],
+                        help='Storage mode of the captured attention: dense float32/float16/bfloat16, probabilities '
+                             'quantized to uint8, only the top-k attended keys per query ("topk"), or "none" to not '
+                             'store raw attention at all',
+                        )
+    parser.add_argument('--attention_topk', default=8, type=int,
+                        help='Number of attended keys kept per query when --attention_capture=topk')
+    parser.add_argument('--attention_statistics', action="store_true",
+                        help='If set, attention statistics (entropy, distance, [CLS]/[SEP]/same-copy mass) are '
+                             'aggregated per layer/head/position during evaluation',
+                        )
+    parser.add_argument('--position_decoding', action="store_true",
+                        help='If set, the position of every token is decoded from the hidden states of each layer '
+                             '(argmax cosine with the position embedding table) during evaluation',
+                        )
+    parser.add_argument('--low_cpu_mem_usage', action="store_true",
+                        help='If set, models built from in-process cached weights are created on the meta device and '
+                             'only the loaded weights are materialized')
     parser.add_argument('--batch_size', default=64, type=int, help='batch size when evaluating')
     parser.add_argument('--position_embedding_type', default='absolute',
                         help=' Type of position embedding. Choose one of "absolute", "relative_key", '
@@ -84,6 +106,81 @@ def get_parser(HF=True) -> argparse.ArgumentParser:
                              '(Shaw et al.). For more information on "relative_key_query", please refer to Method 4 in '
                              'Improve Transformer Models with Better Relative Position Embeddings (Huang et al.).',
                         choices=["absolute", "relative_key", "relative_key_query"])
+    parser.add_argument('--fused_attention', action="store_true",
+                        help='If set, self-attention dispatches to torch scaled_dot_product_attention whenever the '
+                             'attention probabilities are not requested (absolute position embeddings only)')
+    parser.add_argument('--attention_chunk_size', default=None, type=int,
+                        help='If set, self-attention processes the queries in chunks of this many tokens so the '
+                             'attention memory stays bounded on long inputs')
+    parser.add_argument('--position_extension', default='none', choices=POSITION_EXTENSIONS,
+                        help='How the absolute position embeddings of the checkpoint are extended to '
+                             '--extended_max_position_embeddings positions (e.g. to evaluate large k)')
+    parser.add_argument('--extended_max_position_embeddings', default=None, type=int,
+                        help='Number of positions of the extended position embedding table')
+    parser.add_argument('--export_dir', type=str, default='exported',
+                        help='Output directory of the exported TorchScript/ONNX models')
+    parser.add_argument('--export_formats', type=str, nargs="+", default=["torchscript", "onnx"],
+                        choices=["torchscript", "onnx"], help='Formats the model is exported to')
+    parser.add_argument('--onnx_opset', default=14, type=int, help='ONNX opset version of the export')
+    parser.add_argument('--export_atol', default=1e-4, type=float,
+                        help='Maximum absolute logit difference between the exported and the PyTorch model')
+    parser.add_argument('--f1_tolerance', default=0.005, type=float,
+                        help='Maximum test F1 drop of the int8 quantized model with respect to fp32')
+    parser.add_argument('--head_importance', default='gradient', choices=HEAD_IMPORTANCE_METHODS,
+                        help='Head importance used for pruning: gradient of the dev loss w.r.t. a head mask, or the '
+                             'negated mean attention entropy')
+    parser.add_argument('--prune_fraction', default=0.2, type=float,
+                        help='Fraction of the attention heads (least important first) pruned by prune_heads.py')
+    parser.add_argument('--teacher', type=str, default=None,
+                        help='Fine-tuned teacher checkpoint (local path or HuggingFace name) of bert_distillation.py')
+    parser.add_argument('--student_layers', default=6, type=int,
+                        help='Number of encoder layers of the student, evenly spaced layers of the teacher are kept')
+    parser.add_argument('--student_hidden_size', default=None, type=int,
+                        help='Hidden size of the student, randomly initialized when it differs from the teacher\'s')
+    parser.add_argument('--distill_temperature', default=2.0, type=float, help='Softmax temperature of the KD loss')
+    parser.add_argument('--distill_alpha', default=0.5, type=float,
+                        help='Weight of the cross-entropy with the gold labels, 1 - alpha weighs the KD loss')
+    parser.add_argument('--soft_label_cache', type=str, default=None,
+                        help='If set, the teacher soft labels of the training batches and their augmented views '
+                             'are computed once and cached in this directory')
+    parser.add_argument('--predict_file', type=str, default=None,
+                        help='Text file (one text per line) whose entities are predicted by predict_entities.py')
+    parser.add_argument('--predictions_file', type=str, default='predictions.jsonl',
+                        help='JSON lines output of predict_entities.py')
+    parser.add_argument('--constrained_decoding', action="store_true",
+                        help='If set, predictions and metrics decode the most likely valid IOBES label sequence '
+                             '(constrained Viterbi) instead of the per-token argmax')
+    parser.add_argument('--window_stride', default=128, type=int,
+                        help='Number of subwords shared by consecutive windows when long texts are predicted in '
+                             'sliding windows of max_length tokens')
+    parser.add_argument('--position_weights', type=str, default=None,
+                        help='.npy file of the reliability of each window position (e.g. per-position F1), used to '
+                             'weigh overlapping window predictions. Defaults to a linear decay with the position')
+    parser.add_argument('--position_shifts', default=1, type=int,
+                        help='Number of deterministic position shifts whose logits are averaged at inference '
+                             '(test-time augmentation, 1 disables it)')
+    parser.add_argument('--max_position_shift', default=None, type=int,
+                        help='Largest test-time position shift, defaults to half of max_position_embeddings')
+    parser.add_argument('--tta_shifts', type=int, nargs="+", default=[1, 2, 4, 8],
+                        help='Numbers of test-time position shifts compared by position_shift_tta.py')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Host of the NER server')
+    parser.add_argument('--port', default=8000, type=int, help='Port of the NER server')
+    parser.add_argument('--unix_socket', type=str, default=None,
+                        help='If set, the NER server listens on this Unix socket instead of host:port')
+    parser.add_argument('--workers', default=1, type=int,
+                        help='Number of pre-forked NER server processes sharing the model weights')
+    parser.add_argument('--max_batch_size', default=32, type=int,
+                        help='Maximum number of texts coalesced into one micro-batch by the NER server')
+    parser.add_argument('--max_wait_ms', default=5.0, type=float,
+                        help='Maximum time (ms) the NER server waits to fill a micro-batch')
+    parser.add_argument('--tokenizer_threads', default=2, type=int,
+                        help='Number of threads tokenizing the requests of the NER server')
+    parser.add_argument('--smoke_test', action="store_true",
+                        help='If set, serve_ner.py serves a tiny random-init checkpoint and queries it offline')
+    parser.add_argument('--threads', default=None, type=int, help='Number of torch CPU threads')
+    parser.add_argument('--classify_labeled_only', action="store_true",
+                        help='If set, dropout, classifier and loss are only computed at labeled token positions '
+                             '(padding and ignored subwords are skipped)')
     parser.add_argument("--debugging", action="store_true", help="whether it's debugging")
 
     return parser